@@ -14,6 +14,7 @@ from notifications_utils.clients.redis.redis_client import RedisClient
 from notifications_utils import logging, request_helper
 from werkzeug.local import LocalProxy
 
+from app import instrumentation
 from app.celery.celery import NotifyCelery
 from app.clients import Clients
 from app.clients.document_download import DocumentDownloadClient
@@ -48,7 +49,11 @@ api_user = LocalProxy(lambda: _request_ctx_stack.top.api_user)
 authenticated_service = LocalProxy(lambda: _request_ctx_stack.top.authenticated_service)
 
 
-def create_app(application):
+def create_app(application, register_routes=True):
+    """
+    Celery workers don't serve requests, so run_celery.py passes register_routes=False to skip importing the
+    blueprints and commands. Workers import their tasks from CELERY_IMPORTS instead.
+    """
     from app.config import configs
 
     notify_environment = os.environ['NOTIFY_ENVIRONMENT']
@@ -68,20 +73,26 @@ def create_app(application):
     firetext_client.init_app(application, statsd_client=statsd_client)
     loadtest_client.init_app(application, statsd_client=statsd_client)
     mmg_client.init_app(application, statsd_client=statsd_client)
-    aws_ses_client.init_app(application.config['AWS_REGION'], statsd_client=statsd_client)
+    aws_ses_client.init_app(
+        application.config['AWS_REGION'],
+        statsd_client=statsd_client,
+        max_pool_connections=application.config['PROVIDER_BATCH_MAX_CONCURRENT_REQUESTS'],
+    )
     notify_celery.init_app(application)
     encryption.init_app(application)
     redis_store.init_app(application)
+    instrumentation.init_app(redis_store)
     performance_platform_client.init_app(application)
     document_download_client.init_app(application)
     clients.init_app(sms_clients=[firetext_client, mmg_client, loadtest_client], email_clients=[aws_ses_client])
 
-    register_blueprint(application)
-    register_v2_blueprints(application)
+    if register_routes:
+        register_blueprint(application)
+        register_v2_blueprints(application)
 
-    # avoid circular imports by importing this file later
-    from app.commands import setup_commands
-    setup_commands(application)
+        # avoid circular imports by importing this file later
+        from app.commands import setup_commands
+        setup_commands(application)
 
     return application
 
@@ -234,13 +245,15 @@ def init_app(app):
     def record_request_details():
         g.start = monotonic()
         g.endpoint = request.endpoint
+        if request.endpoint:
+            instrumentation.start_request_spans(request.endpoint)
 
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE')
-        return response
+        return instrumentation.finish_request_spans(response)
 
     @app.errorhandler(Exception)
     def exception(error):
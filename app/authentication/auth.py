@@ -5,6 +5,7 @@ from notifications_utils import request_helper
 from sqlalchemy.exc import DataError
 from sqlalchemy.orm.exc import NoResultFound
 
+from app import instrumentation
 from app.dao.services_dao import dao_fetch_service_by_id_with_api_keys
 
 
@@ -61,6 +62,7 @@ def requires_admin_auth():
         raise AuthError('Unauthorized, admin authentication token required', 401)
 
 
+@instrumentation.span('auth')
 def requires_auth():
     request_helper.check_proxy_header_before_request()
 
@@ -1,28 +1,104 @@
+import os
+import threading
+import urllib.parse
 from datetime import datetime, timedelta
+from time import monotonic
 
 from flask import current_app
 
 import pytz
-from boto3 import client, resource
+import boto3
 import botocore
+from botocore.config import Config
+
+from app import statsd_client
 
 FILE_LOCATION_STRUCTURE = 'service-{}-notify/{}.csv'
 
+_client = {'pid': None, 'client': None, 'reused': 0, 'reported_at': None}
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    The S3 client for this process, created on first use. Creating one means resolving credentials and loading
+    endpoint data, and each has its own connection pool, so every S3 call in a process shares it. Clients are
+    thread safe, unlike resources, so it can be used from the threads in send_concurrently too.
+
+    Celery's prefork workers inherit the parent's client, whose connections can't be shared between processes,
+    so a new one is made when the process id changes.
+
+    How many times the client was reused is counted in process and sent to statsd at most every
+    S3_CLIENT_STATS_INTERVAL_SECONDS, rather than on every call.
+    """
+    with _client_lock:
+        if _client['pid'] != os.getpid():
+            # boto3's default session isn't thread safe, so make one for the client
+            _client['client'] = boto3.session.Session().client(
+                's3',
+                region_name=current_app.config['AWS_REGION'],
+                config=Config(max_pool_connections=current_app.config['S3_MAX_POOL_CONNECTIONS']),
+            )
+            _client['pid'] = os.getpid()
+            _client['reused'] = 0
+            _client['reported_at'] = monotonic()
+            statsd_client.incr('clients.s3.created')
+        else:
+            _client['reused'] += 1
+            if monotonic() - _client['reported_at'] >= current_app.config['S3_CLIENT_STATS_INTERVAL_SECONDS']:
+                statsd_client.incr('clients.s3.reused', count=_client['reused'])
+                _client['reused'] = 0
+                _client['reported_at'] = monotonic()
+        return _client['client']
+
+
+def get_s3_resource():
+    """
+    A new S3 resource, for the few places that list a bucket through its objects. Resources aren't thread safe,
+    so they aren't shared: everything else uses the client from get_s3_client.
+    """
+    return boto3.session.Session().resource('s3', region_name=current_app.config['AWS_REGION'])
+
+
+def s3upload(filedata, region, bucket_name, file_location, content_type='binary/octet-stream', tags=None):
+    """
+    Does the same as notifications_utils.s3.s3upload, which makes a new resource for each upload, but with the
+    shared client. `region` is only there to keep the same arguments: the client is for AWS_REGION.
+
+    `filedata` can also be a file, which boto3 uploads in parts if it's bigger than 8MB.
+    """
+    upload_args = {
+        'ServerSideEncryption': 'AES256',
+        'ContentType': content_type,
+    }
+    if tags:
+        upload_args['Tagging'] = urllib.parse.urlencode(tags)
+
+    try:
+        if hasattr(filedata, 'read'):
+            get_s3_client().upload_fileobj(filedata, bucket_name, file_location, ExtraArgs=upload_args)
+        else:
+            get_s3_client().put_object(Bucket=bucket_name, Key=file_location, Body=filedata, **upload_args)
+    except botocore.exceptions.ClientError as e:
+        current_app.logger.error(
+            "Unable to upload file to S3 bucket {} key {}: {}".format(bucket_name, file_location, e)
+        )
+        raise
+
 
 def get_s3_file(bucket_name, file_location):
-    s3_file = get_s3_object(bucket_name, file_location)
-    return s3_file.get()['Body'].read().decode('utf-8')
+    s3_file = get_s3_client().get_object(Bucket=bucket_name, Key=file_location)
+    return s3_file['Body'].read().decode('utf-8')
 
 
-def get_s3_object(bucket_name, file_location):
-    s3 = resource('s3')
-    return s3.Object(bucket_name, file_location)
+def get_s3_object_metadata(bucket_name, file_location):
+    return get_s3_client().head_object(Bucket=bucket_name, Key=file_location)['Metadata']
 
 
 def file_exists(bucket_name, file_location):
     try:
         # try and access metadata of object
-        get_s3_object(bucket_name, file_location).metadata
+        get_s3_object_metadata(bucket_name, file_location)
         return True
     except botocore.exceptions.ClientError as e:
         if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
@@ -38,13 +114,17 @@ def get_job_location(service_id, job_id):
 
 
 def get_job_from_s3(service_id, job_id):
-    obj = get_s3_object(*get_job_location(service_id, job_id))
-    return obj.get()['Body'].read().decode('utf-8')
+    return get_s3_file(*get_job_location(service_id, job_id))
+
+
+def upload_job_to_s3(service_id, job_id, file_data, metadata):
+    bucket_name, file_location = get_job_location(service_id, job_id)
+    get_s3_client().put_object(Bucket=bucket_name, Key=file_location, Body=file_data, Metadata=metadata)
 
 
 def get_job_metadata_from_s3(service_id, job_id):
-    obj = get_s3_object(*get_job_location(service_id, job_id))
-    return obj.get()['Metadata']
+    bucket_name, file_location = get_job_location(service_id, job_id)
+    return get_s3_client().get_object(Bucket=bucket_name, Key=file_location)['Metadata']
 
 
 def remove_job_from_s3(service_id, job_id):
@@ -52,19 +132,21 @@ def remove_job_from_s3(service_id, job_id):
 
 
 def get_s3_bucket_objects(bucket_name, subfolder='', older_than=7, limit_days=2):
-    boto_client = client('s3', current_app.config['AWS_REGION'])
-    paginator = boto_client.get_paginator('list_objects_v2')
+    return list(iter_s3_bucket_objects(bucket_name, subfolder))
+
+
+def iter_s3_bucket_objects(bucket_name, subfolder=''):
+    """
+    The objects under subfolder, listed a page of 1000 at a time as they're needed rather than all up front.
+    """
+    paginator = get_s3_client().get_paginator('list_objects_v2')
     page_iterator = paginator.paginate(
         Bucket=bucket_name,
         Prefix=subfolder
     )
 
-    all_objects_in_bucket = []
     for page in page_iterator:
-        if page.get('Contents'):
-            all_objects_in_bucket.extend(page['Contents'])
-
-    return all_objects_in_bucket
+        yield from page.get('Contents', [])
 
 
 def filter_s3_bucket_objects_within_date_range(bucket_objects, older_than=7, limit_days=2):
@@ -87,21 +169,53 @@ def filter_s3_bucket_objects_within_date_range(bucket_objects, older_than=7, lim
     return filtered_items
 
 
+def copy_s3_object(source_bucket, source_key, target_bucket, target_key, metadata=None):
+    """
+    Copy an object within S3, without downloading it. The target keeps the source's metadata unless new
+    metadata is given.
+    """
+    extra_args = {'ServerSideEncryption': 'AES256'}
+    if metadata is not None:
+        extra_args.update(Metadata=metadata, MetadataDirective='REPLACE')
+
+    get_s3_client().copy_object(
+        CopySource={'Bucket': source_bucket, 'Key': source_key},
+        Bucket=target_bucket,
+        Key=target_key,
+        **extra_args
+    )
+
+
+def delete_s3_objects(bucket_name, object_keys):
+    """
+    Delete objects in batches of 1000, the most S3 takes in one request. Returns the keys that couldn't be
+    deleted.
+    """
+    failed = []
+    for i in range(0, len(object_keys), 1000):
+        response = get_s3_client().delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': key} for key in object_keys[i:i + 1000]], 'Quiet': True}
+        )
+        for error in response.get('Errors', []):
+            current_app.logger.error("Unable to delete {} from S3 bucket {}: {}".format(
+                error['Key'], bucket_name, error.get('Message')))
+            failed.append(error['Key'])
+    return failed
+
+
 def remove_s3_object(bucket_name, object_key):
-    obj = get_s3_object(bucket_name, object_key)
-    return obj.delete()
+    return get_s3_client().delete_object(Bucket=bucket_name, Key=object_key)
 
 
 def remove_transformed_dvla_file(job_id):
     bucket_name = current_app.config['DVLA_BUCKETS']['job']
     file_location = '{}-dvla-job.text'.format(job_id)
-    obj = get_s3_object(bucket_name, file_location)
-    return obj.delete()
+    return remove_s3_object(bucket_name, file_location)
 
 
 def get_list_of_files_by_suffix(bucket_name, subfolder='', suffix='', last_modified=None):
-    s3_client = client('s3', current_app.config['AWS_REGION'])
-    paginator = s3_client.get_paginator('list_objects_v2')
+    paginator = get_s3_client().get_paginator('list_objects_v2')
 
     page_iterator = paginator.paginate(
         Bucket=bucket_name,
@@ -1,8 +1,11 @@
 import time
+from contextlib import contextmanager
 
 from celery import Celery, Task
-from celery.signals import worker_process_shutdown
-from flask import current_app
+from celery.signals import before_task_publish, worker_process_shutdown
+from flask import current_app, g, has_app_context
+
+from app import instrumentation
 
 
 @worker_process_shutdown.connect
@@ -10,6 +13,13 @@ def worker_process_shutdown(sender, signal, pid, exitcode, **kwargs):
     current_app.logger.info('worker shutdown: PID: {} Exitcode: {}'.format(pid, exitcode))
 
 
+@before_task_publish.connect
+def add_published_at(sender=None, body=None, **kwargs):
+    # becomes self.request.notify_published_at in the task, for measuring time spent waiting on the queue
+    if isinstance(body, dict):
+        body['notify_published_at'] = time.time()
+
+
 def make_task(app):
     class NotifyTask(Task):
         abstract = True
@@ -32,7 +42,30 @@ def make_task(app):
             # ensure task has flask context to access config, logger, etc
             with app.app_context():
                 self.start = time.time()
-                return super().__call__(*args, **kwargs)
+                self.record_queue_wait()
+                profile = instrumentation.start_sampled_profile(app.config['TASK_PROFILING_SAMPLE_RATE'])
+                try:
+                    return super().__call__(*args, **kwargs)
+                finally:
+                    elapsed_time = time.time() - self.start
+                    self.record_time_breakdown()
+                    instrumentation.log_profile_if_slow(
+                        profile, self.name, elapsed_time, app.config['TASK_PROFILING_MIN_SECONDS']
+                    )
+
+        def record_queue_wait(self):
+            from app import statsd_client
+
+            published_at = getattr(self.request, 'notify_published_at', None)
+            if published_at:
+                statsd_client.timing('celery.{}.queue-wait'.format(self.name), max(0, self.start - published_at))
+
+        def record_time_breakdown(self):
+            from app import statsd_client
+
+            for kind, (count, total) in instrumentation.get_timing_totals().items():
+                statsd_client.timing('celery.{}.{}-time'.format(self.name, kind), total)
+                statsd_client.incr('celery.{}.{}-calls'.format(self.name, kind), count=count)
 
     return NotifyTask
 
@@ -47,3 +80,73 @@ class NotifyCelery(Celery):
         )
 
         self.conf.update(app.config)
+
+    @contextmanager
+    def batch_publishing(self):
+        """
+        Within this context, tasks queued with `publish` or `publish_by_name` are held per queue and published
+        together over one producer connection. Messages are sent once PUBLISH_BATCH_SIZE are waiting for a queue,
+        when one is added after the oldest has waited PUBLISH_BATCH_MAX_SECONDS, and when the context exits.
+
+        Nested contexts share the outermost one, which does the final flush.
+        """
+        if g.get('batch_publisher') is not None:
+            yield g.batch_publisher
+            return
+
+        publisher = BatchPublisher(
+            self,
+            current_app.config['PUBLISH_BATCH_SIZE'],
+            current_app.config['PUBLISH_BATCH_MAX_SECONDS']
+        )
+        g.batch_publisher = publisher
+        try:
+            yield publisher
+        finally:
+            g.pop('batch_publisher')
+            publisher.flush()
+
+    def publish(self, task, args, queue, **options):
+        return self._publish(queue, task.apply_async, (args,), dict(options, queue=queue))
+
+    def publish_by_name(self, name, queue, **options):
+        return self._publish(queue, self.send_task, (), dict(options, name=name, queue=queue))
+
+    def _publish(self, queue, send, args, kwargs):
+        publisher = g.get('batch_publisher') if has_app_context() else None
+        if publisher is None:
+            return send(*args, **kwargs)
+        publisher.add(queue, send, args, kwargs)
+
+
+class BatchPublisher:
+
+    def __init__(self, celery, batch_size, max_seconds):
+        self.celery = celery
+        self.batch_size = batch_size
+        self.max_seconds = max_seconds
+        # queue -> (monotonic time the first message was added, [(send, args, kwargs)])
+        self.batches = {}
+
+    def add(self, queue, send, args, kwargs):
+        first_added_at, messages = self.batches.setdefault(queue, (time.monotonic(), []))
+        messages.append((send, args, kwargs))
+        if len(messages) >= self.batch_size or time.monotonic() - first_added_at >= self.max_seconds:
+            self.flush(queue)
+
+    def flush(self, queue=None):
+        from app import statsd_client
+
+        for queue in [queue] if queue else list(self.batches):
+            _, messages = self.batches.pop(queue, (None, []))
+            if not messages:
+                continue
+
+            start = time.monotonic()
+            with self.celery.producer_or_acquire() as producer:
+                for send, args, kwargs in messages:
+                    send(*args, producer=producer, **kwargs)
+
+            statsd_client.timing('celery.publish.{}.elapsed-time'.format(queue), time.monotonic() - start)
+            statsd_client.incr('celery.publish.{}.messages'.format(queue), count=len(messages))
+            statsd_client.incr('celery.publish.{}.batches'.format(queue))
@@ -1,12 +1,15 @@
+import json
 import math
+import threading
+import uuid
 from datetime import datetime
+from itertools import islice
 
+import requests
 from botocore.exceptions import ClientError as BotoClientError
 from flask import current_app
-from requests import (
-    post as requests_post,
-    RequestException
-)
+from requests import RequestException
+from requests.adapters import HTTPAdapter
 
 from notifications_utils.statsd_decorators import statsd
 
@@ -17,14 +20,26 @@ from app.dao.notifications_dao import (
     get_notification_by_id,
     update_notification_status_by_id,
     dao_update_notification,
+    dao_get_count_of_letters_to_process_for_date,
     dao_get_notification_by_reference,
-    dao_get_notifications_by_references,
+    dao_get_notification_statuses_by_references,
+    dao_get_notifications_by_ids,
+    dao_update_notifications_billable_units,
     dao_update_notifications_by_reference,
 )
+from app.delivery.send_to_providers import send_concurrently
 from app.errors import VirusScanError
 from app.letters.utils import (
+    cache_letter_pdf,
+    copy_cached_letter_pdf,
+    decrement_letters_to_process,
+    get_letter_pdf_cache_key,
+    get_letter_pdf_filename,
+    get_letters_to_process_count,
     get_reference_from_filename,
+    increment_letters_to_process,
     move_scanned_pdf_to_test_or_live_pdf_bucket,
+    record_letter_pdf_location,
     upload_letter_pdf,
     move_failed_pdf, ScanErrorType, move_error_pdf_to_scan_bucket,
     get_file_names_from_error_bucket
@@ -43,15 +58,26 @@ from app.models import (
 def create_letters_pdf(self, notification_id):
     try:
         notification = get_notification_by_id(notification_id, _raise=True)
-
-        pdf_data, billable_units = get_letters_pdf(
-            notification.template,
+        letter_args = dict(
             contact_block=notification.reply_to_text,
             org_id=notification.service.dvla_organisation.id,
             values=notification.personalisation
         )
 
-        upload_letter_pdf(notification, pdf_data)
+        cache_key = None
+        billable_units = None
+        if current_app.config['LETTERS_PDF_CACHE_ENABLED']:
+            cache_key = get_letter_pdf_cache_key(get_letters_pdf_data(notification.template, **letter_args))
+            billable_units = copy_cached_letter_pdf(
+                cache_key,
+                get_letter_pdf_filename(notification.reference, notification.service.crown)
+            )
+
+        if billable_units is None:
+            pdf_data, billable_units = get_letters_pdf(notification.template, **letter_args)
+            upload_file_name = upload_letter_pdf(notification, pdf_data)
+            if cache_key:
+                cache_letter_pdf(cache_key, upload_file_name, billable_units)
 
         notification.billable_units = billable_units
         dao_update_notification(notification)
@@ -70,22 +96,149 @@ def create_letters_pdf(self, notification_id):
             current_app.logger.exception(
                 "RETRY FAILED: task create_letters_pdf failed for notification {}".format(notification_id),
             )
-            update_notification_status_by_id(notification_id, 'technical-failure')
+            failed_notification = update_notification_status_by_id(notification_id, 'technical-failure')
+            if failed_notification:
+                decrement_letters_to_process(failed_notification)
+
+
+@notify_celery.task(bind=True, name="create-letters-pdf-batch", max_retries=5, default_retry_delay=60)
+@statsd(namespace="tasks")
+def create_letters_pdf_batch(self, notification_ids):
+    """
+    Create the PDFs for up to CREATE_LETTERS_PDF_BATCH_SIZE letters in one task, and queue any more as another
+    batch. The letters are rendered and uploaded on a bounded pool of threads, and their billable units are saved
+    together at the end. Any that fail are handed to create_letters_pdf so that retries stay per letter.
+
+    Letters are saved before their batch is published, so any that aren't in the database are retried a few
+    times in case their transaction is still finishing, then handed to create_letters_pdf. Letters that are no
+    longer waiting for a PDF, for example because they were cancelled or have already gone to DVLA, are skipped.
+    """
+    notification_ids = [str(notification_id) for notification_id in notification_ids]
+    batch_size = current_app.config['CREATE_LETTERS_PDF_BATCH_SIZE']
+    if len(notification_ids) > batch_size:
+        create_letters_pdf_batch.apply_async([notification_ids[batch_size:]], queue=QueueNames.CREATE_LETTERS_PDF)
+        notification_ids = notification_ids[:batch_size]
+
+    notifications = dao_get_notifications_by_ids(notification_ids)
+    letters = _build_letters(notifications)
+    results = send_concurrently(
+        _create_letter_pdf,
+        letters,
+        max_workers=current_app.config['CREATE_LETTERS_PDF_MAX_CONCURRENT_REQUESTS']
+    )
+
+    billable_units = {}
+    for letter, (units, exception) in zip(letters, results):
+        if exception is None:
+            billable_units[letter['id']] = units
+        else:
+            current_app.logger.error("Letters PDF notification creation for id: {} failed: {}".format(
+                letter['id'], exception
+            ))
+            create_letters_pdf.apply_async([letter['id']], queue=QueueNames.RETRY)
+
+    dao_update_notifications_billable_units(billable_units)
+    current_app.logger.info(
+        "Created {} letter PDFs in a batch of {}".format(len(billable_units), len(notification_ids))
+    )
+
+    found_ids = {str(notification.id) for notification in notifications}
+    missing_ids = [notification_id for notification_id in notification_ids if notification_id not in found_ids]
+    if missing_ids:
+        try:
+            self.retry(args=[missing_ids], queue=QueueNames.RETRY)
+        except self.MaxRetriesExceededError:
+            current_app.logger.error(
+                "RETRY FAILED: task create_letters_pdf_batch never found notifications {}, "
+                "handing them to create_letters_pdf".format(missing_ids)
+            )
+            for notification_id in missing_ids:
+                create_letters_pdf.apply_async([notification_id], queue=QueueNames.RETRY)
+
+
+def _build_letters(notifications):
+    """
+    Work out everything needed to render and upload each letter before any threads start, so that they don't
+    use the database session. Letters sharing a template version and organisation share one request template.
+    """
+    templates = {}
+    letters = []
+    for notification in notifications:
+        if notification.status != NOTIFICATION_CREATED:
+            current_app.logger.info("Letter notification {} is {}, not creating its PDF".format(
+                notification.id, notification.status))
+            continue
+
+        org_id = notification.service.dvla_organisation.id
+        key = (notification.template_id, notification.template_version, org_id)
+        if key not in templates:
+            templates[key] = {
+                'subject': notification.template.subject,
+                'content': notification.template.content,
+            }
+        letters.append({
+            'id': str(notification.id),
+            'reference': notification.reference,
+            'crown': notification.service.crown,
+            'data': {
+                'letter_contact_block': notification.reply_to_text,
+                'template': templates[key],
+                'values': notification.personalisation,
+                'dvla_org_id': org_id,
+            },
+        })
+    return letters
+
+
+def _create_letter_pdf(letter):
+    upload_file_name = get_letter_pdf_filename(letter['reference'], letter['crown'])
+
+    cache_key = None
+    if current_app.config['LETTERS_PDF_CACHE_ENABLED']:
+        cache_key = get_letter_pdf_cache_key(letter['data'])
+        billable_units = copy_cached_letter_pdf(cache_key, upload_file_name)
+        if billable_units is not None:
+            current_app.logger.info("Copied cached letters PDF {} for notification id {}".format(
+                upload_file_name, letter['id']))
+            return billable_units
+
+    pdf_data, billable_units = render_letters_pdf(letter['data'])
+
+    s3.s3upload(
+        filedata=pdf_data,
+        region=current_app.config['AWS_REGION'],
+        bucket_name=current_app.config['LETTERS_PDF_BUCKET_NAME'],
+        file_location=upload_file_name
+    )
+    record_letter_pdf_location(upload_file_name)
+    current_app.logger.info("Uploaded letters PDF {} for notification id {}, billable units {}".format(
+        upload_file_name, letter['id'], billable_units))
+
+    if cache_key:
+        cache_letter_pdf(cache_key, upload_file_name, billable_units)
+    return billable_units
 
 
 def get_letters_pdf(template, contact_block, org_id, values):
+    return render_letters_pdf(get_letters_pdf_data(template, contact_block, org_id, values))
+
+
+def get_letters_pdf_data(template, contact_block, org_id, values):
     template_for_letter_print = {
         "subject": template.subject,
         "content": template.content
     }
 
-    data = {
+    return {
         'letter_contact_block': contact_block,
         'template': template_for_letter_print,
         'values': values,
         'dvla_org_id': org_id,
     }
-    resp = requests_post(
+
+
+def render_letters_pdf(data):
+    resp = get_template_preview_session().post(
         '{}/print.pdf'.format(
             current_app.config['TEMPLATE_PREVIEW_API_HOST']
         ),
@@ -100,67 +253,155 @@ def get_letters_pdf(template, contact_block, org_id, values):
     return resp.content, billable_units
 
 
+_template_preview_session = {'session': None}
+_template_preview_session_lock = threading.Lock()
+
+
+def get_template_preview_session():
+    """
+    Keep connections to template preview open between letters, so that PDFs rendered by a batch, or one after
+    another by a worker, don't each open a new one. Created on first use, as most processes never make a PDF.
+    """
+    with _template_preview_session_lock:
+        if _template_preview_session['session'] is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=current_app.config['CREATE_LETTERS_PDF_MAX_CONCURRENT_REQUESTS']
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _template_preview_session['session'] = session
+    return _template_preview_session['session']
+
+
 @notify_celery.task(name='collate-letter-pdfs-for-day')
 def collate_letter_pdfs_for_day(date):
-    letter_pdfs = s3.get_s3_bucket_objects(
+    letter_pdfs = s3.iter_s3_bucket_objects(
         current_app.config['LETTERS_PDF_BUCKET_NAME'],
         subfolder=date
     )
-    for letters in group_letters(letter_pdfs):
-        filenames = [letter['Key'] for letter in letters]
-        current_app.logger.info(
-            'Calling task zip-and-send-letter-pdfs for {} pdfs of total size {:,} bytes'.format(
-                len(filenames),
-                sum(letter['Size'] for letter in letters)
+    with notify_celery.batch_publishing():
+        for letters in group_letters(letter_pdfs):
+            filenames = [letter['Key'] for letter in letters]
+            current_app.logger.info(
+                'Calling task zip-and-send-letter-pdfs for {} pdfs of total size {:,} bytes'.format(
+                    len(filenames),
+                    sum(letter['Size'] for letter in letters)
+                )
+            )
+            if current_app.config['LETTER_ZIP_MANIFESTS_ENABLED']:
+                kwargs = {'manifest': upload_letter_zip_manifest(date, filenames)}
+            else:
+                kwargs = {'filenames_to_zip': filenames}
+            notify_celery.publish_by_name(
+                TaskNames.ZIP_AND_SEND_LETTER_PDFS,
+                kwargs=kwargs,
+                queue=QueueNames.PROCESS_FTP,
+                compression='zlib'
             )
-        )
-        notify_celery.send_task(
-            name=TaskNames.ZIP_AND_SEND_LETTER_PDFS,
-            kwargs={'filenames_to_zip': filenames},
-            queue=QueueNames.PROCESS_FTP,
-            compression='zlib'
-        )
+
+    # the count kept as letters were made is what triggered this, so check it against the database once a day
+    letters_counted = get_letters_to_process_count(date)
+    if letters_counted is not None:
+        letters_to_process = dao_get_count_of_letters_to_process_for_date(datetime.strptime(date, '%Y-%m-%d').date())
+        if letters_counted != letters_to_process:
+            current_app.logger.warning('{} letters were counted for {} but there are {} in the database'.format(
+                letters_counted, date, letters_to_process
+            ))
+
+
+def upload_letter_zip_manifest(date, filenames):
+    """
+    Put the list of letters for one zip next to them in the letters PDF bucket, so the task only has to say where
+    it is. Returns its bucket and key.
+    """
+    manifest = {
+        'bucket': current_app.config['LETTERS_PDF_BUCKET_NAME'],
+        'key': 'manifests/{}/{}.json'.format(date, uuid.uuid4()),
+    }
+    s3.s3upload(
+        filedata=json.dumps({'filenames_to_zip': filenames}),
+        region=current_app.config['AWS_REGION'],
+        bucket_name=manifest['bucket'],
+        file_location=manifest['key'],
+        content_type='application/json'
+    )
+    return manifest
 
 
 def group_letters(letter_pdfs):
     """
-    Group letters in chunks of MAX_LETTER_PDF_ZIP_FILESIZE. Will add files to lists, never going over that size.
+    Group letters in chunks of MAX_LETTER_PDF_ZIP_FILESIZE and MAX_LETTER_PDF_COUNT_PER_ZIP, never going over either,
+    as letter_pdfs is read. Up to LETTER_ZIP_OPEN_GROUPS chunks are filled at once: each letter goes in the first one
+    it fits in, and when a letter doesn't fit in any of them the fullest is yielded to make room. A chunk is also
+    yielded as soon as it's full.
     If a single file is (somehow) larger than MAX_LETTER_PDF_ZIP_FILESIZE that'll be in a list on it's own.
     If there are no files, will just exit (rather than yielding an empty list).
     """
-    running_filesize = 0
-    list_of_files = []
-    for letter in letter_pdfs:
-        if letter['Key'].lower().endswith('.pdf') and letter_in_created_state(letter['Key']):
-            if (
-                running_filesize + letter['Size'] > current_app.config['MAX_LETTER_PDF_ZIP_FILESIZE'] or
-                len(list_of_files) >= current_app.config['MAX_LETTER_PDF_COUNT_PER_ZIP']
-            ):
-                yield list_of_files
-                running_filesize = 0
-                list_of_files = []
-
-            running_filesize += letter['Size']
-            list_of_files.append(letter)
-
-    if list_of_files:
-        yield list_of_files
-
-
-def letter_in_created_state(filename):
-    # filename looks like '2018-01-13/NOTIFY.ABCDEF1234567890.D.2.C.C.20180113120000.PDF'
-    subfolder = filename.split('/')[0]
-    ref = get_reference_from_filename(filename)
-    notifications = dao_get_notifications_by_references([ref])
-    if notifications:
-        if notifications[0].status == NOTIFICATION_CREATED:
-            return True
-        current_app.logger.info('Collating letters for {} but notification with reference {} already in {}'.format(
-            subfolder,
-            ref,
-            notifications[0].status
-        ))
-    return False
+    max_filesize = current_app.config['MAX_LETTER_PDF_ZIP_FILESIZE']
+    max_count = current_app.config['MAX_LETTER_PDF_COUNT_PER_ZIP']
+    max_open_groups = current_app.config['LETTER_ZIP_OPEN_GROUPS']
+
+    open_groups = []
+    for letter in _letters_to_send(letter_pdfs):
+        group = next((
+            group for group in open_groups if group['filesize'] + letter['Size'] <= max_filesize
+        ), None)
+        if group is None:
+            if len(open_groups) >= max_open_groups:
+                fullest_group = max(open_groups, key=lambda group: group['filesize'])
+                open_groups.remove(fullest_group)
+                yield fullest_group['letters']
+            group = {'filesize': 0, 'letters': []}
+            open_groups.append(group)
+
+        group['filesize'] += letter['Size']
+        group['letters'].append(letter)
+        if group['filesize'] >= max_filesize or len(group['letters']) >= max_count:
+            open_groups.remove(group)
+            yield group['letters']
+
+    for group in open_groups:
+        yield group['letters']
+
+
+def _letters_to_send(letter_pdfs):
+    letter_pdfs = (letter for letter in letter_pdfs if letter['Key'].lower().endswith('.pdf'))
+    while True:
+        batch = list(islice(letter_pdfs, current_app.config['LETTER_STATUS_LOOKUP_BATCH_SIZE']))
+        if not batch:
+            return
+        filenames_to_send = letters_in_created_state([letter['Key'] for letter in batch])
+        for letter in batch:
+            if letter['Key'] in filenames_to_send:
+                yield letter
+
+
+def letters_in_created_state(filenames):
+    """
+    The filenames whose notifications are still in created. The statuses are looked up in batches of
+    LETTER_STATUS_LOOKUP_BATCH_SIZE rather than one query per letter.
+    """
+    # filenames look like '2018-01-13/NOTIFY.ABCDEF1234567890.D.2.C.C.20180113120000.PDF'
+    references = {filename: get_reference_from_filename(filename) for filename in filenames}
+    statuses = dao_get_notification_statuses_by_references(
+        set(references.values()),
+        current_app.config['LETTER_STATUS_LOOKUP_BATCH_SIZE']
+    )
+
+    in_created_state = set()
+    for filename, ref in references.items():
+        status = statuses.get(ref)
+        if status == NOTIFICATION_CREATED:
+            in_created_state.add(filename)
+        elif status:
+            current_app.logger.info('Collating letters for {} but notification with reference {} already in {}'.format(
+                filename.split('/')[0],
+                ref,
+                status
+            ))
+    return in_created_state
 
 
 @notify_celery.task(name='process-virus-scan-passed')
@@ -178,6 +419,8 @@ def process_virus_scan_passed(filename):
         reference,
         NOTIFICATION_DELIVERED if is_test_key else NOTIFICATION_CREATED
     )
+    # precompiled letters are only waiting to be printed once they've been scanned
+    increment_letters_to_process(notification)
 
 
 @notify_celery.task(name='process-virus-scan-failed')
@@ -239,14 +482,54 @@ def replay_letters_in_error(filename=None):
             queue=QueueNames.ANTIVIRUS,
         )
     else:
-        error_files = get_file_names_from_error_bucket()
-        for item in error_files:
-            moved_file_name = item.key.split('/')[1]
-            current_app.logger.info("Calling scan_file for: {}".format(moved_file_name))
-            move_error_pdf_to_scan_bucket(moved_file_name)
-            # call task to add the filename to anti virus queue
-            notify_celery.send_task(
-                name=TaskNames.SCAN_FILE,
-                kwargs={'filename': moved_file_name},
-                queue=QueueNames.ANTIVIRUS,
-            )
+        # A letter is only removed from ERROR once it's been copied back, so if this stops part way through it can
+        # be run again to replay the rest
+        filenames = [item.key.split('/', 1)[1] for item in get_file_names_from_error_bucket()]
+        filenames = [filename for filename in filenames if filename]
+        batch_size = current_app.config['REPLAY_LETTERS_IN_ERROR_BATCH_SIZE']
+
+        replayed = 0
+        for i in range(0, len(filenames), batch_size):
+            moved_file_names = _move_error_pdfs_to_scan_bucket(filenames[i:i + batch_size])
+            with notify_celery.batch_publishing():
+                for moved_file_name in moved_file_names:
+                    # call task to add the filename to anti virus queue
+                    notify_celery.publish_by_name(
+                        TaskNames.SCAN_FILE,
+                        kwargs={'filename': moved_file_name},
+                        queue=QueueNames.ANTIVIRUS,
+                    )
+            replayed += len(moved_file_names)
+            current_app.logger.info("Replayed {} of {} letters in error".format(replayed, len(filenames)))
+
+
+def _move_error_pdfs_to_scan_bucket(filenames):
+    """
+    Copy the letters back from ERROR concurrently, then delete the ones that were copied in bulk. Returns the
+    filenames that were moved.
+
+    A letter that can't be deleted from ERROR isn't returned, so it isn't scanned. The next replay copies it
+    again and scans it then, so it's only scanned once.
+    """
+    scan_bucket = current_app.config['LETTERS_SCAN_BUCKET_NAME']
+    results = send_concurrently(
+        lambda filename: s3.copy_s3_object(scan_bucket, 'ERROR/' + filename, scan_bucket, filename),
+        filenames,
+        max_workers=current_app.config['S3_MAX_POOL_CONNECTIONS']
+    )
+
+    copied = []
+    for filename, (_, exception) in zip(filenames, results):
+        if exception is None:
+            copied.append(filename)
+        else:
+            current_app.logger.error("Failed to move letter PDF ERROR/{} back to scan: {}".format(filename, exception))
+
+    not_deleted = s3.delete_s3_objects(scan_bucket, ['ERROR/' + filename for filename in copied])
+    if not_deleted:
+        not_deleted = s3.delete_s3_objects(scan_bucket, not_deleted)
+    if not_deleted:
+        current_app.logger.error("Failed to delete {} letter PDFs from ERROR, they'll be replayed next time: {}".format(
+            len(not_deleted), not_deleted))
+
+    return [filename for filename in copied if 'ERROR/' + filename not in not_deleted]
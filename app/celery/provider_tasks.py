@@ -58,3 +58,56 @@ def deliver_email(self, notification_id):
                       "Notification has been updated to technical-failure".format(notification_id)
             update_notification_status_by_id(notification_id, NOTIFICATION_TECHNICAL_FAILURE)
             raise NotificationTechnicalFailureException(message)
+
+
+@notify_celery.task(bind=True, name="deliver-sms-batch")
+@statsd(namespace="tasks")
+def deliver_sms_batch(self, notification_ids):
+    """
+    Send up to DELIVER_SMS_BATCH_SIZE created SMS notifications in one task, and queue any more as another batch.
+    Anything that can't be sent, or has gone missing, is handed to deliver_sms so that retries stay per
+    notification.
+    """
+    batch_size = current_app.config['DELIVER_SMS_BATCH_SIZE']
+    if len(notification_ids) > batch_size:
+        deliver_sms_batch.apply_async([notification_ids[batch_size:]], queue=QueueNames.SEND_SMS)
+        notification_ids = notification_ids[:batch_size]
+    current_app.logger.info("Start sending batch of {} SMS".format(len(notification_ids)))
+
+    notifications = notifications_dao.dao_get_notifications_by_ids(notification_ids)
+    failed = send_to_providers.send_sms_batch_to_provider(notifications)
+
+    for notification_id in _ids_to_retry(notification_ids, notifications, failed):
+        deliver_sms.apply_async(
+            [notification_id], queue=QueueNames.RETRY, countdown=deliver_sms.default_retry_delay
+        )
+
+
+@notify_celery.task(bind=True, name="deliver-email-batch")
+@statsd(namespace="tasks")
+def deliver_email_batch(self, notification_ids):
+    """
+    Send up to DELIVER_EMAIL_BATCH_SIZE created email notifications in one task, and queue any more as another
+    batch. Anything that can't be sent, or has gone missing, is handed to deliver_email so that retries stay per
+    notification.
+    """
+    batch_size = current_app.config['DELIVER_EMAIL_BATCH_SIZE']
+    if len(notification_ids) > batch_size:
+        deliver_email_batch.apply_async([notification_ids[batch_size:]], queue=QueueNames.SEND_EMAIL)
+        notification_ids = notification_ids[:batch_size]
+    current_app.logger.info("Start sending batch of {} emails".format(len(notification_ids)))
+
+    notifications = notifications_dao.dao_get_notifications_by_ids(notification_ids)
+    failed = send_to_providers.send_email_batch_to_provider(notifications)
+
+    for notification_id in _ids_to_retry(notification_ids, notifications, failed):
+        deliver_email.apply_async(
+            [notification_id], queue=QueueNames.RETRY, countdown=deliver_email.default_retry_delay
+        )
+
+
+def _ids_to_retry(notification_ids, notifications, failed):
+    found_ids = {str(notification.id) for notification in notifications}
+    return [str(notification.id) for notification in failed] + [
+        str(notification_id) for notification_id in notification_ids if str(notification_id) not in found_ids
+    ]
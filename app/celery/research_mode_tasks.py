@@ -5,10 +5,8 @@ import json
 from flask import current_app
 from requests import request, RequestException, HTTPError
 
-from notifications_utils.s3 import s3upload
-
 from app import notify_celery
-from app.aws.s3 import file_exists
+from app.aws.s3 import file_exists, s3upload
 from app.models import SMS_TYPE
 from app.config import QueueNames
 from app.celery.process_ses_receipts_tasks import process_ses_results
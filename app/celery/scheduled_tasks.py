@@ -10,18 +10,24 @@ from notifications_utils.statsd_decorators import statsd
 from sqlalchemy import and_, func
 from sqlalchemy.exc import SQLAlchemyError
 
-from app import notify_celery
+from app import db, notify_celery, statsd_client
 from app import performance_platform_client, zendesk_client
 from app.aws import s3
+from app.celery.provider_tasks import deliver_email_batch, deliver_sms_batch
 from app.celery.service_callback_tasks import (
     send_delivery_status_to_service,
     create_delivery_status_callback_data,
 )
-from app.celery.tasks import process_job
+from app.celery.tasks import process_job, record_letter_ack_file
 from app.config import QueueNames, TaskNames
 from app.dao.inbound_sms_dao import delete_inbound_sms_created_more_than_a_week_ago
 from app.dao.invited_org_user_dao import delete_org_invitations_created_more_than_two_days_ago
 from app.dao.invited_user_dao import delete_invitations_created_more_than_two_days_ago
+from app.dao.letter_ack_dao import (
+    dao_get_acked_zip_file_names,
+    dao_get_recorded_ack_file_names,
+    dao_get_zip_file_names_in_ack_files_for_day,
+)
 from app.dao.jobs_dao import (
     dao_get_letter_job_ids_by_status,
     dao_set_scheduled_jobs_to_pending,
@@ -30,11 +36,12 @@ from app.dao.jobs_dao import (
 from app.dao.jobs_dao import dao_update_job
 from app.dao.notifications_dao import (
     dao_timeout_notifications,
-    is_delivery_slow_for_provider,
+    dao_get_notifications_by_ids,
     delete_notifications_created_more_than_a_week_ago_by_type,
     dao_get_count_of_letters_to_process_for_date,
-    dao_get_scheduled_notifications,
-    set_scheduled_notification_to_processed,
+    dao_get_delivery_counts_for_provider,
+    dao_lock_scheduled_notifications_to_send,
+    set_scheduled_notifications_to_processed,
     notifications_not_yet_sent
 )
 from app.dao.provider_details_dao import (
@@ -48,6 +55,7 @@ from app.dao.services_dao import (
 from app.dao.stats_template_usage_by_month_dao import insert_or_update_stats_for_template
 from app.dao.users_dao import delete_codes_older_created_more_than_a_day_ago
 from app.exceptions import NotificationTechnicalFailureException
+from app.letters.utils import get_letters_to_process_count
 from app.models import (
     Job,
     Notification,
@@ -58,10 +66,11 @@ from app.models import (
     JOB_STATUS_ERROR,
     SMS_TYPE,
     EMAIL_TYPE,
-    KEY_TYPE_NORMAL
+    KEY_TYPE_NORMAL,
+    KEY_TYPE_TEST
 )
-from app.notifications.process_notifications import send_notification_to_queue
 from app.performance_platform import total_sent_notifications, processing_time
+from app.provider_details.delivery_latency import get_delivery_latency_percentiles
 from app.v2.errors import JobIncompleteError
 
 
@@ -90,17 +99,54 @@ def run_scheduled_jobs():
 @statsd(namespace="tasks")
 def send_scheduled_notifications():
     try:
-        scheduled_notifications = dao_get_scheduled_notifications()
-        for notification in scheduled_notifications:
-            send_notification_to_queue(notification, notification.service.research_mode)
-            set_scheduled_notification_to_processed(notification.id)
+        batch_size = current_app.config['SEND_SCHEDULED_NOTIFICATIONS_BATCH_SIZE']
+        sent = 0
+        while True:
+            scheduled_notifications = dao_lock_scheduled_notifications_to_send(batch_size)
+            if not scheduled_notifications:
+                db.session.commit()
+                break
+
+            with notify_celery.batch_publishing():
+                for deliver_batch_task, queue, notification_ids in _delivery_batches(scheduled_notifications):
+                    _publish_delivery_batch(deliver_batch_task, notification_ids, queue, 'send-scheduled-notifications')
+            # commits, releasing the locks taken on the batch
+            set_scheduled_notifications_to_processed([n.id for n in scheduled_notifications])
+            sent += len(scheduled_notifications)
+
         current_app.logger.info(
-            "Sent {} scheduled notifications to the provider queue".format(len(scheduled_notifications)))
+            "Sent {} scheduled notifications to the provider queue".format(sent))
     except SQLAlchemyError:
         current_app.logger.exception("Failed to send scheduled notifications")
         raise
 
 
+def _delivery_batches(notifications):
+    batches = {}
+    for n in notifications:
+        if n.research_mode or n.key_type == KEY_TYPE_TEST:
+            queue = QueueNames.RESEARCH_MODE
+        else:
+            queue = _delivery_batch_settings(n.notification_type)[1]
+        batches.setdefault((n.notification_type, queue), []).append(str(n.id))
+
+    for (notification_type, queue), notification_ids in batches.items():
+        deliver_batch_task, _, batch_size = _delivery_batch_settings(notification_type)
+        for i in range(0, len(notification_ids), batch_size):
+            yield deliver_batch_task, queue, notification_ids[i:i + batch_size]
+
+
+def _delivery_batch_settings(notification_type):
+    if notification_type == SMS_TYPE:
+        return deliver_sms_batch, QueueNames.SEND_SMS, current_app.config['DELIVER_SMS_BATCH_SIZE']
+    return deliver_email_batch, QueueNames.SEND_EMAIL, current_app.config['DELIVER_EMAIL_BATCH_SIZE']
+
+
+def _publish_delivery_batch(deliver_batch_task, notification_ids, queue, metric):
+    notify_celery.publish(deliver_batch_task, [notification_ids], queue=queue)
+    statsd_client.incr('tasks.{}.{}'.format(metric, queue), count=len(notification_ids))
+
+
 @notify_celery.task(name="delete-verify-codes")
 @statsd(namespace="tasks")
 def delete_verify_codes():
@@ -190,27 +236,49 @@ def delete_invitations():
 @notify_celery.task(name='timeout-sending-notifications')
 @statsd(namespace="tasks")
 def timeout_notifications():
-    technical_failure_notifications, temporary_failure_notifications = \
-        dao_timeout_notifications(current_app.config.get('SENDING_NOTIFICATIONS_TIMEOUT_PERIOD'))
-
-    notifications = technical_failure_notifications + temporary_failure_notifications
-    for notification in notifications:
-        # queue callback task only if the service_callback_api exists
-        service_callback_api = get_service_delivery_status_callback_api_for_service(service_id=notification.service_id)
-        if service_callback_api:
-            encrypted_notification = create_delivery_status_callback_data(notification, service_callback_api)
-            send_delivery_status_to_service.apply_async([str(notification.id), encrypted_notification],
-                                                        queue=QueueNames.CALLBACKS)
+    timeout_period = current_app.config.get('SENDING_NOTIFICATIONS_TIMEOUT_PERIOD')
+    batch_size = current_app.config.get('TIMEOUT_NOTIFICATIONS_BATCH_SIZE')
+    service_callback_apis = {}
+    technical_failure_ids = []
+    total = 0
+
+    while True:
+        technical_failure_notifications, temporary_failure_notifications = \
+            dao_timeout_notifications(timeout_period, batch_size)
+        notifications = technical_failure_notifications + temporary_failure_notifications
+        if not notifications:
+            break
+
+        _send_timeout_status_updates_to_services(notifications, service_callback_apis)
+        technical_failure_ids.extend(str(x.id) for x in technical_failure_notifications)
+        total += len(notifications)
 
     current_app.logger.info(
-        "Timeout period reached for {} notifications, status has been updated.".format(len(notifications)))
-    if technical_failure_notifications:
+        "Timeout period reached for {} notifications, status has been updated.".format(total))
+    if technical_failure_ids:
         message = "{} notifications have been updated to technical-failure because they " \
                   "have timed out and are still in created.Notification ids: {}".format(
-                      len(technical_failure_notifications), [str(x.id) for x in technical_failure_notifications])
+                      len(technical_failure_ids), technical_failure_ids)
         raise NotificationTechnicalFailureException(message)
 
 
+def _send_timeout_status_updates_to_services(timed_out, service_callback_apis):
+    # look up each service's callback api once per run, and only load the notifications that need one
+    for service_id in {x.service_id for x in timed_out} - service_callback_apis.keys():
+        service_callback_apis[service_id] = get_service_delivery_status_callback_api_for_service(service_id=service_id)
+
+    notification_ids = [x.id for x in timed_out if service_callback_apis[x.service_id]]
+    if not notification_ids:
+        return
+
+    with notify_celery.batch_publishing():
+        for notification in dao_get_notifications_by_ids(notification_ids):
+            service_callback_api = service_callback_apis[notification.service_id]
+            encrypted_notification = create_delivery_status_callback_data(notification, service_callback_api)
+            notify_celery.publish(send_delivery_status_to_service, [str(notification.id), encrypted_notification],
+                                  queue=QueueNames.CALLBACKS)
+
+
 @notify_celery.task(name='send-daily-performance-platform-stats')
 @statsd(namespace="tasks")
 def send_daily_performance_platform_stats():
@@ -255,31 +323,38 @@ def send_total_sent_notifications_to_performance_platform(day):
 @statsd(namespace="tasks")
 def switch_current_sms_provider_on_slow_delivery():
     """
-    Switch providers if there are at least two slow delivery notifications (more than four minutes)
-    in the last ten minutes. Search from the time we last switched to the current provider.
+    Switch providers if the current provider's deliveries have been slow over the last ten minutes, going by
+    the delivery receipts it has sent back since we last switched to it.
     """
-    functional_test_provider_service_id = current_app.config.get('FUNCTIONAL_TEST_PROVIDER_SERVICE_ID')
-    functional_test_provider_template_id = current_app.config.get('FUNCTIONAL_TEST_PROVIDER_SMS_TEMPLATE_ID')
-
-    if functional_test_provider_service_id and functional_test_provider_template_id:
-        current_provider = get_current_provider('sms')
-        slow_delivery_notifications = is_delivery_slow_for_provider(
-            provider=current_provider.identifier,
-            threshold=2,
-            sent_at=max(datetime.utcnow() - timedelta(minutes=10), current_provider.updated_at),
-            delivery_time=timedelta(minutes=4),
-            service_id=functional_test_provider_service_id,
-            template_id=functional_test_provider_template_id
+    current_provider = get_current_provider('sms')
+    since = max(datetime.utcnow() - timedelta(minutes=10), current_provider.updated_at)
+    percentile = current_app.config['SLOW_DELIVERY_PERCENTILE']
+    threshold = current_app.config['SLOW_DELIVERY_THRESHOLD_SECONDS']
+
+    if current_app.config['REDIS_ENABLED']:
+        latency = get_delivery_latency_percentiles(current_provider.identifier, since=since, percentiles=(percentile,))
+        receipts = latency['count']
+        slow = bool(receipts) and latency['p{}'.format(percentile)] >= threshold
+    else:
+        # without redis there are no latency histograms, so count the slow deliveries in the notifications table
+        receipts, slow_receipts = dao_get_delivery_counts_for_provider(
+            current_provider.identifier,
+            sent_at=since,
+            delivery_time=timedelta(seconds=threshold)
         )
-
-        if slow_delivery_notifications:
-            current_app.logger.warning(
-                'Slow delivery notifications detected for provider {}'.format(
-                    current_provider.identifier
-                )
+        slow = slow_receipts > receipts * (100 - percentile) / 100
+
+    if receipts >= current_app.config['SLOW_DELIVERY_MIN_RECEIPTS'] and slow:
+        current_app.logger.warning(
+            'Slow delivery notifications detected for provider {}: p{} of {} receipts is at least {} seconds'.format(
+                current_provider.identifier,
+                percentile,
+                receipts,
+                threshold
             )
+        )
 
-            dao_toggle_sms_provider(current_provider.identifier)
+        dao_toggle_sms_provider(current_provider.identifier)
 
 
 @notify_celery.task(name="delete-inbound-sms")
@@ -388,7 +463,10 @@ def run_letter_jobs():
 @notify_celery.task(name="trigger-letter-pdfs-for-day")
 @statsd(namespace="tasks")
 def trigger_letter_pdfs_for_day():
-    letter_pdfs_count = dao_get_count_of_letters_to_process_for_date()
+    letter_pdfs_count = get_letters_to_process_count(date.today())
+    if not letter_pdfs_count:
+        # there's no count kept, or it says there aren't any letters, so make sure in the database
+        letter_pdfs_count = dao_get_count_of_letters_to_process_for_date()
     if letter_pdfs_count:
         notify_celery.send_task(
             name='collate-letter-pdfs-for-day',
@@ -466,24 +544,14 @@ def letter_raise_alert_if_no_ack_file_for_zip():
         subname = key.split('/')[-1]    # strip subfolder in name
         zip_file_set.add(subname.upper().rstrip('.TXT'))
 
-    # get acknowledgement file
-    ack_file_set = set()
-
-    yesterday = datetime.now(tz=pytz.utc) - timedelta(days=1)   # AWS datetime format
-
-    for key in s3.get_list_of_files_by_suffix(bucket_name=current_app.config['DVLA_RESPONSE_BUCKET_NAME'],
-                                              subfolder='root/dispatch', suffix='.ACK.txt', last_modified=yesterday):
-        ack_file_set.add(key)
-
-    today_str = datetime.utcnow().strftime('%Y%m%d')
+    # strip empty element before comparison
+    zip_file_set.discard('')
 
-    ack_content_set = set()
-    for key in ack_file_set:
-        if today_str in key:
-            content = s3.get_s3_file(current_app.config['DVLA_RESPONSE_BUCKET_NAME'], key)
-            for zip_file in content.split('\n'):    # each line
-                s = zip_file.split('|')
-                ack_content_set.add(s[0].upper())
+    # ack files are recorded as DVLA send them, so they only need to be read here if one has been missed
+    acked_zip_file_set = dao_get_acked_zip_file_names(zip_file_set)
+    if zip_file_set - acked_zip_file_set:
+        _record_ack_files_not_yet_recorded()
+        acked_zip_file_set = dao_get_acked_zip_file_names(zip_file_set)
 
     message = (
         "Letter ack file does not contain all zip files sent. "
@@ -491,16 +559,13 @@ def letter_raise_alert_if_no_ack_file_for_zip():
         "pdf bucket: {}, subfolder: {}, "
         "ack bucket: {}"
     ).format(
-        str(sorted(zip_file_set - ack_content_set)),
+        str(sorted(zip_file_set - acked_zip_file_set)),
         current_app.config['LETTERS_PDF_BUCKET_NAME'],
         datetime.utcnow().strftime('%Y-%m-%d') + '/zips_sent',
         current_app.config['DVLA_RESPONSE_BUCKET_NAME']
     )
-    # strip empty element before comparison
-    ack_content_set.discard('')
-    zip_file_set.discard('')
 
-    if len(zip_file_set - ack_content_set) > 0:
+    if len(zip_file_set - acked_zip_file_set) > 0:
         if current_app.config['NOTIFY_ENVIRONMENT'] in ['live', 'production', 'test']:
             zendesk_client.create_ticket(
                 subject="Letter acknowledge error",
@@ -509,26 +574,64 @@ def letter_raise_alert_if_no_ack_file_for_zip():
             )
         current_app.logger.error(message)
 
-    if len(ack_content_set - zip_file_set) > 0:
+    acked_today = dao_get_zip_file_names_in_ack_files_for_day(datetime.utcnow().strftime('%Y%m%d'))
+    if len(acked_today - zip_file_set) > 0:
         current_app.logger.info(
-            "letter ack contains zip that is not for today: {}".format(ack_content_set - zip_file_set)
+            "letter ack contains zip that is not for today: {}".format(acked_today - zip_file_set)
         )
 
 
+def _record_ack_files_not_yet_recorded():
+    yesterday = datetime.now(tz=pytz.utc) - timedelta(days=1)   # AWS datetime format
+    today_str = datetime.utcnow().strftime('%Y%m%d')
+
+    ack_file_set = {
+        key for key in s3.get_list_of_files_by_suffix(bucket_name=current_app.config['DVLA_RESPONSE_BUCKET_NAME'],
+                                                      subfolder='root/dispatch', suffix='.ACK.txt',
+                                                      last_modified=yesterday)
+        if today_str in key
+    }
+
+    for key in ack_file_set - dao_get_recorded_ack_file_names(ack_file_set):
+        current_app.logger.info('Recording letter ack file {} that was not recorded when received'.format(key))
+        record_letter_ack_file(key)
+
+
 @notify_celery.task(name='replay-created-notifications')
 @statsd(namespace="tasks")
 def replay_created_notifications():
     # if the notification has not be send after 4 hours + 15 minutes, then try to resend.
     resend_created_notifications_older_than = (60 * 60 * 4) + (60 * 15)
-    for notification_type in (EMAIL_TYPE, SMS_TYPE):
-        notifications_to_resend = notifications_not_yet_sent(
-            resend_created_notifications_older_than,
-            notification_type
-        )
+    limit = current_app.config['REPLAY_CREATED_NOTIFICATIONS_LIMIT']
 
-        current_app.logger.info("Sending {} {} notifications "
+    for notification_type in (EMAIL_TYPE, SMS_TYPE):
+        deliver_batch_task, queue, batch_size = _delivery_batch_settings(notification_type)
+        batches = {queue: [], QueueNames.RESEARCH_MODE: []}
+        replayed = 0
+
+        with notify_celery.batch_publishing():
+            for n in notifications_not_yet_sent(resend_created_notifications_older_than, notification_type, limit):
+                research_mode = n.research_mode or n.key_type == KEY_TYPE_TEST
+                batch_queue = QueueNames.RESEARCH_MODE if research_mode else queue
+                batches[batch_queue].append(str(n.id))
+                if len(batches[batch_queue]) >= batch_size:
+                    _publish_delivery_batch(
+                        deliver_batch_task, batches[batch_queue], batch_queue, 'replay-created-notifications'
+                    )
+                    replayed += len(batches[batch_queue])
+                    batches[batch_queue] = []
+
+            for batch_queue, batch in batches.items():
+                if batch:
+                    _publish_delivery_batch(deliver_batch_task, batch, batch_queue, 'replay-created-notifications')
+                    replayed += len(batch)
+
+        current_app.logger.info("Sent {} {} notifications "
                                 "to the delivery queue because the notification "
-                                "status was created.".format(len(notifications_to_resend), notification_type))
-
-        for n in notifications_to_resend:
-            send_notification_to_queue(notification=n, research_mode=n.service.research_mode)
+                                "status was created.".format(replayed, notification_type))
+        if replayed == limit:
+            current_app.logger.warning(
+                "Replayed the limit of {} {} notifications, the rest will be replayed on the next run".format(
+                    limit, notification_type
+                )
+            )
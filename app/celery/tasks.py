@@ -17,7 +17,6 @@ from requests import (
     RequestException
 )
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm.exc import NoResultFound
 
 from app import (
     create_uuid,
@@ -31,6 +30,7 @@ from app.celery import provider_tasks, letters_pdf_tasks, research_mode_tasks
 from app.config import QueueNames
 from app.dao.daily_sorted_letter_dao import dao_create_or_update_daily_sorted_letter
 from app.dao.inbound_sms_dao import dao_get_inbound_sms_by_id
+from app.dao.letter_ack_dao import dao_record_letter_acks
 from app.dao.jobs_dao import (
     dao_update_job,
     dao_get_job_by_id,
@@ -41,8 +41,8 @@ from app.dao.notifications_dao import (
     dao_update_notifications_by_reference,
     dao_get_last_notification_added_for_job_id,
     update_notification_status_by_reference,
-    dao_get_notification_history_by_reference,
-    dao_get_notification_by_reference,
+    dao_get_billable_units_by_references,
+    dao_update_letter_notifications_by_reference,
 )
 from app.dao.provider_details_dao import get_current_provider
 from app.dao.service_inbound_api_dao import get_service_inbound_api_for_service
@@ -104,12 +104,17 @@ def process_job(job_id):
 
     current_app.logger.debug("Starting job {} processing {} notifications".format(job_id, job.notification_count))
 
-    for row in RecipientCSV(
+    with notify_celery.batch_publishing():
+        rows = RecipientCSV(
             s3.get_job_from_s3(str(service.id), str(job_id)),
             template_type=template.template_type,
             placeholders=template.placeholders
-    ).rows:
-        process_row(row, template, job, service)
+        ).rows
+        if template.template_type == LETTER_TYPE and not service.research_mode:
+            save_letters_from_job(rows, db_template, job, service)
+        else:
+            for row in rows:
+                process_row(row, template, job, service)
 
     job_complete(job, start=start)
 
@@ -150,7 +155,8 @@ def process_row(row, template, job, service):
 
     send_fn = send_fns[template_type]
 
-    send_fn.apply_async(
+    notify_celery.publish(
+        send_fn,
         (
             str(service.id),
             create_uuid(),
@@ -160,6 +166,45 @@ def process_row(row, template, job, service):
     )
 
 
+def save_letters_from_job(rows, db_template, job, service):
+    """
+    Letters from a job are saved here rather than by a save-letter task for each row, so they are all in the
+    database before the batches that create their PDFs are published. If saving one fails, batches are still
+    published for the letters saved before it, as a resumed job only picks up the rows after the last one saved.
+    """
+    notification_ids = []
+    try:
+        for row in rows:
+            notification_id = create_uuid()
+            _persist_letter(service, db_template, notification_id, {
+                'template': str(job.template_id),
+                'template_version': job.template_version,
+                'job': str(job.id),
+                'row_number': row.index,
+                'personalisation': dict(row.personalisation),
+            })
+            notification_ids.append(notification_id)
+    finally:
+        publish_letters_pdf_batches(notification_ids, service)
+
+
+def publish_letters_pdf_batches(notification_ids, service):
+    """
+    Letters from a job have their PDFs created CREATE_LETTERS_PDF_BATCH_SIZE at a time, rather than by a task
+    for each letter. Research mode letters never get a PDF.
+    """
+    if service.research_mode:
+        return
+
+    batch_size = current_app.config['CREATE_LETTERS_PDF_BATCH_SIZE']
+    for i in range(0, len(notification_ids), batch_size):
+        notify_celery.publish(
+            letters_pdf_tasks.create_letters_pdf_batch,
+            [notification_ids[i:i + batch_size]],
+            queue=QueueNames.CREATE_LETTERS_PDF
+        )
+
+
 def __sending_limits_for_job_exceeded(service, job, job_id):
     total_sent = fetch_todays_total_message_count(service.id)
 
@@ -210,7 +255,8 @@ def save_sms(self,
             reply_to_text=template.get_reply_to_text()
         )
 
-        provider_tasks.deliver_sms.apply_async(
+        notify_celery.publish(
+            provider_tasks.deliver_sms,
             [str(saved_notification.id)],
             queue=QueueNames.SEND_SMS if not service.research_mode else QueueNames.RESEARCH_MODE
         )
@@ -260,7 +306,8 @@ def save_email(self,
             reply_to_text=template.get_reply_to_text()
         )
 
-        provider_tasks.deliver_email.apply_async(
+        notify_celery.publish(
+            provider_tasks.deliver_email,
             [str(saved_notification.id)],
             queue=QueueNames.SEND_EMAIL if not service.research_mode else QueueNames.RESEARCH_MODE
         )
@@ -280,52 +327,51 @@ def save_letter(
 ):
     notification = encryption.decrypt(encrypted_notification)
 
-    # we store the recipient as just the first item of the person's address
-    recipient = notification['personalisation']['addressline1']
-
     service = dao_fetch_service_by_id(service_id)
     template = dao_get_template_by_id(notification['template'], version=notification['template_version'])
 
     try:
-        # if we don't want to actually send the letter, then start it off in SENDING so we don't pick it up
-        status = NOTIFICATION_CREATED if not service.research_mode else NOTIFICATION_SENDING
-
-        saved_notification = persist_notification(
-            template_id=notification['template'],
-            template_version=notification['template_version'],
-            recipient=recipient,
-            service=service,
-            personalisation=notification['personalisation'],
-            notification_type=LETTER_TYPE,
-            api_key_id=None,
-            key_type=KEY_TYPE_NORMAL,
-            created_at=datetime.utcnow(),
-            job_id=notification['job'],
-            job_row_number=notification['row_number'],
-            notification_id=notification_id,
-            reference=create_random_identifier(),
-            reply_to_text=template.get_reply_to_text(),
-            status=status
-        )
-
-        if not service.research_mode:
-            letters_pdf_tasks.create_letters_pdf.apply_async(
-                [str(saved_notification.id)],
-                queue=QueueNames.CREATE_LETTERS_PDF
-            )
-        elif current_app.config['NOTIFY_ENVIRONMENT'] in ['preview', 'development']:
-            research_mode_tasks.create_fake_letter_response_file.apply_async(
-                (saved_notification.reference,),
-                queue=QueueNames.RESEARCH_MODE
-            )
-        else:
-            update_notification_status_by_reference(saved_notification.reference, 'delivered')
+        saved_notification = _persist_letter(service, template, notification_id, notification)
+
+        # other letters are saved by process_job, which creates their PDFs in batches
+        if service.research_mode:
+            if current_app.config['NOTIFY_ENVIRONMENT'] in ['preview', 'development']:
+                research_mode_tasks.create_fake_letter_response_file.apply_async(
+                    (saved_notification.reference,),
+                    queue=QueueNames.RESEARCH_MODE
+                )
+            else:
+                update_notification_status_by_reference(saved_notification.reference, 'delivered')
 
         current_app.logger.debug("Letter {} created at {}".format(saved_notification.id, saved_notification.created_at))
     except SQLAlchemyError as e:
         handle_exception(self, notification, notification_id, e)
 
 
+def _persist_letter(service, template, notification_id, notification):
+    # if we don't want to actually send the letter, then start it off in SENDING so we don't pick it up
+    status = NOTIFICATION_CREATED if not service.research_mode else NOTIFICATION_SENDING
+
+    return persist_notification(
+        template_id=notification['template'],
+        template_version=notification['template_version'],
+        # we store the recipient as just the first item of the person's address
+        recipient=notification['personalisation']['addressline1'],
+        service=service,
+        personalisation=notification['personalisation'],
+        notification_type=LETTER_TYPE,
+        api_key_id=None,
+        key_type=KEY_TYPE_NORMAL,
+        created_at=datetime.utcnow(),
+        job_id=notification['job'],
+        job_row_number=notification['row_number'],
+        notification_id=notification_id,
+        reference=create_random_identifier(),
+        reply_to_text=template.get_reply_to_text(),
+        status=status
+    )
+
+
 @notify_celery.task(bind=True, name='update-letter-job-to-error')
 @statsd(namespace="tasks")
 def update_dvla_job_to_error(self, job_id):
@@ -409,10 +455,12 @@ def update_letter_notifications_statuses(self, filename):
     except TypeError:
         raise DVLAException('DVLA response file: {} has an invalid format'.format(filename))
     else:
-        temporary_failures = []
+        temporary_failures = [
+            update.reference for update in notification_updates if update.status != DVLA_RESPONSE_STATUS_SENT
+        ]
+        check_billable_units(notification_updates)
+        update_letter_notifications(filename, notification_updates)
         for update in notification_updates:
-            check_billable_units(update)
-            update_letter_notification(filename, temporary_failures, update)
             sorted_letter_counts[update.cost_threshold] += 1
 
         try:
@@ -436,6 +484,20 @@ def update_letter_notifications_statuses(self, filename):
                 raise DVLAException(message)
 
 
+@notify_celery.task(name='record-letter-ack-file')
+@statsd(namespace="tasks")
+def record_letter_ack_file(filename):
+    """
+    Record the zips DVLA acknowledge in an ack file, so the daily check for zips without an ack doesn't have to
+    download every ack file.
+    """
+    content = s3.get_s3_file(current_app.config['DVLA_RESPONSE_BUCKET_NAME'], filename)
+    # each line looks like 'NOTIFY.20180111175007.ZIP|20180111175733'
+    zip_file_names = {line.split('|')[0].upper() for line in content.split('\n')}
+    zip_file_names.discard('')
+    dao_record_letter_acks(filename, sorted(zip_file_names))
+
+
 def get_billing_date_in_bst_from_filename(filename):
     datetime_string = filename.split('-')[1]
     datetime_obj = datetime.strptime(datetime_string, '%Y%m%d%H%M%S')
@@ -458,43 +520,39 @@ def process_updates_from_file(response_file):
     return notification_updates
 
 
-def update_letter_notification(filename, temporary_failures, update):
-    if update.status == DVLA_RESPONSE_STATUS_SENT:
-        status = NOTIFICATION_DELIVERED
-    else:
-        status = NOTIFICATION_TEMPORARY_FAILURE
-        temporary_failures.append(update.reference)
-
-    updated_count = dao_update_notifications_by_reference(
-        references=[update.reference],
-        update_dict={"status": status,
-                     "billable_units": update.page_count,
-                     "updated_at": datetime.utcnow()
-                     }
-    )
+def update_letter_notifications(filename, notification_updates):
+    not_found = dao_update_letter_notifications_by_reference([
+        (
+            update.reference,
+            NOTIFICATION_DELIVERED if update.status == DVLA_RESPONSE_STATUS_SENT else NOTIFICATION_TEMPORARY_FAILURE,
+            int(update.page_count)
+        )
+        for update in notification_updates
+    ], current_app.config['LETTER_STATUS_UPDATE_BATCH_SIZE'])
 
-    if not updated_count:
-        msg = "Update letter notification file {filename} failed: notification either not found " \
-              "or already updated from delivered. Status {status} for notification reference {reference}".format(
-                  filename=filename, status=status, reference=update.reference)
+    if not_found:
+        msg = "Update letter notification file {filename} failed: notifications not found " \
+              "for references {references}".format(filename=filename, references=not_found)
         current_app.logger.error(msg)
 
 
-def check_billable_units(notification_update):
-    try:
-        # This try except is necessary because in test keys and research mode does not create notification history.
-        # Otherwise we could just search for the NotificationHistory object
-        notification = dao_get_notification_by_reference(notification_update.reference)
-    except NoResultFound:
-        notification = dao_get_notification_history_by_reference(notification_update.reference)
-
-    if int(notification_update.page_count) != notification.billable_units:
-        msg = 'Notification with id {} had {} billable_units but a page count of {}'.format(
-            notification.id, notification.billable_units, notification_update.page_count)
-        try:
-            raise DVLAException(msg)
-        except DVLAException:
-            current_app.logger.exception(msg)
+def check_billable_units(notification_updates):
+    billable_units = dao_get_billable_units_by_references(update.reference for update in notification_updates)
+
+    for update in notification_updates:
+        if update.reference not in billable_units:
+            current_app.logger.warning('Notification with reference {} not found to check billable units'.format(
+                update.reference))
+            continue
+
+        notification_id, notification_billable_units = billable_units[update.reference]
+        if int(update.page_count) != notification_billable_units:
+            msg = 'Notification with id {} had {} billable_units but a page count of {}'.format(
+                notification_id, notification_billable_units, update.page_count)
+            try:
+                raise DVLAException(msg)
+            except DVLAException:
+                current_app.logger.exception(msg)
 
 
 @notify_celery.task(bind=True, name="send-inbound-sms", max_retries=5, default_retry_delay=300)
@@ -582,12 +640,19 @@ def process_incomplete_job(job_id):
     TemplateClass = get_template_class(db_template.template_type)
     template = TemplateClass(db_template.__dict__)
 
-    for row in RecipientCSV(
+    rows = (
+        row
+        for row in RecipientCSV(
             s3.get_job_from_s3(str(job.service_id), str(job.id)),
             template_type=template.template_type,
             placeholders=template.placeholders
-    ).rows:
-        if row.index > resume_from_row:
+        ).rows
+        if row.index > resume_from_row
+    )
+    if template.template_type == LETTER_TYPE and not job.service.research_mode:
+        save_letters_from_job(rows, db_template, job, job.service)
+    else:
+        for row in rows:
             process_row(row, template, job, job.service)
 
     job_complete(job, resumed=True)
@@ -1,5 +1,9 @@
+import os
+import threading
+
 import boto3
 import botocore
+from botocore.config import Config
 from flask import current_app
 from time import monotonic
 from notifications_utils.recipients import InvalidEmailError
@@ -48,8 +52,13 @@ class AwsSesClient(EmailClient):
     Amazon SES email client.
     '''
 
-    def init_app(self, region, statsd_client, *args, **kwargs):
-        self._client = boto3.client('ses', region_name=region)
+    def init_app(self, region, statsd_client, *args, max_pool_connections=10, **kwargs):
+        # the boto3 client is slow to create, and only needed by the processes that send email
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+        self.region = region
+        self.max_pool_connections = max_pool_connections
         super(AwsSesClient, self).__init__(*args, **kwargs)
         self.name = 'ses'
         self.statsd_client = statsd_client
@@ -57,6 +66,19 @@ class AwsSesClient(EmailClient):
     def get_name(self):
         return self.name
 
+    def get_boto_client(self):
+        # boto3's default session isn't thread safe, and emails are sent from several threads at once.
+        # Celery's prefork workers can't share the parent's connections, so each process makes its own client.
+        with self._client_lock:
+            if self._client_pid != os.getpid():
+                self._client = boto3.session.Session().client(
+                    'ses',
+                    region_name=self.region,
+                    config=Config(max_pool_connections=self.max_pool_connections),
+                )
+                self._client_pid = os.getpid()
+        return self._client
+
     def send_email(self,
                    source,
                    to_addresses,
@@ -80,7 +102,7 @@ class AwsSesClient(EmailClient):
                 })
 
             start_time = monotonic()
-            response = self._client.send_email(
+            response = self.get_boto_client().send_email(
                 Source=source,
                 Destination={
                     'ToAddresses': to_addresses,
@@ -1,3 +1,8 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
 from app.clients import (Client, ClientException)
 
 
@@ -18,6 +23,28 @@ class SmsClient(Client):
     Base Sms client for sending smss.
     '''
 
+    def init_session(self, pool_maxsize):
+        '''
+        Keep connections to the provider open between requests, so that batched sends running on several
+        threads share a pool of connections rather than opening a new one for each message.
+
+        The session is only created when first used, as most processes never send an SMS.
+        '''
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._pool_maxsize = pool_maxsize
+
+    @property
+    def session(self):
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_maxsize)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+        return self._session
+
     def send_sms(self, *args, **kwargs):
         raise NotImplemented('TODO Need to implement.')
 
@@ -2,7 +2,7 @@ import json
 import logging
 
 from time import monotonic
-from requests import request, RequestException
+from requests import RequestException
 
 from app.clients.sms import (SmsClient, SmsClientResponseException)
 
@@ -49,6 +49,7 @@ class FiretextClient(SmsClient):
         self.name = 'firetext'
         self.url = "https://www.firetext.co.uk/api/sendsms/json"
         self.statsd_client = statsd_client
+        self.init_session(current_app.config.get('PROVIDER_BATCH_MAX_CONCURRENT_REQUESTS', 10))
 
     def get_name(self):
         return self.name
@@ -82,7 +83,7 @@ class FiretextClient(SmsClient):
 
         start_time = monotonic()
         try:
-            response = request(
+            response = self.session.request(
                 "POST",
                 self.url,
                 data=data,
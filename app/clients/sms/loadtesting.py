@@ -20,5 +20,6 @@ class LoadtestingClient(FiretextClient):
         self.api_key = config.config.get('LOADTESTING_API_KEY')
         self.from_number = config.config.get('FROM_NUMBER')
         self.name = 'loadtesting'
-        self.url = "https://www.firetext.co.uk/api/sendsms/json"
+        self.url = config.config.get('LOADTESTING_URL')
         self.statsd_client = statsd_client
+        self.init_session(config.config.get('PROVIDER_BATCH_MAX_CONCURRENT_REQUESTS', 10))
@@ -1,6 +1,6 @@
 import json
 from time import monotonic
-from requests import (request, RequestException)
+from requests import RequestException
 from app.clients.sms import (SmsClient, SmsClientResponseException)
 
 mmg_response_map = {
@@ -41,6 +41,7 @@ class MMGClient(SmsClient):
         self.name = 'mmg'
         self.statsd_client = statsd_client
         self.mmg_url = current_app.config.get('MMG_URL')
+        self.init_session(current_app.config.get('PROVIDER_BATCH_MAX_CONCURRENT_REQUESTS', 10))
 
     def record_outcome(self, success, response):
         status_code = response.status_code if response else 503
@@ -73,7 +74,7 @@ class MMGClient(SmsClient):
 
         start_time = monotonic()
         try:
-            response = request(
+            response = self.session.request(
                 "POST",
                 self.mmg_url,
                 data=json.dumps(data),
@@ -12,10 +12,10 @@ from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import func
 from notifications_utils.statsd_decorators import statsd
 
-from app import db, DATETIME_FORMAT, encryption, redis_store
+from app import db, DATETIME_FORMAT, encryption, notify_celery, redis_store
 from app.celery.scheduled_tasks import send_total_sent_notifications_to_performance_platform
 from app.celery.service_callback_tasks import send_delivery_status_to_service
-from app.celery.letters_pdf_tasks import create_letters_pdf
+from app.celery.letters_pdf_tasks import create_letters_pdf, replay_letters_in_error
 from app.config import QueueNames
 from app.dao.fact_billing_dao import (
     delete_billing_data_for_service_for_day,
@@ -295,6 +295,13 @@ def replay_create_pdf_letters(notification_id):
     create_letters_pdf.apply_async([str(notification_id)], queue=QueueNames.CREATE_LETTERS_PDF)
 
 
+@notify_command(name='replay-letters-in-error')
+@click.option('-f', '--filename', required=False,
+              help="Name of one letter in the scan bucket's ERROR folder to replay. Replays them all if not given")
+def replay_letters_in_error_command(filename=None):
+    replay_letters_in_error(filename)
+
+
 @notify_command(name='replay-service-callbacks')
 @click.option('-f', '--file_name', required=True,
               help="""Full path of the file to upload, file is a contains client references of
@@ -324,22 +331,23 @@ def replay_service_callbacks(file_name, service_id):
     if errors:
         raise Exception("Some notifications for the given references were not found")
 
-    for n in notifications:
-        data = {
-            "notification_id": str(n.id),
-            "notification_client_reference": n.client_reference,
-            "notification_to": n.to,
-            "notification_status": n.status,
-            "notification_created_at": n.created_at.strftime(DATETIME_FORMAT),
-            "notification_updated_at": n.updated_at.strftime(DATETIME_FORMAT),
-            "notification_sent_at": n.sent_at.strftime(DATETIME_FORMAT),
-            "notification_type": n.notification_type,
-            "service_callback_api_url": callback_api.url,
-            "service_callback_api_bearer_token": callback_api.bearer_token,
-        }
-        encrypted_status_update = encryption.encrypt(data)
-        send_delivery_status_to_service.apply_async([str(n.id), encrypted_status_update],
-                                                    queue=QueueNames.CALLBACKS)
+    with notify_celery.batch_publishing():
+        for n in notifications:
+            data = {
+                "notification_id": str(n.id),
+                "notification_client_reference": n.client_reference,
+                "notification_to": n.to,
+                "notification_status": n.status,
+                "notification_created_at": n.created_at.strftime(DATETIME_FORMAT),
+                "notification_updated_at": n.updated_at.strftime(DATETIME_FORMAT),
+                "notification_sent_at": n.sent_at.strftime(DATETIME_FORMAT),
+                "notification_type": n.notification_type,
+                "service_callback_api_url": callback_api.url,
+                "service_callback_api_bearer_token": callback_api.bearer_token,
+            }
+            encrypted_status_update = encryption.encrypt(data)
+            notify_celery.publish(send_delivery_status_to_service, [str(n.id), encrypted_status_update],
+                                  queue=QueueNames.CALLBACKS)
 
     print("Replay service status for service: {}. Sent {} notification status updates to the queue".format(
         service_id, len(notifications)))
@@ -602,3 +610,33 @@ def bulk_invite_user_to_service(file_name, service_id, user_id, auth_type, permi
                 print("*** ERROR occurred for email address: {}. \n{}".format(email_address.strip(), e))
 
     file.close()
+
+
+@notify_command(name='load-test')
+@click.option('-s', '--service_id', required=True, type=click.UUID,
+              help="Service to send as. It needs a template of each type in the mix")
+@click.option('-n', '--notifications', default=1000, help="Number of notifications to send through the API")
+@click.option('-c', '--clients', default=10, help="Number of concurrent API clients")
+@click.option('-m', '--mix', default='80,15,5', help="Percentages of sms, email and letters, eg 80,15,5")
+@click.option('-w', '--workers', default=4, help="Number of threads running celery tasks")
+@click.option('-r', '--receipt_rate', default=100.0, help="Delivery receipts fed back to the API per second")
+@click.option('-j', '--job_rows', default=0, help="Also send a CSV job of this many SMS. Needs S3 and research mode")
+def load_test(service_id, notifications, clients, mix, workers, receipt_rate, job_rows):
+    """
+    Load test a local API, celery and receipts in this process, using an in-memory celery broker.
+    """
+    from app.load_test import LoadTest
+    service = dao_fetch_service_by_id(service_id)
+    mix = [int(percentage) for percentage in mix.split(',')]
+
+    report = LoadTest(
+        current_app._get_current_object(), service, notifications, clients, mix, workers, receipt_rate, job_rows
+    ).run()
+
+    print("{requests} requests, {requests_per_second:.1f} per second. Responses: {response_codes}".format(**report))
+    for notification_type, latency in sorted(report['api_latency'].items()):
+        print("API latency for {}: {}".format(notification_type, latency))
+    print("{notifications} notifications, {completed_per_second:.1f} completed per second. Statuses: {statuses}".format(
+        **report
+    ))
+    print("End to end latency: {}".format(report['end_to_end_latency']))
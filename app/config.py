@@ -97,6 +97,9 @@ class Config(object):
     REDIS_ENABLED = os.getenv('REDIS_ENABLED') == '1'
     EXPIRE_CACHE_TEN_MINUTES = 600
     EXPIRE_CACHE_EIGHT_DAYS = 8 * 24 * 60 * 60
+    # previews are only cached for a few minutes, while someone is looking at a letter, and big ones not at all
+    LETTER_PREVIEW_CACHE_SECONDS = 5 * 60
+    LETTER_PREVIEW_CACHE_MAX_BYTES = 512 * 1024
 
     # Performance platform
     PERFORMANCE_PLATFORM_ENABLED = False
@@ -132,6 +135,14 @@ class Config(object):
 
     MAX_LETTER_PDF_ZIP_FILESIZE = 500 * 1024 * 1024  # 500mb
     MAX_LETTER_PDF_COUNT_PER_ZIP = 5000
+    # zips being filled at once when grouping the day's letters, each letter going in the first one it fits in
+    LETTER_ZIP_OPEN_GROUPS = 10
+    # send the FTP app a manifest in S3 listing each zip's letters, rather than the filenames themselves
+    LETTER_ZIP_MANIFESTS_ENABLED = os.getenv('LETTER_ZIP_MANIFESTS_ENABLED') == '1'
+    # most references to look up in one query when collating the day's letters
+    LETTER_STATUS_LOOKUP_BATCH_SIZE = 5000
+    # most letters to update in one statement from a DVLA response file
+    LETTER_STATUS_UPDATE_BATCH_SIZE = 1000
 
     CHECK_PROXY_HEADER = False
 
@@ -158,7 +169,18 @@ class Config(object):
     CELERY_TIMEZONE = 'Europe/London'
     CELERY_ACCEPT_CONTENT = ['json']
     CELERY_TASK_SERIALIZER = 'json'
-    CELERY_IMPORTS = ('app.celery.tasks', 'app.celery.scheduled_tasks', 'app.celery.reporting_tasks')
+    CELERY_TASK_MODULES = (
+        'app.celery.tasks',
+        'app.celery.scheduled_tasks',
+        'app.celery.reporting_tasks',
+        'app.celery.provider_tasks',
+        'app.celery.letters_pdf_tasks',
+        'app.celery.research_mode_tasks',
+        'app.celery.service_callback_tasks',
+        'app.celery.process_ses_receipts_tasks',
+    )
+    # workers that only consume some queues can set a comma separated list of the task modules they need
+    CELERY_IMPORTS = tuple(filter(None, os.getenv('CELERY_IMPORTS', '').split(','))) or CELERY_TASK_MODULES
     CELERYBEAT_SCHEDULE = {
         'run-scheduled-jobs': {
             'task': 'run-scheduled-jobs',
@@ -278,6 +300,66 @@ class Config(object):
     STATSD_PORT = 8125
 
     SENDING_NOTIFICATIONS_TIMEOUT_PERIOD = 259200  # 3 days
+    TIMEOUT_NOTIFICATIONS_BATCH_SIZE = 10000
+    SEND_SCHEDULED_NOTIFICATIONS_BATCH_SIZE = 1000
+    # most notifications of each type to put back on the delivery queues each time created ones are replayed
+    REPLAY_CREATED_NOTIFICATIONS_LIMIT = 100000
+
+    # Active providers are cached in each process, and dropped early when the version key in redis changes
+    PROVIDER_ROUTING_CACHE_TTL_SECONDS = 30
+    PROVIDER_ROUTING_VERSION_CHECK_SECONDS = 2
+
+    # Split domestic SMS between providers by weight instead of sending everything to the highest priority one.
+    # Weights shrink with each provider's recent error rate and share of slow requests, and rate limits are
+    # the most messages a second to send to each provider. Loadtesting can be given a weight to try this locally.
+    SMS_LOAD_BALANCING_ENABLED = os.getenv('SMS_LOAD_BALANCING_ENABLED') == '1'
+    SMS_PROVIDER_WEIGHTS = json.loads(os.environ.get('SMS_PROVIDER_WEIGHTS', '{"mmg": 50, "firetext": 50}'))
+    SMS_PROVIDER_RATE_LIMITS = json.loads(os.environ.get('SMS_PROVIDER_RATE_LIMITS', '{}'))
+    SMS_PROVIDER_SLOW_REQUEST_SECONDS = 5
+    SMS_PROVIDER_HEALTH_WINDOW_MINUTES = 5
+    SMS_PROVIDER_HEALTH_MIN_REQUESTS = 20
+    SMS_PROVIDER_HEALTH_REFRESH_SECONDS = 10
+    SMS_PROVIDER_MIN_HEALTH = 0.1
+
+    # Delivery receipts feed a per provider histogram of time from sent to delivered. The current SMS provider
+    # is switched when this percentile of its receipts, if there are enough of them, is over the threshold.
+    DELIVERY_LATENCY_WINDOW_MINUTES = 15
+    SLOW_DELIVERY_PERCENTILE = 95
+    SLOW_DELIVERY_THRESHOLD_SECONDS = 240
+    SLOW_DELIVERY_MIN_RECEIPTS = 20
+
+    # Profile this share of celery tasks, and log the profile of any that take longer than TASK_PROFILING_MIN_SECONDS
+    TASK_PROFILING_SAMPLE_RATE = float(os.getenv('TASK_PROFILING_SAMPLE_RATE', 0))
+    TASK_PROFILING_MIN_SECONDS = 5
+
+    # API requests report time spent in each instrumentation.span to statsd, and log their span tree if slow
+    SERVER_TIMING_HEADER_ENABLED = os.getenv('SERVER_TIMING_HEADER_ENABLED') == '1'
+    SLOW_REQUEST_THRESHOLD_SECONDS = float(os.getenv('SLOW_REQUEST_THRESHOLD_SECONDS', 1))
+
+    # Tasks published inside notify_celery.batch_publishing() are sent together per queue
+    PUBLISH_BATCH_SIZE = 10
+    PUBLISH_BATCH_MAX_SECONDS = 1
+
+    # Batched delivery: most notifications to fetch per deliver-*-batch task, and most requests in flight
+    # to a provider at once. The SES client's connection pool is made this size too.
+    DELIVER_SMS_BATCH_SIZE = 50
+    DELIVER_EMAIL_BATCH_SIZE = 50
+    PROVIDER_BATCH_MAX_CONCURRENT_REQUESTS = 10
+
+    # Letters from a job have their PDFs created in batches: most letters per create-letters-pdf-batch task,
+    # and most rendered and uploaded at once
+    CREATE_LETTERS_PDF_BATCH_SIZE = 50
+    CREATE_LETTERS_PDF_MAX_CONCURRENT_REQUESTS = 10
+    # Keep the PDFs of letters from jobs in LETTERS_PDF_CACHE_BUCKET_NAME, and copy them for identical letters
+    LETTERS_PDF_CACHE_ENABLED = os.getenv('LETTERS_PDF_CACHE_ENABLED') == '1'
+    # letters moved back from the scan bucket's ERROR folder, and sent to be scanned, at a time
+    REPLAY_LETTERS_IN_ERROR_BATCH_SIZE = 500
+    # precompiled letters bigger than this are decoded to a file on disk rather than in memory
+    PRECOMPILED_LETTER_SPOOL_MAX_SIZE = 5 * 1024 * 1024
+
+    # Connections in the S3 client shared by each process
+    S3_MAX_POOL_CONNECTIONS = 20
+    S3_CLIENT_STATS_INTERVAL_SECONDS = 60
 
     SIMULATED_EMAIL_ADDRESSES = (
         'simulate-delivered@notifications.service.gov.uk',
@@ -287,9 +369,6 @@ class Config(object):
 
     SIMULATED_SMS_NUMBERS = ('+447700900000', '+447700900111', '+447700900222')
 
-    FUNCTIONAL_TEST_PROVIDER_SERVICE_ID = None
-    FUNCTIONAL_TEST_PROVIDER_SMS_TEMPLATE_ID = None
-
     DVLA_BUCKETS = {
         'job': '{}-dvla-file-per-job'.format(os.getenv('NOTIFY_ENVIRONMENT')),
         'notification': '{}-dvla-letter-api-files'.format(os.getenv('NOTIFY_ENVIRONMENT'))
@@ -318,6 +397,7 @@ class Config(object):
     LETTER_PROCESSING_DEADLINE = time(17, 30)
 
     MMG_URL = "https://api.mmg.co.uk/json/api.php"
+    LOADTESTING_URL = os.getenv('LOADTESTING_URL', 'https://www.firetext.co.uk/api/sendsms/json')
     AWS_REGION = 'eu-west-1'
 
 
@@ -335,6 +415,7 @@ class Development(Config):
     DVLA_RESPONSE_BUCKET_NAME = 'notify.tools-ftp'
     LETTERS_PDF_BUCKET_NAME = 'development-letters-pdf'
     LETTERS_SCAN_BUCKET_NAME = 'development-letters-scan'
+    LETTERS_PDF_CACHE_BUCKET_NAME = 'development-letters-pdf-cache'
 
     ADMIN_CLIENT_SECRET = 'dev-notify-secret-key'
     SECRET_KEY = 'dev-notify-secret-key'
@@ -374,6 +455,7 @@ class Test(Development):
     DVLA_RESPONSE_BUCKET_NAME = 'test.notify.com-ftp'
     LETTERS_PDF_BUCKET_NAME = 'test-letters-pdf'
     LETTERS_SCAN_BUCKET_NAME = 'test-letters-scan'
+    LETTERS_PDF_CACHE_BUCKET_NAME = 'test-letters-pdf-cache'
 
     # this is overriden in jenkins and on cloudfoundry
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI', 'postgresql://localhost/test_notification_api')
@@ -394,6 +476,9 @@ class Test(Development):
     MMG_INBOUND_SMS_USERNAME = ['username']
     TEMPLATE_PREVIEW_API_HOST = 'http://localhost:9999'
 
+    # tests change provider details directly, so always read them from the database
+    PROVIDER_ROUTING_CACHE_TTL_SECONDS = 0
+
 
 class Preview(Config):
     NOTIFY_EMAIL_DOMAIN = 'notify.works'
@@ -404,6 +489,7 @@ class Preview(Config):
     DVLA_RESPONSE_BUCKET_NAME = 'notify.works-ftp'
     LETTERS_PDF_BUCKET_NAME = 'preview-letters-pdf'
     LETTERS_SCAN_BUCKET_NAME = 'preview-letters-scan'
+    LETTERS_PDF_CACHE_BUCKET_NAME = 'preview-letters-pdf-cache'
     FROM_NUMBER = 'preview'
     API_RATE_LIMIT_ENABLED = True
     CHECK_PROXY_HEADER = True
@@ -418,6 +504,7 @@ class Staging(Config):
     DVLA_RESPONSE_BUCKET_NAME = 'staging-notify.works-ftp'
     LETTERS_PDF_BUCKET_NAME = 'staging-letters-pdf'
     LETTERS_SCAN_BUCKET_NAME = 'staging-letters-scan'
+    LETTERS_PDF_CACHE_BUCKET_NAME = 'staging-letters-pdf-cache'
     STATSD_ENABLED = True
     FROM_NUMBER = 'stage'
     API_RATE_LIMIT_ENABLED = True
@@ -434,10 +521,9 @@ class Live(Config):
     DVLA_RESPONSE_BUCKET_NAME = 'notifications.service.gov.uk-ftp'
     LETTERS_PDF_BUCKET_NAME = 'production-letters-pdf'
     LETTERS_SCAN_BUCKET_NAME = 'production-letters-scan'
+    LETTERS_PDF_CACHE_BUCKET_NAME = 'production-letters-pdf-cache'
     STATSD_ENABLED = True
     FROM_NUMBER = 'GOVUK'
-    FUNCTIONAL_TEST_PROVIDER_SERVICE_ID = '6c1d81bb-dae2-4ee9-80b0-89a4aae9f649'
-    FUNCTIONAL_TEST_PROVIDER_SMS_TEMPLATE_ID = 'ba9e1789-a804-40b8-871f-cc60d4c1286f'
     PERFORMANCE_PLATFORM_ENABLED = True
     API_RATE_LIMIT_ENABLED = True
     CHECK_PROXY_HEADER = True
@@ -457,6 +543,7 @@ class Sandbox(CloudFoundryConfig):
     DVLA_RESPONSE_BUCKET_NAME = 'notify.works-ftp'
     LETTERS_PDF_BUCKET_NAME = 'cf-sandbox-letters-pdf'
     LETTERS_SCAN_BUCKET_NAME = 'cf-sandbox-letters-scan'
+    LETTERS_PDF_CACHE_BUCKET_NAME = 'cf-sandbox-letters-pdf-cache'
     FROM_NUMBER = 'sandbox'
     REDIS_ENABLED = False
 
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+from app.dao.dao_utils import transactional
+from app.models import LetterAck, LetterAckFile
+
+
+@transactional
+def dao_record_letter_acks(ack_file_name, zip_file_names):
+    '''
+    Record the ack file as read, and each zip it acknowledges. Recording the same file twice - from the DVLA
+    callback and from the daily check - does nothing.
+    '''
+    created_at = datetime.utcnow()
+    db.session.connection().execute(insert(LetterAckFile.__table__).values(
+        ack_file_name=ack_file_name, created_at=created_at
+    ).on_conflict_do_nothing(index_elements=['ack_file_name']))
+
+    if not zip_file_names:
+        return
+    stmt = insert(LetterAck.__table__).values([
+        {'zip_file_name': zip_file_name, 'ack_file_name': ack_file_name, 'created_at': created_at}
+        for zip_file_name in zip_file_names
+    ])
+    db.session.connection().execute(stmt.on_conflict_do_nothing(index_elements=['zip_file_name', 'ack_file_name']))
+
+
+def dao_get_acked_zip_file_names(zip_file_names):
+    if not zip_file_names:
+        return set()
+    return {
+        ack.zip_file_name for ack in db.session.query(LetterAck.zip_file_name).filter(
+            LetterAck.zip_file_name.in_(list(zip_file_names))
+        ).distinct()
+    }
+
+
+def dao_get_zip_file_names_in_ack_files_for_day(day):
+    '''
+    The zips acknowledged by ack files with day, as YYYYMMDD, in their name.
+    '''
+    return {
+        ack.zip_file_name for ack in db.session.query(LetterAck.zip_file_name).filter(
+            LetterAck.ack_file_name.contains(day)
+        ).distinct()
+    }
+
+
+def dao_get_recorded_ack_file_names(ack_file_names):
+    if not ack_file_names:
+        return set()
+    return {
+        ack_file.ack_file_name for ack_file in db.session.query(LetterAckFile.ack_file_name).filter(
+            LetterAckFile.ack_file_name.in_(list(ack_file_names))
+        )
+    }
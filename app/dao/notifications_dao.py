@@ -16,7 +16,7 @@ from notifications_utils.recipients import (
 )
 from notifications_utils.statsd_decorators import statsd
 from werkzeug.datastructures import MultiDict
-from sqlalchemy import (desc, func, or_, asc)
+from sqlalchemy import (desc, func, or_, asc, bindparam)
 from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.expression import case
 from sqlalchemy.sql import functions
@@ -374,27 +374,34 @@ def dao_delete_notifications_and_history_by_id(notification_id):
     ).delete(synchronize_session='fetch')
 
 
-def _timeout_notifications(current_statuses, new_status, timeout_start, updated_at):
-    notifications = Notification.query.filter(
+def _timeout_notifications(current_statuses, new_status, timeout_start, updated_at, limit):
+    table = Notification.__table__
+    ids_to_timeout = db.session.query(Notification.id).filter(
         Notification.created_at < timeout_start,
         Notification.status.in_(current_statuses),
         Notification.notification_type != LETTER_TYPE
-    ).all()
-    for table in [NotificationHistory, Notification]:
-        q = table.query.filter(
-            table.created_at < timeout_start,
-            table.status.in_(current_statuses),
-            table.notification_type != LETTER_TYPE
-        )
-        q.update(
+    ).limit(limit).subquery()
+
+    timed_out = db.session.execute(
+        table.update().where(
+            table.c.id.in_(ids_to_timeout)
+        ).values(
+            status=new_status, updated_at=updated_at
+        ).returning(table.c.id, table.c.service_id)
+    ).fetchall()
+
+    if timed_out:
+        NotificationHistory.query.filter(
+            NotificationHistory.id.in_([row.id for row in timed_out])
+        ).update(
             {'status': new_status, 'updated_at': updated_at},
             synchronize_session=False
         )
-    # return a list of q = notification_ids in Notification table for sending delivery receipts
-    return notifications
+    # return (id, service_id) of each notification timed out, for sending delivery receipts
+    return timed_out
 
 
-def dao_timeout_notifications(timeout_period_in_seconds):
+def dao_timeout_notifications(timeout_period_in_seconds, limit):
     """
     Timeout SMS and email notifications by the following rules:
 
@@ -406,10 +413,14 @@ def dao_timeout_notifications(timeout_period_in_seconds):
         pending -> temporary-failure
 
     Letter notifications are not timed out
+
+    At most `limit` notifications are timed out for each rule, so call this until nothing is returned.
     """
     timeout_start = datetime.utcnow() - timedelta(seconds=timeout_period_in_seconds)
     updated_at = datetime.utcnow()
-    timeout = functools.partial(_timeout_notifications, timeout_start=timeout_start, updated_at=updated_at)
+    timeout = functools.partial(
+        _timeout_notifications, timeout_start=timeout_start, updated_at=updated_at, limit=limit
+    )
 
     # Notifications still in created status are marked with a technical-failure:
     technical_failure_notifications = timeout([NOTIFICATION_CREATED], NOTIFICATION_TECHNICAL_FAILURE)
@@ -436,23 +447,23 @@ def get_total_sent_notifications_in_date_range(start_date, end_date, notificatio
     return result or 0
 
 
-def is_delivery_slow_for_provider(
-        sent_at,
-        provider,
-        threshold,
-        delivery_time,
-        service_id,
-        template_id
-):
-    count = db.session.query(Notification).filter(
-        Notification.service_id == service_id,
-        Notification.template_id == template_id,
+@statsd(namespace="dao")
+def dao_get_delivery_counts_for_provider(provider, sent_at, delivery_time):
+    """
+    How many SMS the provider has delivered that were sent since sent_at, and how many of those took at least
+    delivery_time to deliver.
+    """
+    delivered, slow = db.session.query(
+        func.count(Notification.id),
+        func.count(case([((Notification.updated_at - Notification.sent_at) >= delivery_time, 1)]))
+    ).filter(
+        Notification.created_at >= sent_at - timedelta(days=1),
+        Notification.notification_type == SMS_TYPE,
         Notification.sent_at >= sent_at,
         Notification.status == NOTIFICATION_DELIVERED,
         Notification.sent_by == provider,
-        (Notification.updated_at - Notification.sent_at) >= delivery_time,
-    ).count()
-    return count >= threshold
+    ).one()
+    return delivered, slow
 
 
 @statsd(namespace="dao")
@@ -475,6 +486,145 @@ def dao_update_notifications_by_reference(references, update_dict):
     return updated_count
 
 
+@statsd(namespace="dao")
+@transactional
+def dao_update_letter_notifications_by_reference(letter_updates, batch_size):
+    """
+    Set the status and billable_units of letters from a DVLA response file. Each update is a
+    (reference, status, billable_units) tuple. Each table gets an UPDATE ... FROM (VALUES ...) for every
+    batch_size letters, rather than one per letter. Returns the references that weren't in either table.
+    """
+    updated_at = datetime.utcnow()
+    found = set()
+    for i in range(0, len(letter_updates), batch_size):
+        found.update(_update_letter_notifications_by_reference(letter_updates[i:i + batch_size], updated_at))
+
+    return [reference for reference, _, _ in letter_updates if reference not in found]
+
+
+def _update_letter_notifications_by_reference(letter_updates, updated_at):
+    params = {'updated_at': updated_at}
+    rows = []
+    for i, (reference, status, billable_units) in enumerate(letter_updates):
+        rows.append('(:reference_{0}, :status_{0}, :billable_units_{0})'.format(i))
+        params['reference_{}'.format(i)] = reference
+        params['status_{}'.format(i)] = status
+        params['billable_units_{}'.format(i)] = billable_units
+
+    found = set()
+    for table in (Notification.__tablename__, NotificationHistory.__tablename__):
+        found.update(row.reference for row in db.session.execute(
+            """
+            UPDATE {table}
+            SET notification_status = letter_updates.status,
+                billable_units = letter_updates.billable_units,
+                updated_at = :updated_at
+            FROM (VALUES {rows}) AS letter_updates (reference, status, billable_units)
+            WHERE {table}.reference = letter_updates.reference
+            RETURNING {table}.reference
+            """.format(table=table, rows=', '.join(rows)),
+            params
+        ))
+    return found
+
+
+@statsd(namespace="dao")
+def dao_get_billable_units_by_references(references):
+    """
+    reference -> (id, billable_units) for these references. Test key and research mode letters aren't in
+    notification_history and older letters are only in notification_history, so both tables are read.
+    """
+    references = set(references)
+    billable_units = {
+        row.reference: (row.id, row.billable_units)
+        for row in db.session.query(
+            Notification.reference, Notification.id, Notification.billable_units
+        ).filter(
+            Notification.reference.in_(references)
+        )
+    }
+
+    missing = references - billable_units.keys()
+    if missing:
+        billable_units.update({
+            row.reference: (row.id, row.billable_units)
+            for row in db.session.query(
+                NotificationHistory.reference, NotificationHistory.id, NotificationHistory.billable_units
+            ).filter(
+                NotificationHistory.reference.in_(missing)
+            )
+        })
+    return billable_units
+
+
+@statsd(namespace="dao")
+@transactional
+def dao_update_notifications_sent_to_provider(notification_updates):
+    """
+    Record the outcome of sending a batch of notifications to a provider. Each update is a dict of
+    id, status, sent_at, sent_by, reference and billable_units for one notification. Both tables are
+    updated with a single executemany each, rather than one round trip per notification.
+    """
+    if not notification_updates:
+        return
+
+    updated_at = datetime.utcnow()
+    params = [
+        {
+            '_id': update['id'],
+            '_status': update['status'],
+            '_sent_at': update['sent_at'],
+            '_sent_by': update['sent_by'],
+            '_reference': update['reference'],
+            '_billable_units': update['billable_units'],
+            '_updated_at': updated_at,
+        }
+        for update in notification_updates
+    ]
+
+    for table in (Notification.__table__, NotificationHistory.__table__):
+        db.session.execute(
+            table.update().where(
+                table.c.id == bindparam('_id')
+            ).values(
+                status=bindparam('_status'),
+                sent_at=bindparam('_sent_at'),
+                sent_by=bindparam('_sent_by'),
+                reference=bindparam('_reference'),
+                billable_units=bindparam('_billable_units'),
+                updated_at=bindparam('_updated_at'),
+            ),
+            params
+        )
+
+
+@statsd(namespace="dao")
+@transactional
+def dao_update_notifications_billable_units(billable_units):
+    """
+    Set billable_units for each notification id in the dict, with a single executemany for each table.
+    """
+    if not billable_units:
+        return
+
+    updated_at = datetime.utcnow()
+    params = [
+        {'_id': notification_id, '_billable_units': units, '_updated_at': updated_at}
+        for notification_id, units in billable_units.items()
+    ]
+
+    for table in (Notification.__table__, NotificationHistory.__table__):
+        db.session.execute(
+            table.update().where(
+                table.c.id == bindparam('_id')
+            ).values(
+                billable_units=bindparam('_billable_units'),
+                updated_at=bindparam('_updated_at'),
+            ),
+            params
+        )
+
+
 @statsd(namespace="dao")
 def dao_get_notifications_by_to_field(service_id, search_term, notification_type=None, statuses=None):
     if notification_type is None:
@@ -535,28 +685,71 @@ def dao_get_notifications_by_references(references):
     ).all()
 
 
+@statsd(namespace="dao")
+def dao_get_notification_statuses_by_references(references, batch_size):
+    """
+    reference -> status for the notifications with these references, looked up batch_size at a time.
+    """
+    references = list(references)
+    statuses = {}
+    for i in range(0, len(references), batch_size):
+        statuses.update(db.session.query(
+            Notification.reference, Notification.status
+        ).filter(
+            Notification.reference.in_(references[i:i + batch_size])
+        ).all())
+    return statuses
+
+
+@statsd(namespace="dao")
+def dao_get_notifications_by_ids(notification_ids):
+    return Notification.query.filter(
+        Notification.id.in_(notification_ids)
+    ).all()
+
+
 @statsd(namespace="dao")
 def dao_created_scheduled_notification(scheduled_notification):
     db.session.add(scheduled_notification)
     db.session.commit()
 
 
-@statsd(namespace="dao")
-def dao_get_scheduled_notifications():
-    notifications = Notification.query.join(
-        ScheduledNotification
+def dao_lock_scheduled_notifications_to_send(limit):
+    """
+    Rows of id, notification_type, key_type and the service's research_mode for up to `limit` scheduled SMS and
+    email notifications that are due.
+
+    Their scheduled_notifications rows stay locked until the transaction ends, and rows locked by another
+    transaction are skipped, so overlapping runs never pick up the same notification.
+    """
+    return db.session.query(
+        Notification.id,
+        Notification.notification_type,
+        Notification.key_type,
+        Service.research_mode
+    ).join(
+        ScheduledNotification, ScheduledNotification.notification_id == Notification.id
+    ).join(
+        Service, Notification.service_id == Service.id
     ).filter(
         ScheduledNotification.scheduled_for < datetime.utcnow(),
-        ScheduledNotification.pending).all()
-
-    return notifications
+        ScheduledNotification.pending,
+        Notification.notification_type.in_([SMS_TYPE, EMAIL_TYPE])
+    ).order_by(
+        ScheduledNotification.scheduled_for
+    ).limit(
+        limit
+    ).with_for_update(
+        skip_locked=True, of=ScheduledNotification
+    ).all()
 
 
-def set_scheduled_notification_to_processed(notification_id):
+def set_scheduled_notifications_to_processed(notification_ids):
     db.session.query(ScheduledNotification).filter(
-        ScheduledNotification.notification_id == notification_id
+        ScheduledNotification.notification_id.in_(notification_ids)
     ).update(
-        {'pending': False}
+        {'pending': False},
+        synchronize_session=False
     )
     db.session.commit()
 
@@ -638,15 +831,26 @@ def dao_get_count_of_letters_to_process_for_date(date_to_process=None):
     return count_of_letters_to_process_for_date
 
 
-def notifications_not_yet_sent(should_be_sending_after_seconds, notification_type):
+def notifications_not_yet_sent(should_be_sending_after_seconds, notification_type, limit=None):
+    """
+    Rows of id, key_type and the service's research_mode for each notification still in created, streamed
+    from a server side cursor so a large backlog is never held in memory all at once.
+    """
     older_than_date = datetime.utcnow() - timedelta(seconds=should_be_sending_after_seconds)
 
-    notifications = Notification.query.filter(
+    return db.session.query(
+        Notification.id,
+        Notification.key_type,
+        Service.research_mode
+    ).join(
+        Service, Notification.service_id == Service.id
+    ).filter(
         Notification.created_at <= older_than_date,
         Notification.notification_type == notification_type,
         Notification.status == NOTIFICATION_CREATED
-    ).all()
-    return notifications
+    ).limit(
+        limit
+    ).yield_per(1000)
 
 
 def guess_notification_type(search_term):
@@ -8,6 +8,7 @@ from app.provider_details.switch_providers import (
     provider_is_primary,
     switch_providers
 )
+from app.provider_details.routing import invalidate_provider_routing
 from app.models import ProviderDetails, ProviderDetailsHistory
 from app import db
 
@@ -57,8 +58,13 @@ def dao_toggle_sms_provider(identifier):
     dao_switch_sms_provider_to_provider_with_identifier(alternate_provider.identifier)
 
 
-@transactional
 def dao_switch_sms_provider_to_provider_with_identifier(identifier):
+    _switch_sms_provider_to_provider_with_identifier(identifier)
+    invalidate_provider_routing()
+
+
+@transactional
+def _switch_sms_provider_to_provider_with_identifier(identifier):
     new_provider = get_provider_details_by_identifier(identifier)
 
     if provider_is_inactive(new_provider):
@@ -90,8 +96,13 @@ def get_provider_details_by_notification_type(notification_type, supports_intern
     return ProviderDetails.query.filter(*filters).order_by(asc(ProviderDetails.priority)).all()
 
 
-@transactional
 def dao_update_provider_details(provider_details):
+    _update_provider_details(provider_details)
+    invalidate_provider_routing()
+
+
+@transactional
+def _update_provider_details(provider_details):
     provider_details.version += 1
     provider_details.updated_at = datetime.utcnow()
     history = ProviderDetailsHistory.from_original(provider_details)
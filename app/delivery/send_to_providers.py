@@ -1,25 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
 from urllib import parse
 from datetime import datetime
+from time import monotonic
 
 from flask import current_app
 from notifications_utils.recipients import (
     validate_and_format_phone_number,
-    validate_and_format_email_address
+    validate_and_format_email_address,
+    InvalidEmailError
 )
 from notifications_utils.template import HTMLEmailTemplate, PlainTextEmailTemplate, SMSMessageTemplate
 from requests.exceptions import HTTPError
 
-from app import clients, statsd_client, create_uuid
+from app import clients, statsd_client, create_uuid, instrumentation
 from app.dao.notifications_dao import (
-    dao_update_notification
-)
-from app.dao.provider_details_dao import (
-    get_provider_details_by_notification_type,
-    dao_toggle_sms_provider
+    dao_update_notification,
+    dao_update_notifications_sent_to_provider
 )
+from app.dao.provider_details_dao import dao_toggle_sms_provider
 from app.celery.research_mode_tasks import send_sms_response, send_email_response
 from app.dao.templates_dao import dao_get_template_by_id
 from app.exceptions import NotificationTechnicalFailureException
+from app.provider_details.routing import (
+    choose_sms_provider,
+    get_active_provider_identifiers,
+    record_sms_provider_outcome
+)
 from app.models import (
     SMS_TYPE,
     KEY_TYPE_TEST,
@@ -70,14 +76,15 @@ def send_sms_to_provider(notification):
                 raise
         else:
             try:
-                provider.send_sms(
-                    to=validate_and_format_phone_number(notification.to, international=notification.international),
-                    content=str(template),
-                    reference=str(notification.id),
-                    sender=notification.reply_to_text
-                )
+                send_sms(provider, {
+                    'to': validate_and_format_phone_number(notification.to, international=notification.international),
+                    'content': str(template),
+                    'reference': str(notification.id),
+                    'sender': notification.reply_to_text
+                })
             except Exception as e:
-                dao_toggle_sms_provider(provider.name)
+                if not is_sms_load_balanced(notification.international):
+                    dao_toggle_sms_provider(provider.name)
                 raise e
             else:
                 notification.billable_units = template.fragment_count
@@ -90,6 +97,111 @@ def send_sms_to_provider(notification):
         statsd_client.timing("sms.total-time", delta_milliseconds)
 
 
+def send_sms_batch_to_provider(notifications):
+    """
+    Send a batch of SMS notifications. The provider is chosen once for domestic and once for international
+    messages and each template version is fetched once, then the messages are sent concurrently over the
+    providers' pooled connections and the results are written back in a single bulk update.
+
+    Returns the notifications that could not be sent, so that they can be retried one at a time.
+    """
+    to_send, failed = _send_notifications_not_for_provider(notifications, send_sms_to_provider)
+
+    messages, not_built = _build_sms_messages(to_send)
+    failed += not_built
+
+    results = send_concurrently(
+        lambda message: send_sms(message['provider'], message['sms']),
+        messages
+    )
+
+    sent_at = datetime.utcnow()
+    updates = []
+    failed_providers = set()
+    for message, (_, exception) in zip(messages, results):
+        notification, provider = message['notification'], message['provider']
+        if exception is None:
+            updates.append(_notification_update(
+                notification,
+                NOTIFICATION_SENT if notification.international else NOTIFICATION_SENDING,
+                sent_at=sent_at,
+                sent_by=provider.get_name(),
+                billable_units=message['fragment_count']
+            ))
+            delta_milliseconds = (sent_at - notification.created_at).total_seconds() * 1000
+            statsd_client.timing("sms.total-time", delta_milliseconds)
+        else:
+            current_app.logger.error("SMS notification {} failed: {}".format(notification.id, exception))
+            if not is_sms_load_balanced(notification.international):
+                failed_providers.add(provider.name)
+            failed.append(notification)
+
+    dao_update_notifications_sent_to_provider(updates)
+
+    for provider_name in failed_providers:
+        dao_toggle_sms_provider(provider_name)
+
+    current_app.logger.info("Sent {} SMS in a batch of {}".format(len(updates), len(notifications)))
+    return failed
+
+
+def _build_sms_messages(notifications):
+    providers = {}
+    template_models = {}
+    messages = []
+    failed = []
+    for notification in notifications:
+        try:
+            provider = providers.get(notification.international)
+            if provider is None:
+                provider = provider_to_use(SMS_TYPE, notification.id, notification.international)
+                if not is_sms_load_balanced(notification.international):
+                    # without load balancing every message goes to the same provider, so only choose it once
+                    providers[notification.international] = provider
+            template_key = (notification.template_id, notification.template_version)
+            if template_key not in template_models:
+                template_models[template_key] = dao_get_template_by_id(*template_key)
+
+            service = notification.service
+            template = SMSMessageTemplate(
+                template_models[template_key].__dict__,
+                values=notification.personalisation,
+                prefix=service.name,
+                show_prefix=service.prefix_sms,
+            )
+            messages.append({
+                'notification': notification,
+                'provider': provider,
+                'fragment_count': template.fragment_count,
+                'sms': {
+                    'to': validate_and_format_phone_number(notification.to, international=notification.international),
+                    'content': str(template),
+                    'reference': str(notification.id),
+                    'sender': notification.reply_to_text,
+                },
+            })
+        except Exception:
+            current_app.logger.exception("SMS notification {} failed".format(notification.id))
+            failed.append(notification)
+    return messages, failed
+
+
+@instrumentation.timed('http')
+def send_sms(provider, sms):
+    start_time = monotonic()
+    try:
+        response = provider.send_sms(**sms)
+    except Exception:
+        record_sms_provider_outcome(provider.name, False, monotonic() - start_time)
+        raise
+    record_sms_provider_outcome(provider.name, True, monotonic() - start_time)
+    return response
+
+
+def is_sms_load_balanced(international):
+    return current_app.config['SMS_LOAD_BALANCING_ENABLED'] and not international
+
+
 def send_email_to_provider(notification):
     service = notification.service
     if not service.active:
@@ -102,17 +214,6 @@ def send_email_to_provider(notification):
         )
         template_dict = dao_get_template_by_id(notification.template_id, notification.template_version).__dict__
 
-        html_email = HTMLEmailTemplate(
-            template_dict,
-            values=notification.personalisation,
-            **get_html_email_options(service)
-        )
-
-        plain_text_email = PlainTextEmailTemplate(
-            template_dict,
-            values=notification.personalisation
-        )
-
         if service.research_mode or notification.key_type == KEY_TYPE_TEST:
             reference = str(create_uuid())
             notification.billable_units = 0
@@ -120,19 +221,7 @@ def send_email_to_provider(notification):
             update_notification(notification, provider)
             send_email_response(reference, notification.to)
         else:
-            from_address = '"{}" <{}@{}>'.format(service.name, service.email_from,
-                                                 current_app.config['NOTIFY_EMAIL_DOMAIN'])
-
-            email_reply_to = notification.reply_to_text
-
-            reference = provider.send_email(
-                from_address,
-                validate_and_format_email_address(notification.to),
-                plain_text_email.subject,
-                body=str(plain_text_email),
-                html_body=str(html_email),
-                reply_to_address=validate_and_format_email_address(email_reply_to) if email_reply_to else None,
-            )
+            reference = send_email(provider, build_email(notification, template_dict))
             notification.reference = reference
             update_notification(notification, provider)
 
@@ -143,6 +232,172 @@ def send_email_to_provider(notification):
         statsd_client.timing("email.total-time", delta_milliseconds)
 
 
+def send_email_batch_to_provider(notifications):
+    """
+    Send a batch of email notifications to the current email provider. Templates are fetched once per
+    version and rendered up front, then the emails are sent concurrently through the one provider client
+    and the results are written back in a single bulk update.
+
+    Returns the notifications that could not be sent, so that they can be retried one at a time.
+    """
+    to_send, failed = _send_notifications_not_for_provider(notifications, send_email_to_provider)
+
+    if not to_send:
+        return failed
+
+    provider = provider_to_use(EMAIL_TYPE, to_send[0].id)
+
+    template_dicts = {}
+    emails = []
+    updates = []
+    for notification in to_send:
+        template_key = (notification.template_id, notification.template_version)
+        if template_key not in template_dicts:
+            template_dicts[template_key] = dao_get_template_by_id(*template_key).__dict__
+        try:
+            emails.append((notification, build_email(notification, template_dicts[template_key])))
+        except InvalidEmailError as e:
+            current_app.logger.exception(e)
+            updates.append(_notification_update(notification, NOTIFICATION_TECHNICAL_FAILURE))
+
+    results = send_concurrently(
+        lambda email: send_email(provider, email),
+        [email for _, email in emails]
+    )
+
+    sent_at = datetime.utcnow()
+    sent_count = 0
+    for (notification, _), (reference, exception) in zip(emails, results):
+        if exception is None:
+            sent_count += 1
+            updates.append(_notification_update(
+                notification, NOTIFICATION_SENDING, sent_at=sent_at, sent_by=provider.get_name(), reference=reference
+            ))
+            delta_milliseconds = (sent_at - notification.created_at).total_seconds() * 1000
+            statsd_client.timing("email.total-time", delta_milliseconds)
+        elif isinstance(exception, InvalidEmailError):
+            current_app.logger.exception(exception)
+            updates.append(_notification_update(notification, NOTIFICATION_TECHNICAL_FAILURE))
+        else:
+            current_app.logger.error("Email notification {} failed: {}".format(notification.id, exception))
+            failed.append(notification)
+
+    dao_update_notifications_sent_to_provider(updates)
+
+    current_app.logger.info(
+        "Sent {} emails in a batch of {} to provider {}".format(sent_count, len(notifications), provider.get_name())
+    )
+    return failed
+
+
+def _send_notifications_not_for_provider(notifications, send_to_provider):
+    """
+    Notifications for inactive services, research mode and test keys never reach the provider, so they are
+    sent the same way as a single notification. Returns the notifications left for the provider, and those
+    which failed.
+    """
+    to_send = []
+    failed = []
+    for notification in notifications:
+        if notification.status != NOTIFICATION_CREATED:
+            continue
+        service = notification.service
+        if service.active and not service.research_mode and notification.key_type != KEY_TYPE_TEST:
+            to_send.append(notification)
+            continue
+        try:
+            send_to_provider(notification)
+        except NotificationTechnicalFailureException as e:
+            current_app.logger.exception(e)
+        except Exception:
+            current_app.logger.exception(
+                "{} notification {} failed".format(notification.notification_type, notification.id)
+            )
+            failed.append(notification)
+    return to_send, failed
+
+
+def build_email(notification, template_dict):
+    service = notification.service
+
+    html_email = HTMLEmailTemplate(
+        template_dict,
+        values=notification.personalisation,
+        **get_html_email_options(service)
+    )
+
+    plain_text_email = PlainTextEmailTemplate(
+        template_dict,
+        values=notification.personalisation
+    )
+
+    email_reply_to = notification.reply_to_text
+
+    return {
+        'from_address': '"{}" <{}@{}>'.format(service.name, service.email_from,
+                                              current_app.config['NOTIFY_EMAIL_DOMAIN']),
+        'to': validate_and_format_email_address(notification.to),
+        'subject': plain_text_email.subject,
+        'body': str(plain_text_email),
+        'html_body': str(html_email),
+        'reply_to_address': validate_and_format_email_address(email_reply_to) if email_reply_to else None,
+    }
+
+
+@instrumentation.timed('http')
+def send_email(provider, email):
+    return provider.send_email(
+        email['from_address'],
+        email['to'],
+        email['subject'],
+        body=email['body'],
+        html_body=email['html_body'],
+        reply_to_address=email['reply_to_address'],
+    )
+
+
+def send_concurrently(send, items, max_workers=None):
+    """
+    Call send for every item using a bounded pool of threads, each with the current app context. There are
+    PROVIDER_BATCH_MAX_CONCURRENT_REQUESTS threads unless max_workers is given.
+    Returns a (result, exception) tuple per item, in the same order as the items.
+
+    Each thread times its calls in its own app context, and the totals are added to the current app context's
+    once they've all finished.
+    """
+    app = current_app._get_current_object()
+
+    def send_with_app_context(item):
+        with app.app_context():
+            try:
+                outcome = send(item), None
+            except Exception as e:
+                outcome = None, e
+            return outcome, instrumentation.get_timing_totals()
+
+    if not items:
+        return []
+
+    max_workers = max_workers or current_app.config['PROVIDER_BATCH_MAX_CONCURRENT_REQUESTS']
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(send_with_app_context, items))
+
+    for _, timing_totals in results:
+        instrumentation.add_timing_totals(timing_totals)
+    return [outcome for outcome, _ in results]
+
+
+def _notification_update(notification, status, sent_at=None, sent_by=None, reference=None, billable_units=None):
+    return {
+        'id': notification.id,
+        'status': status,
+        'sent_at': sent_at,
+        'sent_by': sent_by,
+        'reference': reference if reference is not None else notification.reference,
+        'billable_units': billable_units if billable_units is not None else notification.billable_units,
+    }
+
+
 def update_notification(notification, provider, international=False):
     notification.sent_at = datetime.utcnow()
     notification.sent_by = provider.get_name()
@@ -154,9 +409,7 @@ def update_notification(notification, provider, international=False):
 
 
 def provider_to_use(notification_type, notification_id, international=False):
-    active_providers_in_order = [
-        p for p in get_provider_details_by_notification_type(notification_type, international) if p.active
-    ]
+    active_providers_in_order = get_active_provider_identifiers(notification_type, international)
 
     if not active_providers_in_order:
         current_app.logger.error(
@@ -164,7 +417,10 @@ def provider_to_use(notification_type, notification_id, international=False):
         )
         raise Exception("No active {} providers".format(notification_type))
 
-    return clients.get_client_by_name_and_type(active_providers_in_order[0].identifier, notification_type)
+    if notification_type == SMS_TYPE and is_sms_load_balanced(international):
+        return clients.get_client_by_name_and_type(choose_sms_provider(active_providers_in_order), notification_type)
+
+    return clients.get_client_by_name_and_type(active_providers_in_order[0], notification_type)
 
 
 def get_logo_url(base_url, logo_file):
@@ -0,0 +1,207 @@
+import cProfile
+import io
+import pstats
+import random
+from contextlib import contextmanager
+from functools import wraps
+from time import monotonic
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REDIS_CLIENT_METHODS = (
+    'get',
+    'set',
+    'incr',
+    'expire',
+    'delete',
+    'get_all_from_hash',
+    'set_hash_and_expire',
+    'increment_hash_value',
+    'decrement_hash_value',
+    'exceeded_rate_limit',
+)
+
+
+def init_app(redis_client):
+    """
+    Count the time spent in database queries and redis calls against the current app context, so that each
+    celery task or request can report where its time went.
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    for name in REDIS_CLIENT_METHODS:
+        method = getattr(redis_client, name, None)
+        if method is not None and not getattr(method, 'instrumented', False):
+            setattr(redis_client, name, timed('redis')(method))
+
+
+def timed(kind):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(kind, monotonic() - start)
+        wrapper.instrumented = True
+        return wrapper
+    return decorator
+
+
+def record(kind, elapsed_time):
+    if not has_app_context():
+        return
+    totals = get_timing_totals()
+    count, total = totals.get(kind, (0, 0))
+    totals[kind] = (count + 1, total + elapsed_time)
+
+
+def add_timing_totals(timing_totals):
+    """
+    Add totals collected in another app context, such as a worker thread's, to the current app context's.
+    """
+    totals = get_timing_totals()
+    for kind, (count, total) in timing_totals.items():
+        current_count, current_total = totals.get(kind, (0, 0))
+        totals[kind] = (current_count + count, current_total + total)
+
+
+def get_timing_totals():
+    """
+    kind ('db', 'redis', 'http') -> (number of calls, total seconds) for the current app context.
+    """
+    if 'timing_totals' not in g:
+        g.timing_totals = {}
+    return g.timing_totals
+
+
+@contextmanager
+def span(name):
+    """
+    Time a block, or a function when used as a decorator, as a child of the innermost open span of the current
+    request. Does nothing outside a request started with `start_request_spans`, so it is safe in shared code that
+    celery tasks also call.
+    """
+    stack = g.get('span_stack') if has_app_context() else None
+    if not stack:
+        yield
+        return
+
+    node = {'name': name, 'elapsed': 0, 'children': []}
+    stack[-1]['children'].append(node)
+    stack.append(node)
+    start = monotonic()
+    try:
+        yield
+    finally:
+        node['elapsed'] = monotonic() - start
+        stack.pop()
+
+
+def start_request_spans(name):
+    g.span_stack = [{'name': name, 'start': monotonic(), 'elapsed': 0, 'children': []}]
+
+
+def finish_request_spans(response):
+    """
+    Close the request's root span and report where its time went: statsd timers for each named span and for
+    db, redis and http calls, a Server-Timing header if SERVER_TIMING_HEADER_ENABLED, and the whole span tree
+    in the log if the request took longer than SLOW_REQUEST_THRESHOLD_SECONDS.
+    """
+    from app import statsd_client
+
+    stack = g.pop('span_stack', None)
+    if not stack:
+        return response
+
+    root = stack[0]
+    root['elapsed'] = monotonic() - root['start']
+    span_totals = _span_totals(root['children'])
+    timing_totals = get_timing_totals()
+
+    for name, elapsed_time in span_totals.items():
+        statsd_client.timing('requests.{}.{}-time'.format(root['name'], name), elapsed_time)
+    for kind, (count, total) in timing_totals.items():
+        statsd_client.timing('requests.{}.{}-time'.format(root['name'], kind), total)
+        statsd_client.incr('requests.{}.{}-calls'.format(root['name'], kind), count=count)
+
+    if current_app.config['SERVER_TIMING_HEADER_ENABLED']:
+        response.headers['Server-Timing'] = _server_timing_header(root, span_totals, timing_totals)
+
+    if root['elapsed'] >= current_app.config['SLOW_REQUEST_THRESHOLD_SECONDS']:
+        current_app.logger.warning("Slow request {}\n{}\n{}".format(
+            root['name'],
+            '\n'.join(_format_span_tree(root)),
+            ', '.join(
+                '{}: {} calls in {:.4f}s'.format(kind, count, total)
+                for kind, (count, total) in sorted(timing_totals.items())
+            )
+        ))
+
+    return response
+
+
+def start_sampled_profile(sample_rate):
+    if not sample_rate or random.random() >= sample_rate:
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def log_profile_if_slow(profile, name, elapsed_time, min_seconds):
+    if profile is None:
+        return
+    profile.disable()
+    if elapsed_time < min_seconds:
+        return
+
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(30)
+    current_app.logger.info("Profile of {} which took {:.4f}s\n{}".format(name, elapsed_time, stream.getvalue()))
+
+
+def _span_totals(spans, totals=None):
+    totals = {} if totals is None else totals
+    for node in spans:
+        totals[node['name']] = totals.get(node['name'], 0) + node['elapsed']
+        _span_totals(node['children'], totals)
+    return totals
+
+
+def _server_timing_header(root, span_totals, timing_totals):
+    metrics = ['total;dur={:.1f}'.format(root['elapsed'] * 1000)]
+    metrics += ['{};dur={:.1f}'.format(name, elapsed_time * 1000) for name, elapsed_time in span_totals.items()]
+    metrics += [
+        '{};desc="{} calls";dur={:.1f}'.format(kind, count, total * 1000)
+        for kind, (count, total) in sorted(timing_totals.items())
+    ]
+    return ', '.join(metrics)
+
+
+def _format_span_tree(node, depth=0):
+    lines = ['{}{} {:.4f}s'.format('  ' * depth, node['name'], node['elapsed'])]
+    for child in node['children']:
+        lines += _format_span_tree(child, depth + 1)
+    return lines
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_times', []).append(monotonic())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record('db', monotonic() - conn.info['query_start_times'].pop())
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute isn't called for a query that fails
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start_times'):
+        record('db', monotonic() - conn.info['query_start_times'].pop())
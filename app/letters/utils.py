@@ -1,11 +1,23 @@
+import base64
+import hashlib
+import io
+import json
+import tempfile
 from datetime import datetime, timedelta
 from enum import Enum
 
-import boto3
+import botocore
 from flask import current_app
 
-from notifications_utils.s3 import s3upload
-
+from app import redis_store, statsd_client
+from app.aws.s3 import (
+    copy_s3_object,
+    get_s3_client,
+    get_s3_object_metadata,
+    get_s3_resource,
+    remove_s3_object,
+    s3upload,
+)
 from app.models import KEY_TYPE_TEST
 from app.utils import convert_utc_to_bst
 
@@ -15,6 +27,12 @@ class ScanErrorType(Enum):
     FAILURE = 2
 
 
+# characters of base64 letter content decoded at a time
+BASE64_CHUNK_SIZE = 1024 * 1024
+NOT_BASE64_CHARACTERS = bytes(
+    set(range(256)) - set(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')
+)
+
 LETTERS_PDF_FILE_LOCATION_STRUCTURE = \
     '{folder}NOTIFY.{reference}.{duplex}.{letter_class}.{colour}.{crown}.{date}.pdf'
 
@@ -25,13 +43,51 @@ def get_folder_name(_now, is_test_or_scan_letter=False):
     if is_test_or_scan_letter:
         folder_name = ''
     else:
-        print_datetime = convert_utc_to_bst(_now)
-        if print_datetime.time() > current_app.config.get('LETTER_PROCESSING_DEADLINE'):
-            print_datetime += timedelta(days=1)
-        folder_name = '{}/'.format(print_datetime.date())
+        folder_name = '{}/'.format(get_letter_print_date(_now))
     return folder_name
 
 
+def get_letter_print_date(_now):
+    print_datetime = convert_utc_to_bst(_now)
+    if print_datetime.time() > current_app.config.get('LETTER_PROCESSING_DEADLINE'):
+        print_datetime += timedelta(days=1)
+    return print_datetime.date()
+
+
+def letters_to_process_cache_key(print_date):
+    return 'letters-to-process-{}'.format(print_date)
+
+
+def increment_letters_to_process(notification):
+    """
+    Count a letter that's waiting to be sent to print on its print day, so the day's letters don't have to be
+    counted in the database. Test letters and letters from services in research mode are never printed.
+    """
+    if notification.key_type == KEY_TYPE_TEST or notification.service.research_mode:
+        return
+    key = letters_to_process_cache_key(get_letter_print_date(notification.created_at))
+    redis_store.increment_hash_value(key, 'count')
+    redis_store.expire(key, current_app.config['EXPIRE_CACHE_EIGHT_DAYS'])
+
+
+def decrement_letters_to_process(notification):
+    if notification.key_type == KEY_TYPE_TEST or notification.service.research_mode:
+        return
+    redis_store.decrement_hash_value(
+        letters_to_process_cache_key(get_letter_print_date(notification.created_at)), 'count'
+    )
+
+
+def get_letters_to_process_count(print_date):
+    """
+    The count kept by increment_letters_to_process, or None if there isn't one, for example if redis is off.
+    """
+    counts = redis_store.get_all_from_hash(letters_to_process_cache_key(print_date))
+    if not counts or b'count' not in counts:
+        return None
+    return int(counts[b'count'])
+
+
 def get_letter_pdf_filename(reference, crown, is_scan_letter=False):
     now = datetime.utcnow()
 
@@ -64,9 +120,62 @@ def get_reference_from_filename(filename):
     return filename_parts[1]
 
 
+def letter_pdf_location_cache_key(reference):
+    return 'letter-pdf-location-{}'.format(reference.upper())
+
+
+def record_letter_pdf_location(filename):
+    """
+    Remember where a letter's PDF ended up, so get_letter_pdf can fetch it without listing the bucket. The
+    filename has the time it was made in, so it can't be worked out from the notification.
+    """
+    redis_store.set(
+        letter_pdf_location_cache_key(get_reference_from_filename(filename)),
+        filename,
+        ex=current_app.config['EXPIRE_CACHE_EIGHT_DAYS']
+    )
+
+
+def decode_letter_content(content):
+    """
+    Decode base64 letter content a chunk at a time into a temporary file, which stays in memory until it's bigger
+    than PRECOMPILED_LETTER_SPOOL_MAX_SIZE, so a large letter is never held decoded in memory as well. Characters
+    that aren't base64 are skipped, and invalid content raises ValueError, as base64.b64decode does.
+    """
+    letter_file = tempfile.SpooledTemporaryFile(max_size=current_app.config['PRECOMPILED_LETTER_SPOOL_MAX_SIZE'])
+    remainder = b''
+    try:
+        for i in range(0, len(content), BASE64_CHUNK_SIZE):
+            chunk = content[i:i + BASE64_CHUNK_SIZE].encode('ascii')
+            chunk = remainder + chunk.translate(None, NOT_BASE64_CHARACTERS)
+            # base64 decodes in groups of 4 characters, so any left over wait for the next chunk
+            whole_groups = len(chunk) - len(chunk) % 4
+            letter_file.write(base64.b64decode(chunk[:whole_groups]))
+            remainder = chunk[whole_groups:]
+        letter_file.write(base64.b64decode(remainder))
+    except ValueError:
+        letter_file.close()
+        raise
+
+    letter_file.seek(0)
+    return letter_file
+
+
+def _get_size(pdf_data):
+    if not hasattr(pdf_data, 'read'):
+        return len(pdf_data)
+    pdf_data.seek(0, io.SEEK_END)
+    size = pdf_data.tell()
+    pdf_data.seek(0)
+    return size
+
+
 def upload_letter_pdf(notification, pdf_data, precompiled=False):
+    """
+    `pdf_data` is the PDF's bytes, or a file of them.
+    """
     current_app.logger.info("PDF Letter {} reference {} created at {}, {} bytes".format(
-        notification.id, notification.reference, notification.created_at, len(pdf_data)))
+        notification.id, notification.reference, notification.created_at, _get_size(pdf_data)))
 
     upload_file_name = get_letter_pdf_filename(
         notification.reference,
@@ -85,11 +194,61 @@ def upload_letter_pdf(notification, pdf_data, precompiled=False):
         file_location=upload_file_name
     )
 
+    if not precompiled:
+        record_letter_pdf_location(upload_file_name)
+
     current_app.logger.info("Uploaded letters PDF {} to {} for notification id {}".format(
         upload_file_name, bucket_name, notification.id))
     return upload_file_name
 
 
+def get_letter_pdf_cache_key(data):
+    """
+    Letters with the same template version, contact block, organisation and personalisation get the same PDF
+    on the same day, so cached PDFs are found by a hash of everything sent to template preview to make them
+    and today's date in London, which template preview prints on the letter.
+    """
+    key_data = dict(data, date=convert_utc_to_bst(datetime.utcnow()).date().isoformat())
+    return '{}.pdf'.format(hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest())
+
+
+def copy_cached_letter_pdf(cache_key, file_location):
+    """
+    Copy the cached PDF for cache_key to file_location in the letters PDF bucket, without it leaving S3.
+    Returns its billable units, or None if it isn't cached.
+    """
+    cache_bucket_name = current_app.config['LETTERS_PDF_CACHE_BUCKET_NAME']
+    try:
+        billable_units = int(get_s3_object_metadata(cache_bucket_name, cache_key)['billable-units'])
+    except botocore.exceptions.ClientError as e:
+        if e.response['ResponseMetadata']['HTTPStatusCode'] != 404:
+            raise
+        statsd_client.incr('letters.pdf-cache.miss')
+        return None
+
+    copy_s3_object(cache_bucket_name, cache_key, current_app.config['LETTERS_PDF_BUCKET_NAME'], file_location)
+    record_letter_pdf_location(file_location)
+    statsd_client.incr('letters.pdf-cache.hit')
+    return billable_units
+
+
+def cache_letter_pdf(cache_key, file_location, billable_units):
+    """
+    Keep a copy of the PDF just uploaded to file_location for other letters with the same cache_key. Old PDFs
+    are expired by the cache bucket's lifecycle rules.
+    """
+    try:
+        copy_s3_object(
+            current_app.config['LETTERS_PDF_BUCKET_NAME'],
+            file_location,
+            current_app.config['LETTERS_PDF_CACHE_BUCKET_NAME'],
+            cache_key,
+            metadata={'billable-units': str(billable_units)}
+        )
+    except botocore.exceptions.ClientError:
+        current_app.logger.exception("Failed to cache letter PDF {} as {}".format(file_location, cache_key))
+
+
 def move_scanned_pdf_to_test_or_live_pdf_bucket(source_filename, is_test_letter=False):
     source_bucket_name = current_app.config['LETTERS_SCAN_BUCKET_NAME']
     target_bucket_config = 'TEST_LETTERS_BUCKET_NAME' if is_test_letter else 'LETTERS_PDF_BUCKET_NAME'
@@ -98,6 +257,7 @@ def move_scanned_pdf_to_test_or_live_pdf_bucket(source_filename, is_test_letter=
     target_filename = get_folder_name(datetime.utcnow(), is_test_letter) + source_filename
 
     _move_s3_object(source_bucket_name, source_filename, target_bucket_name, target_filename)
+    record_letter_pdf_location(target_filename)
 
 
 def move_failed_pdf(source_filename, scan_error_type):
@@ -116,7 +276,7 @@ def move_error_pdf_to_scan_bucket(source_filename):
 
 
 def get_file_names_from_error_bucket():
-    s3 = boto3.resource('s3')
+    s3 = get_s3_resource()
     scan_bucket = current_app.config['LETTERS_SCAN_BUCKET_NAME']
     bucket = s3.Bucket(scan_bucket)
 
@@ -130,33 +290,31 @@ def get_letter_pdf(notification):
     else:
         bucket_name = current_app.config['LETTERS_PDF_BUCKET_NAME']
 
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
+    location = redis_store.get(letter_pdf_location_cache_key(notification.reference))
+    if location:
+        try:
+            return get_s3_client().get_object(Bucket=bucket_name, Key=location.decode('utf-8'))["Body"].read()
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+
+    bucket = get_s3_resource().Bucket(bucket_name)
 
     item = next(x for x in bucket.objects.filter(
         Prefix=get_bucket_prefix_for_notification(notification, is_test_letter)
     ))
+    record_letter_pdf_location(item.key)
 
-    obj = s3.Object(
-        bucket_name=bucket_name,
-        key=item.key
-    )
-    return obj.get()["Body"].read()
+    return get_s3_client().get_object(Bucket=bucket_name, Key=item.key)["Body"].read()
 
 
 def _move_s3_object(source_bucket, source_filename, target_bucket, target_filename):
-    s3 = boto3.resource('s3')
-    copy_source = {'Bucket': source_bucket, 'Key': source_filename}
-
-    target_bucket = s3.Bucket(target_bucket)
-    obj = target_bucket.Object(target_filename)
-
     # Tags are copied across but the expiration time is reset in the destination bucket
     # e.g. if a file has 5 days left to expire on a ONE_WEEK retention in the source bucket,
     # in the destination bucket the expiration time will be reset to 7 days left to expire
-    obj.copy(copy_source, ExtraArgs={'ServerSideEncryption': 'AES256'})
+    copy_s3_object(source_bucket, source_filename, target_bucket, target_filename)
 
-    s3.Object(source_bucket, source_filename).delete()
+    remove_s3_object(source_bucket, source_filename)
 
     current_app.logger.info("Moved letter PDF: {}/{} to {}/{}".format(
         source_bucket, source_filename, target_bucket, target_filename))
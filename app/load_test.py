@@ -0,0 +1,298 @@
+"""
+An in-process load test of the whole send pipeline: the API, celery tasks and provider receipts.
+
+The API is served on a local port to a number of concurrent clients. Tasks go to an in-memory broker and are run by
+worker threads, and the research mode simulator stands in for the providers. SMS receipts from the simulator are
+held by a relay and fed back to the API at a fixed rate, so a backlog of receipts can be tested separately from the
+rate of sending.
+
+Letters are sent with a test key too, which skips creating the PDF, so they only count towards the API figures.
+"""
+import csv
+import io
+import queue
+import random
+import socket
+import threading
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime
+from time import monotonic, sleep
+
+import requests
+from flask import current_app
+from kombu import Consumer, Exchange, Queue
+from sqlalchemy import or_
+from notifications_python_client.authentication import create_jwt_token
+from werkzeug.serving import make_server
+
+from app import notify_celery
+from app.aws.s3 import upload_job_to_s3
+from app.config import QueueNames
+from app.dao.api_key_dao import expire_api_key, save_model_api_key
+from app.dao.templates_dao import dao_get_all_templates_for_service
+from app.models import (
+    ApiKey,
+    Notification,
+    EMAIL_TYPE,
+    KEY_TYPE_TEST,
+    LETTER_TYPE,
+    NOTIFICATION_STATUS_TYPES_COMPLETED,
+    SMS_TYPE,
+)
+
+NOTIFICATION_TYPES = (SMS_TYPE, EMAIL_TYPE, LETTER_TYPE)
+
+RECIPIENTS = {
+    SMS_TYPE: {'phone_number': '07700900001'},
+    EMAIL_TYPE: {'email_address': 'delivered@simulator.notify'},
+    LETTER_TYPE: {},
+}
+
+LETTER_ADDRESS = {'address_line_1': 'Load Test', 'address_line_2': '1 Test Street', 'postcode': 'SW1A 1AA'}
+
+
+class LoadTest:
+    """
+    Sends `notifications` for `service`, split between SMS, email and letters by the `mix` percentages, from
+    `clients` concurrent API clients. Uses a test key, so nothing is sent to a provider, billed or printed.
+
+    Also sends a CSV job of `job_rows` SMS if given. Jobs don't have an API key, so the service has to be in research
+    mode to keep them away from the providers.
+    """
+
+    def __init__(self, app, service, notifications, clients, mix, workers, receipt_rate, job_rows=0):
+        self.app = app
+        self.service = service
+        self.notifications = notifications
+        self.clients = clients
+        self.mix = mix
+        self.workers = workers
+        self.receipt_rate = receipt_rate
+        self.job_rows = job_rows
+
+        if receipt_rate <= 0:
+            raise Exception('Receipt rate must be more than 0')
+        if job_rows and not service.research_mode:
+            raise Exception('Service {} must be in research mode to load test jobs'.format(service.id))
+
+        self.templates = self._get_templates()
+        self.job_id = None
+        self.responses = []
+        self.receipts = queue.Queue()
+        self.stopping = threading.Event()
+
+    def run(self, drain_timeout=60):
+        original_config = {
+            key: current_app.config[key] for key in ('API_HOST_NAME', 'BROKER_URL', 'BROKER_TRANSPORT_OPTIONS')
+        }
+        notify_celery.conf.update(BROKER_URL='memory://', BROKER_TRANSPORT_OPTIONS={})
+
+        api_key = ApiKey(service=self.service, name='load test {}'.format(datetime.utcnow()), key_type=KEY_TYPE_TEST,
+                         created_by=self.service.created_by)
+        save_model_api_key(api_key)
+
+        api_server = make_server('localhost', 0, self.app, threaded=True)
+        relay_server = make_server('localhost', 0, self._receipt_relay, threaded=True)
+        api_url = 'http://localhost:{}'.format(api_server.server_port)
+        current_app.config['API_HOST_NAME'] = 'http://localhost:{}'.format(relay_server.server_port)
+
+        threads = [
+            threading.Thread(target=api_server.serve_forever),
+            threading.Thread(target=relay_server.serve_forever),
+            threading.Thread(target=self._feed_receipts, args=(api_url,)),
+        ] + [threading.Thread(target=self._work) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            start = monotonic()
+            if self.job_rows:
+                self._send_job(api_url)
+            self._send(api_url, api_key.secret)
+            sending_time = monotonic() - start
+
+            self._wait_for_completion(api_key.id, drain_timeout)
+            return self._report(api_key.id, sending_time, monotonic() - start)
+        finally:
+            self.stopping.set()
+            api_server.shutdown()
+            relay_server.shutdown()
+            expire_api_key(self.service.id, api_key.id)
+            current_app.config.update(original_config)
+            notify_celery.conf.update(original_config)
+
+    def _get_templates(self):
+        templates = {}
+        for template in dao_get_all_templates_for_service(self.service.id):
+            templates.setdefault(template.template_type, template)
+
+        for notification_type, percentage in zip(NOTIFICATION_TYPES, self.mix):
+            if percentage and notification_type not in templates:
+                raise Exception('Service {} has no {} template'.format(self.service.id, notification_type))
+        return templates
+
+    def _request_data(self, notification_type):
+        template = self.templates[notification_type]
+        personalisation = {
+            placeholder: 'load test' for placeholder in template._as_utils_template().placeholders
+        }
+        if notification_type == LETTER_TYPE:
+            personalisation.update(LETTER_ADDRESS)
+        return dict(RECIPIENTS[notification_type], template_id=str(template.id), personalisation=personalisation)
+
+    def _send(self, api_url, secret):
+        requests_data = {
+            notification_type: self._request_data(notification_type)
+            for notification_type, percentage in zip(NOTIFICATION_TYPES, self.mix) if percentage
+        }
+        notification_types = self._notification_types()
+        random.shuffle(notification_types)
+
+        def client(notification_types):
+            session = requests.Session()
+            for notification_type in notification_types:
+                start = monotonic()
+                response = session.post(
+                    '{}/v2/notifications/{}'.format(api_url, notification_type),
+                    json=requests_data[notification_type],
+                    headers={'Authorization': 'Bearer {}'.format(create_jwt_token(secret, str(self.service.id)))},
+                )
+                self.responses.append((notification_type, response.status_code, monotonic() - start))
+
+        clients = [
+            threading.Thread(target=client, args=(notification_types[i::self.clients],)) for i in range(self.clients)
+        ]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+
+    def _notification_types(self):
+        """
+        One notification type for each notification to send, split by the mix. The last type in the mix gets what's
+        left over from rounding down, so there are always exactly `notifications` of them.
+        """
+        shares = [
+            (notification_type, percentage)
+            for notification_type, percentage in zip(NOTIFICATION_TYPES, self.mix) if percentage
+        ]
+        notification_types = []
+        for notification_type, percentage in shares[:-1]:
+            notification_types += [notification_type] * (self.notifications * percentage // sum(self.mix))
+        notification_types += [shares[-1][0]] * (self.notifications - len(notification_types))
+        return notification_types
+
+    def _send_job(self, api_url):
+        """
+        Jobs are read from the CSV upload bucket, so unlike the rest of the test this needs access to S3.
+        """
+        template = self.templates[SMS_TYPE]
+        placeholders = list(template._as_utils_template().placeholders)
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['phone number'] + placeholders)
+        for _ in range(self.job_rows):
+            writer.writerow([RECIPIENTS[SMS_TYPE]['phone_number']] + ['load test'] * len(placeholders))
+
+        self.job_id = job_id = str(uuid.uuid4())
+        upload_job_to_s3(self.service.id, job_id, output.getvalue(), {
+            'template_id': str(template.id),
+            'original_file_name': 'load-test.csv',
+            'notification_count': str(self.job_rows),
+            'valid': 'True',
+        })
+        token = create_jwt_token(
+            current_app.config['ADMIN_CLIENT_SECRET'], current_app.config['ADMIN_CLIENT_USER_NAME']
+        )
+        response = requests.post(
+            '{}/service/{}/job'.format(api_url, self.service.id),
+            json={'id': job_id, 'created_by': str(self.service.created_by_id)},
+            headers={'Authorization': 'Bearer {}'.format(token)},
+        )
+        response.raise_for_status()
+
+    def _receipt_relay(self, environ, start_response):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        self.receipts.put((environ['PATH_INFO'], environ.get('CONTENT_TYPE'), environ['wsgi.input'].read(length)))
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [b'{"result": "success"}']
+
+    def _feed_receipts(self, api_url):
+        session = requests.Session()
+        next_at = monotonic()
+        while not self.stopping.is_set():
+            try:
+                path, content_type, body = self.receipts.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            sleep(max(0, next_at - monotonic()))
+            next_at = max(next_at, monotonic()) + 1 / self.receipt_rate
+            session.post(api_url + path, data=body, headers={'Content-Type': content_type})
+
+    def _work(self):
+        queues = [Queue(name, Exchange('default'), routing_key=name) for name in QueueNames.all_queues()]
+        with notify_celery.connection() as connection:
+            with Consumer(connection, queues=queues, callbacks=[self._run_task], accept=['json']):
+                while not self.stopping.is_set():
+                    try:
+                        connection.drain_events(timeout=0.5)
+                    except socket.timeout:
+                        pass
+
+    def _run_task(self, body, message):
+        notify_celery.tasks[body['task']].apply(args=body['args'], kwargs=body['kwargs'])
+        message.ack()
+
+    def _wait_for_completion(self, api_key_id, timeout):
+        give_up_at = monotonic() + timeout
+        while monotonic() < give_up_at:
+            incomplete = self._sent_notifications(api_key_id).filter(
+                Notification.notification_type != LETTER_TYPE,
+                Notification.status.notin_(NOTIFICATION_STATUS_TYPES_COMPLETED),
+            )
+            if not incomplete.count() and self.receipts.empty():
+                return
+            sleep(1)
+
+    def _sent_notifications(self, api_key_id):
+        if self.job_id:
+            return Notification.query.filter(or_(
+                Notification.api_key_id == api_key_id,
+                Notification.job_id == self.job_id,
+            ))
+        return Notification.query.filter(Notification.api_key_id == api_key_id)
+
+    def _report(self, api_key_id, sending_time, total_time):
+        latencies = defaultdict(list)
+        for notification_type, status_code, elapsed_time in self.responses:
+            latencies[notification_type].append(elapsed_time)
+
+        notifications = self._sent_notifications(api_key_id).all()
+        end_to_end = [
+            (notification.updated_at - notification.created_at).total_seconds()
+            for notification in notifications
+            if notification.notification_type != LETTER_TYPE
+            and notification.status in NOTIFICATION_STATUS_TYPES_COMPLETED
+        ]
+        return {
+            'requests': len(self.responses),
+            'requests_per_second': len(self.responses) / sending_time,
+            'response_codes': dict(Counter(status_code for _, status_code, _ in self.responses)),
+            'api_latency': {
+                notification_type: percentiles(values) for notification_type, values in latencies.items()
+            },
+            'notifications': len(notifications),
+            'statuses': dict(Counter(notification.status for notification in notifications)),
+            'completed_per_second': len(end_to_end) / total_time,
+            'end_to_end_latency': percentiles(end_to_end),
+        }
+
+
+def percentiles(values, percentiles=(50, 95, 99)):
+    values = sorted(values)
+    return {
+        'p{}'.format(percentile): values[max(0, -(-len(values) * percentile // 100) - 1)] if values else None
+        for percentile in percentiles
+    }
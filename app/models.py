@@ -1871,3 +1871,24 @@ class ServiceDataRetention(db.Model):
             "created_at": self.created_at.strftime(DATETIME_FORMAT),
             "updated_at": self.updated_at.strftime(DATETIME_FORMAT) if self.updated_at else None,
         }
+
+
+class LetterAck(db.Model):
+    """
+    A zip of letters that DVLA have acknowledged, and an ack file that said so.
+    """
+    __tablename__ = 'letter_acks'
+
+    zip_file_name = db.Column(db.String, primary_key=True)
+    ack_file_name = db.Column(db.String, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+class LetterAckFile(db.Model):
+    """
+    An ack file from DVLA that has been read into letter_acks, even if it didn't list any zips.
+    """
+    __tablename__ = 'letter_ack_files'
+
+    ack_file_name = db.Column(db.String, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
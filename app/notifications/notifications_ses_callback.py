@@ -5,7 +5,7 @@ from flask import (
     json
 )
 
-from app import statsd_client
+from app import notify_celery, statsd_client
 from app.clients.email.aws_ses import get_aws_responses
 from app.dao import (
     notifications_dao
@@ -15,7 +15,8 @@ from app.dao.notifications_dao import dao_get_notification_history_by_reference
 from app.dao.service_callback_api_dao import (
     get_service_delivery_status_callback_api_for_service, get_service_complaint_callback_api_for_service
 )
-from app.models import Complaint
+from app.models import Complaint, NOTIFICATION_DELIVERED
+from app.provider_details.delivery_latency import record_delivery_latency
 from app.notifications.process_client_response import validate_callback_data
 from app.celery.service_callback_tasks import (
     send_delivery_status_to_service,
@@ -81,11 +82,7 @@ def process_ses_response(ses_request):
                     notification.id))
             statsd_client.incr('callback.ses.{}'.format(notification_status))
             if notification.sent_at:
-                statsd_client.timing_with_dates(
-                    'callback.ses.elapsed-time'.format(client_name.lower()),
-                    datetime.utcnow(),
-                    notification.sent_at
-                )
+                _record_elapsed_time(notification, notification_status)
 
             _check_and_queue_callback_task(notification)
             return
@@ -150,13 +147,20 @@ def remove_emails_from_complaint(complaint_dict):
     return complaint_dict['mail'].pop('destination')
 
 
+def _record_elapsed_time(notification, notification_status):
+    now = datetime.utcnow()
+    statsd_client.timing_with_dates('callback.ses.elapsed-time', now, notification.sent_at)
+    if notification_status == NOTIFICATION_DELIVERED:
+        record_delivery_latency(notification.sent_by or 'ses', notification.sent_at, now)
+
+
 def _check_and_queue_callback_task(notification):
     # queue callback task only if the service_callback_api exists
     service_callback_api = get_service_delivery_status_callback_api_for_service(service_id=notification.service_id)
     if service_callback_api:
         notification_data = create_delivery_status_callback_data(notification, service_callback_api)
-        send_delivery_status_to_service.apply_async([str(notification.id), notification_data],
-                                                    queue=QueueNames.CALLBACKS)
+        notify_celery.publish(send_delivery_status_to_service, [str(notification.id), notification_data],
+                              queue=QueueNames.CALLBACKS)
 
 
 def _check_and_queue_complaint_callback_task(complaint, notification, recipient):
@@ -164,4 +168,4 @@ def _check_and_queue_complaint_callback_task(complaint, notification, recipient)
     service_callback_api = get_service_complaint_callback_api_for_service(service_id=notification.service_id)
     if service_callback_api:
         complaint_data = create_complaint_callback_data(complaint, notification, service_callback_api, recipient)
-        send_complaint_to_service.apply_async([complaint_data], queue=QueueNames.CALLBACKS)
+        notify_celery.publish(send_complaint_to_service, [complaint_data], queue=QueueNames.CALLBACKS)
@@ -3,7 +3,7 @@ import uuid
 from datetime import datetime
 from flask import current_app
 
-from app import statsd_client
+from app import notify_celery, statsd_client
 from app.clients import ClientException
 from app.dao import notifications_dao
 from app.clients.sms.firetext import get_firetext_responses
@@ -15,6 +15,8 @@ from app.celery.service_callback_tasks import (
 from app.config import QueueNames
 from app.dao.notifications_dao import dao_update_notification
 from app.dao.service_callback_api_dao import get_service_delivery_status_callback_api_for_service
+from app.models import NOTIFICATION_DELIVERED
+from app.provider_details.delivery_latency import record_delivery_latency
 
 sms_response_mapper = {
     'MMG': get_mmg_responses,
@@ -88,19 +90,22 @@ def _process_for_status(notification_status, client_name, provider_reference):
         set_notification_sent_by(notification, client_name.lower())
 
     if notification.sent_at:
+        now = datetime.utcnow()
         statsd_client.timing_with_dates(
             'callback.{}.elapsed-time'.format(client_name.lower()),
-            datetime.utcnow(),
+            now,
             notification.sent_at
         )
+        if notification_status == NOTIFICATION_DELIVERED:
+            record_delivery_latency(notification.sent_by, notification.sent_at, now)
 
     # queue callback task only if the service_callback_api exists
     service_callback_api = get_service_delivery_status_callback_api_for_service(service_id=notification.service_id)
 
     if service_callback_api:
         encrypted_notification = create_delivery_status_callback_data(notification, service_callback_api)
-        send_delivery_status_to_service.apply_async([str(notification.id), encrypted_notification],
-                                                    queue=QueueNames.CALLBACKS)
+        notify_celery.publish(send_delivery_status_to_service, [str(notification.id), encrypted_notification],
+                              queue=QueueNames.CALLBACKS)
 
     success = "{} callback succeeded. reference {} updated".format(client_name, provider_reference)
     return success
@@ -10,13 +10,14 @@ from notifications_utils.recipients import (
     format_email_address
 )
 
-from app import redis_store
+from app import instrumentation, redis_store
 from app.celery import provider_tasks
 from app.config import QueueNames
 
 from app.models import (
     EMAIL_TYPE,
     KEY_TYPE_TEST,
+    LETTER_TYPE,
     SMS_TYPE,
     NOTIFICATION_CREATED,
     Notification,
@@ -27,6 +28,7 @@ from app.dao.notifications_dao import (
     dao_delete_notifications_and_history_by_id,
     dao_created_scheduled_notification
 )
+from app.letters.utils import increment_letters_to_process
 
 from app.v2.errors import BadRequestError
 from app.utils import (
@@ -51,6 +53,7 @@ def check_placeholders(template_object):
         raise BadRequestError(fields=[{'template': message}], message=message)
 
 
+@instrumentation.span('persist')
 def persist_notification(
     *,
     template_id,
@@ -117,6 +120,9 @@ def persist_notification(
 
             increment_template_usage_cache(service.id, template_id, notification_created_at)
 
+            if notification_type == LETTER_TYPE and status == NOTIFICATION_CREATED:
+                increment_letters_to_process(notification)
+
         current_app.logger.info(
             "{} {} created at {}".format(notification_type, notification_id, notification_created_at)
         )
@@ -132,6 +138,7 @@ def increment_template_usage_cache(service_id, template_id, created_at):
     redis_store.expire(key, current_app.config['EXPIRE_CACHE_EIGHT_DAYS'])
 
 
+@instrumentation.span('publish')
 def send_notification_to_queue(notification, research_mode, queue=None):
     if research_mode or notification.key_type == KEY_TYPE_TEST:
         queue = QueueNames.RESEARCH_MODE
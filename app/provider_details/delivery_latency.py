@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from app import redis_store
+
+
+def record_delivery_latency(identifier, sent_at, delivered_at):
+    """
+    Count a delivery receipt in the provider's latency histogram for the current minute.
+
+    Latencies are held in whole seconds, rounded up to two significant figures, so every bucket is within 10%
+    of the latencies in it and a provider's histogram for a minute never has more than a couple of hundred fields.
+    """
+    if not current_app.config['REDIS_ENABLED'] or not sent_at:
+        return
+
+    key = _delivery_latency_cache_key(identifier, delivered_at)
+    redis_store.increment_hash_value(key, _bucket_for(delivered_at - sent_at))
+    redis_store.expire(key, (current_app.config['DELIVERY_LATENCY_WINDOW_MINUTES'] + 1) * 60)
+
+
+def get_delivery_latency_percentiles(identifier, since=None, percentiles=(50, 95, 99)):
+    """
+    Percentiles, in seconds, of the time from sent to delivered for the provider's receipts over the last
+    DELIVERY_LATENCY_WINDOW_MINUTES, or only the whole minutes after `since` if that is later.
+
+    Returns a dict with the number of receipts as 'count' and 'p50', 'p95' etc, which are None when there
+    were no receipts.
+    """
+    histogram = _get_delivery_latency_histogram(identifier, since)
+    count = sum(histogram.values())
+
+    result = {'count': count}
+    for percentile in percentiles:
+        result['p{}'.format(percentile)] = _percentile(histogram, count, percentile)
+    return result
+
+
+def _get_delivery_latency_histogram(identifier, since):
+    histogram = {}
+    if not current_app.config['REDIS_ENABLED']:
+        return histogram
+
+    now = datetime.utcnow()
+    for minutes_ago in range(current_app.config['DELIVERY_LATENCY_WINDOW_MINUTES']):
+        minute = (now - timedelta(minutes=minutes_ago)).replace(second=0, microsecond=0)
+        if since and minute < since:
+            break
+        buckets = redis_store.get_all_from_hash(_delivery_latency_cache_key(identifier, minute)) or {}
+        for bucket, count in buckets.items():
+            histogram[int(bucket)] = histogram.get(int(bucket), 0) + int(count)
+    return histogram
+
+
+def _percentile(histogram, count, percentile):
+    if not count:
+        return None
+
+    rank = count * percentile / 100
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            return bucket
+
+
+def _bucket_for(latency):
+    seconds = max(0, int(latency.total_seconds()))
+    step = 1
+    while seconds >= step * 100:
+        step *= 10
+    return -(-seconds // step) * step
+
+
+def _delivery_latency_cache_key(identifier, when):
+    return 'delivery-latency-{}-{}'.format(identifier, when.strftime('%Y-%m-%dT%H:%M'))
@@ -8,6 +8,7 @@ from app.dao.provider_details_dao import (
     dao_get_provider_versions
 )
 from app.dao.users_dao import get_user_by_id
+from app.provider_details.delivery_latency import get_delivery_latency_percentiles
 from app.errors import (
     register_errors,
     InvalidRequest
@@ -39,6 +40,12 @@ def get_provider_versions(provider_details_id):
     return jsonify(data=data)
 
 
+@provider_details.route('/<uuid:provider_details_id>/delivery-latency', methods=['GET'])
+def get_provider_delivery_latency(provider_details_id):
+    provider = get_provider_details_by_id(provider_details_id)
+    return jsonify(data=get_delivery_latency_percentiles(provider.identifier))
+
+
 @provider_details.route('/<uuid:provider_details_id>', methods=['POST'])
 def update_provider_details(provider_details_id):
     valid_keys = {'priority', 'created_by', 'active'}
@@ -0,0 +1,201 @@
+import random
+from datetime import datetime, timedelta
+from time import monotonic, time
+
+from flask import current_app
+
+from app import redis_store, statsd_client
+from app.provider_details.delivery_latency import get_delivery_latency_percentiles
+
+PROVIDER_ROUTING_VERSION_CACHE_KEY = 'provider-routing-version'
+
+# (notification_type, international) -> (identifiers of active providers in priority order, loaded at)
+_routing_table = {}
+_version = {'value': None, 'checked_at': None}
+
+# provider identifier -> (health between SMS_PROVIDER_MIN_HEALTH and 1, loaded at)
+_sms_provider_health = {}
+
+
+def get_active_provider_identifiers(notification_type, international=False):
+    """
+    Identifiers of the active providers for a notification type, highest priority first.
+
+    Held in process for PROVIDER_ROUTING_CACHE_TTL_SECONDS. Every provider change bumps a version key in redis,
+    which is checked at most every PROVIDER_ROUTING_VERSION_CHECK_SECONDS, so a switch reaches every worker
+    within seconds without a query to provider_details for each message sent.
+    """
+    ttl = current_app.config['PROVIDER_ROUTING_CACHE_TTL_SECONDS']
+    if not ttl:
+        return _load_active_provider_identifiers(notification_type, international)
+
+    _clear_if_version_changed()
+
+    key = (notification_type, international)
+    cached = _routing_table.get(key)
+    if cached is None or monotonic() - cached[1] >= ttl:
+        cached = (_load_active_provider_identifiers(notification_type, international), monotonic())
+        _routing_table[key] = cached
+    return cached[0]
+
+
+def invalidate_provider_routing():
+    _routing_table.clear()
+    redis_store.incr(PROVIDER_ROUTING_VERSION_CACHE_KEY)
+
+
+def _clear_if_version_changed():
+    checked_at = _version['checked_at']
+    check_every = current_app.config['PROVIDER_ROUTING_VERSION_CHECK_SECONDS']
+    if checked_at is not None and monotonic() - checked_at < check_every:
+        return
+
+    version = redis_store.get(PROVIDER_ROUTING_VERSION_CACHE_KEY)
+    if version != _version['value']:
+        _routing_table.clear()
+        _version['value'] = version
+    _version['checked_at'] = monotonic()
+
+
+def _load_active_provider_identifiers(notification_type, international):
+    # imported here as the provider details dao invalidates this cache
+    from app.dao.provider_details_dao import get_provider_details_by_notification_type
+
+    return [
+        provider.identifier
+        for provider in get_provider_details_by_notification_type(notification_type, international)
+        if provider.active
+    ]
+
+
+def choose_sms_provider(active_identifiers):
+    """
+    Pick a provider for a domestic SMS from the active providers, splitting traffic by SMS_PROVIDER_WEIGHTS
+    scaled by each provider's recent health. A provider that has reached its SMS_PROVIDER_RATE_LIMITS ceiling
+    for the current second is skipped in favour of the others.
+    """
+    weights = {
+        identifier: current_app.config['SMS_PROVIDER_WEIGHTS'].get(identifier, 0) * get_sms_provider_health(identifier)
+        for identifier in active_identifiers
+    }
+    candidates = [identifier for identifier in active_identifiers if weights[identifier] > 0]
+    if not candidates:
+        return active_identifiers[0]
+
+    remaining = list(candidates)
+    while remaining:
+        identifier = _weighted_choice(remaining, [weights[i] for i in remaining])
+        if not _sms_provider_over_rate_limit(identifier):
+            _record_sms_provider_request(identifier)
+            return identifier
+        remaining.remove(identifier)
+
+    current_app.logger.warning("All SMS providers are over their rate limits")
+    statsd_client.incr("sms.providers-over-rate-limit")
+    identifier = max(candidates, key=weights.get)
+    _record_sms_provider_request(identifier)
+    return identifier
+
+
+def record_sms_provider_outcome(identifier, success, elapsed_time):
+    """
+    Count requests, errors and slow requests per provider for the current minute, for get_sms_provider_health.
+    """
+    if not current_app.config['REDIS_ENABLED']:
+        return
+
+    key = _sms_provider_health_cache_key(identifier, datetime.utcnow())
+    redis_store.increment_hash_value(key, 'requests')
+    if not success:
+        redis_store.increment_hash_value(key, 'errors')
+    if elapsed_time >= current_app.config['SMS_PROVIDER_SLOW_REQUEST_SECONDS']:
+        redis_store.increment_hash_value(key, 'slow')
+    redis_store.expire(key, (current_app.config['SMS_PROVIDER_HEALTH_WINDOW_MINUTES'] + 1) * 60)
+
+
+def get_sms_provider_health(identifier):
+    """
+    Between SMS_PROVIDER_MIN_HEALTH and 1: the share of requests to the provider over the last few minutes
+    that neither failed nor were slow, where slow requests count half, scaled down further when the provider's
+    delivery receipts show it is slow to deliver. Held in process for a few seconds, so weights move gradually
+    as errors or latency build up rather than flipping on one bad request.
+    """
+    cached = _sms_provider_health.get(identifier)
+    if cached is None or monotonic() - cached[1] >= current_app.config['SMS_PROVIDER_HEALTH_REFRESH_SECONDS']:
+        cached = (_load_sms_provider_health(identifier), monotonic())
+        _sms_provider_health[identifier] = cached
+    return cached[0]
+
+
+def _load_sms_provider_health(identifier):
+    if not current_app.config['REDIS_ENABLED']:
+        return 1
+
+    health = _request_health(identifier) * _delivery_health(identifier)
+    return max(current_app.config['SMS_PROVIDER_MIN_HEALTH'], health)
+
+
+def _request_health(identifier):
+    now = datetime.utcnow()
+    totals = {'requests': 0, 'errors': 0, 'slow': 0}
+    for minutes_ago in range(current_app.config['SMS_PROVIDER_HEALTH_WINDOW_MINUTES']):
+        counts = redis_store.get_all_from_hash(
+            _sms_provider_health_cache_key(identifier, now - timedelta(minutes=minutes_ago))
+        ) or {}
+        for field, count in counts.items():
+            field = field.decode('utf-8') if isinstance(field, bytes) else field
+            if field in totals:
+                totals[field] += int(count)
+
+    if totals['requests'] < current_app.config['SMS_PROVIDER_HEALTH_MIN_REQUESTS']:
+        return 1
+
+    return 1 - (totals['errors'] + totals['slow'] / 2) / totals['requests']
+
+
+def _delivery_health(identifier):
+    # a provider whose deliveries are slower than SLOW_DELIVERY_THRESHOLD_SECONDS loses weight in proportion,
+    # so it is shed gradually before switch_current_sms_provider_on_slow_delivery switches away from it
+    percentile = current_app.config['SLOW_DELIVERY_PERCENTILE']
+    latency = get_delivery_latency_percentiles(identifier, percentiles=(percentile,))
+    delivery_time = latency['p{}'.format(percentile)]
+    threshold = current_app.config['SLOW_DELIVERY_THRESHOLD_SECONDS']
+
+    if latency['count'] < current_app.config['SLOW_DELIVERY_MIN_RECEIPTS'] or delivery_time <= threshold:
+        return 1
+    return threshold / delivery_time
+
+
+def _weighted_choice(identifiers, weights):
+    # random.choices is only available from python 3.6
+    point = random.uniform(0, sum(weights))
+    for identifier, weight in zip(identifiers, weights):
+        point -= weight
+        if point < 0:
+            return identifier
+    return identifiers[-1]
+
+
+def _sms_provider_over_rate_limit(identifier):
+    # only reads the count, so a provider that is passed over doesn't use up its limit
+    limit = current_app.config['SMS_PROVIDER_RATE_LIMITS'].get(identifier)
+    if not limit or not current_app.config['REDIS_ENABLED']:
+        return False
+    count = redis_store.get(_sms_provider_rate_limit_cache_key(identifier))
+    return count is not None and int(count) >= limit
+
+
+def _record_sms_provider_request(identifier):
+    if identifier not in current_app.config['SMS_PROVIDER_RATE_LIMITS'] or not current_app.config['REDIS_ENABLED']:
+        return
+    key = _sms_provider_rate_limit_cache_key(identifier)
+    redis_store.incr(key)
+    redis_store.expire(key, 2)
+
+
+def _sms_provider_rate_limit_cache_key(identifier):
+    return 'sms-provider-rate-limit-{}-{}'.format(identifier, int(time()))
+
+
+def _sms_provider_health_cache_key(identifier, when):
+    return 'sms-provider-health-{}-{}'.format(identifier, when.strftime('%Y-%m-%dT%H:%M'))
@@ -7,7 +7,10 @@ from jsonschema import (Draft4Validator, ValidationError, FormatChecker)
 from notifications_utils.recipients import (validate_phone_number, validate_email_address, InvalidPhoneError,
                                             InvalidEmailError)
 
+from app import instrumentation
 
+
+@instrumentation.span('validation')
 def validate(json_to_validate, schema):
     format_checker = FormatChecker()
 
@@ -1,4 +1,6 @@
 import base64
+import hashlib
+import json
 from io import BytesIO
 
 import botocore
@@ -7,12 +9,14 @@ from flask import (
     Blueprint,
     current_app,
     jsonify,
-    request)
+    request,
+    Response)
 from notifications_utils import SMS_CHAR_COUNT_LIMIT
 from notifications_utils.pdf import extract_page_from_pdf
 from notifications_utils.template import SMSMessageTemplate
 from requests import post as requests_post
 
+from app import redis_store
 from app.dao.notifications_dao import get_notification_by_id
 from app.dao.services_dao import dao_fetch_service_by_id
 from app.dao.templates_dao import (
@@ -143,7 +147,9 @@ def preview_template_by_id_and_service_id(service_id, template_id):
 
     data['subject'], data['content'] = template_object.subject, str(template_object)
 
-    return jsonify(data)
+    response = jsonify(data)
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @template_blueprint.route('/<uuid:template_id>/version/<int:version>')
@@ -199,65 +205,98 @@ def preview_letter_template_by_notification_id(service_id, notification_id, file
     template = dao_get_template_by_id(notification.template_id)
 
     if template.is_precompiled_letter:
-        try:
+        # the PDF sent for a precompiled letter never changes
+        data = {'notification_id': str(notification.id)}
+    else:
+        data = _get_letter_preview_data(service_id, notification, template)
+
+    # everything the preview is made from, so a change to the template or the service's organisation gets
+    # a new preview rather than one cached for the old letter
+    etag = hashlib.sha256(
+        json.dumps({'data': data, 'file_type': file_type, 'page': page}, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    cache_key = 'letter-preview-{}-{}'.format(notification_id, etag)
+    content = redis_store.get(cache_key)
+    if content:
+        content = content.decode('utf-8')
+    else:
+        if template.is_precompiled_letter:
+            content = _get_precompiled_letter_preview(notification, file_type, page)
+        else:
+            url = '{}/preview.{}{}'.format(
+                current_app.config['TEMPLATE_PREVIEW_API_HOST'],
+                file_type,
+                '?page={}'.format(page) if page else ''
+            )
+            content = _get_png_preview(url, data, notification.id, json=True)
+        if len(content) <= current_app.config['LETTER_PREVIEW_CACHE_MAX_BYTES']:
+            redis_store.set(cache_key, content, ex=current_app.config['LETTER_PREVIEW_CACHE_SECONDS'])
 
-            pdf_file = get_letter_pdf(notification)
+    response = jsonify({"content": content})
+    response.set_etag(etag)
+    return response
 
-        except botocore.exceptions.ClientError as e:
-            raise InvalidRequest(
-                'Error extracting requested page from PDF file for notification_id {} type {} {}'.format(
-                    notification_id, type(e), e),
-                status_code=500
-            )
 
-        content = base64.b64encode(pdf_file).decode('utf-8')
+def _get_letter_preview_data(service_id, notification, template):
+    template_for_letter_print = {
+        "id": str(notification.template_id),
+        "subject": template.subject,
+        "content": template.content,
+        "version": str(template.version)
+    }
 
-        if file_type == 'png':
-            try:
-                page_number = page if page else "1"
+    service = dao_fetch_service_by_id(service_id)
 
-                pdf_page = extract_page_from_pdf(BytesIO(pdf_file), int(page_number) - 1)
-                content = base64.b64encode(pdf_page).decode('utf-8')
-            except PdfReadError as e:
-                raise InvalidRequest(
-                    'Error extracting requested page from PDF file for notification_id {} type {} {}'.format(
-                        notification_id, type(e), e),
-                    status_code=500
-                )
+    return {
+        'letter_contact_block': notification.reply_to_text,
+        'template': template_for_letter_print,
+        'values': notification.personalisation,
+        'date': notification.created_at.isoformat(),
+        'dvla_org_id': service.dvla_organisation_id,
+    }
 
-            url = '{}/precompiled-preview.png{}'.format(
-                current_app.config['TEMPLATE_PREVIEW_API_HOST'],
-                '?hide_notify=true' if page_number == '1' else ''
-            )
 
-            content = _get_png_preview(url, content, notification.id, json=False)
-    else:
+def _get_precompiled_letter_preview(notification, file_type, page):
+    try:
+
+        pdf_file = get_letter_pdf(notification)
 
-        template_for_letter_print = {
-            "id": str(notification.template_id),
-            "subject": template.subject,
-            "content": template.content,
-            "version": str(template.version)
-        }
+    except botocore.exceptions.ClientError as e:
+        raise InvalidRequest(
+            'Error extracting requested page from PDF file for notification_id {} type {} {}'.format(
+                notification.id, type(e), e),
+            status_code=500
+        )
 
-        service = dao_fetch_service_by_id(service_id)
+    content = base64.b64encode(pdf_file).decode('utf-8')
 
-        data = {
-            'letter_contact_block': notification.reply_to_text,
-            'template': template_for_letter_print,
-            'values': notification.personalisation,
-            'date': notification.created_at.isoformat(),
-            'dvla_org_id': service.dvla_organisation_id,
-        }
+    if file_type == 'png':
+        try:
+            page_number = page if page else "1"
 
-        url = '{}/preview.{}{}'.format(
+            pdf_page = extract_page_from_pdf(BytesIO(pdf_file), int(page_number) - 1)
+            content = base64.b64encode(pdf_page).decode('utf-8')
+        except PdfReadError as e:
+            raise InvalidRequest(
+                'Error extracting requested page from PDF file for notification_id {} type {} {}'.format(
+                    notification.id, type(e), e),
+                status_code=500
+            )
+
+        url = '{}/precompiled-preview.png{}'.format(
             current_app.config['TEMPLATE_PREVIEW_API_HOST'],
-            file_type,
-            '?page={}'.format(page) if page else ''
+            '?hide_notify=true' if page_number == '1' else ''
         )
-        content = _get_png_preview(url, data, notification.id, json=True)
 
-    return jsonify({"content": content})
+        content = _get_png_preview(url, content, notification.id, json=False)
+
+    return content
 
 
 def _get_png_preview(url, data, notification_id, json=True):
@@ -1,6 +1,4 @@
-import base64
 import functools
-import io
 import math
 
 import werkzeug
@@ -14,7 +12,7 @@ from app.config import QueueNames, TaskNames
 from app.dao.notifications_dao import dao_update_notification, update_notification_status_by_reference
 from app.dao.templates_dao import dao_create_template
 from app.dao.users_dao import get_user_by_id
-from app.letters.utils import upload_letter_pdf
+from app.letters.utils import decode_letter_content, upload_letter_pdf
 from app.models import (
     Template,
     SMS_TYPE,
@@ -292,21 +290,29 @@ def process_letter_notification(*, letter_data, api_key, template, reply_to_text
 def process_precompiled_letter_notifications(*, letter_data, api_key, template, reply_to_text):
     try:
         status = NOTIFICATION_PENDING_VIRUS_CHECK
-        letter_content = base64.b64decode(letter_data['content'])
-        pages = pdf_page_count(io.BytesIO(letter_content))
+        letter_file = decode_letter_content(letter_data['content'])
     except ValueError:
         raise BadRequestError(message='Cannot decode letter content (invalid base64 encoding)', status_code=400)
-    except PdfReadError:
-        current_app.logger.exception(msg='Invalid PDF received')
-        raise BadRequestError(message='Letter content is not a valid PDF', status_code=400)
 
-    notification = create_letter_notification(letter_data=letter_data,
-                                              template=template,
-                                              api_key=api_key,
-                                              status=status,
-                                              reply_to_text=reply_to_text)
+    with letter_file:
+        try:
+            # only reads the PDF's trailer, cross-reference table and page tree, not every page
+            pages = pdf_page_count(letter_file)
+        except ValueError:
+            raise BadRequestError(message='Cannot decode letter content (invalid base64 encoding)', status_code=400)
+        except PdfReadError:
+            current_app.logger.exception(msg='Invalid PDF received')
+            raise BadRequestError(message='Letter content is not a valid PDF', status_code=400)
+        letter_file.seek(0)
+
+        notification = create_letter_notification(letter_data=letter_data,
+                                                  template=template,
+                                                  api_key=api_key,
+                                                  status=status,
+                                                  reply_to_text=reply_to_text)
+
+        filename = upload_letter_pdf(notification, letter_file, precompiled=True)
 
-    filename = upload_letter_pdf(notification, letter_content, precompiled=True)
     pages_per_sheet = 2
     notification.billable_units = math.ceil(pages / pages_per_sheet)
 
@@ -0,0 +1,85 @@
+"""
+Benchmarks for the notification send pipeline, and for how long the API and celery take to start. These run
+against the same local test database as the unit tests, with redis disabled, celery publishing mocked out and the
+loadtesting client standing in for the SMS providers.
+
+    make benchmark
+
+saves each run's results as JSON under .benchmarks/ and compares them with the previous run.
+"""
+import pytest
+import requests_mock
+
+from app import db, loadtest_client
+from app.models import ProviderDetails, EMAIL_TYPE, LETTER_TYPE, SMS_TYPE
+from app.provider_details.routing import invalidate_provider_routing
+
+from tests.app.conftest import celery_producer  # noqa: F401
+from tests.app.db import create_service, create_template
+from tests.conftest import client, notify_api, notify_db, notify_db_session, set_config  # noqa: F401
+
+
+@pytest.fixture(autouse=True)
+def redis_disabled(notify_api):  # noqa: F811
+    with set_config(notify_api, 'REDIS_ENABLED', False):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def mock_queues(mocker):
+    for task in [
+        'app.celery.provider_tasks.deliver_sms',
+        'app.celery.provider_tasks.deliver_email',
+        'app.celery.tasks.save_sms',
+        'app.celery.tasks.save_email',
+        'app.celery.letters_pdf_tasks.create_letters_pdf',
+        'app.celery.letters_pdf_tasks.create_letters_pdf_batch',
+        'app.celery.service_callback_tasks.send_delivery_status_to_service',
+    ]:
+        mocker.patch('{}.apply_async'.format(task))
+
+
+@pytest.fixture
+def service(notify_db_session):  # noqa: F811
+    return create_service(
+        service_name='Benchmark service',
+        service_permissions=[EMAIL_TYPE, SMS_TYPE, LETTER_TYPE],
+        message_limit=10000000,
+    )
+
+
+@pytest.fixture
+def templates(service):
+    return {
+        SMS_TYPE: create_template(service, template_type=SMS_TYPE, content='Hello ((name)), your code is ((code))'),
+        EMAIL_TYPE: create_template(service, template_type=EMAIL_TYPE, content='Hello ((name)), your code is ((code))'),
+        LETTER_TYPE: create_template(service, template_type=LETTER_TYPE, content='Hello ((name))'),
+    }
+
+
+@pytest.fixture
+def loadtesting_provider(notify_api, notify_db_session):  # noqa: F811
+    """
+    Route SMS to the loadtesting client, with its API answered in process, for the length of the benchmark.
+    provider_details isn't emptied between tests, so the original priorities are put back afterwards.
+    """
+    providers = ProviderDetails.query.filter_by(notification_type=SMS_TYPE).all()
+    priorities = {provider.id: provider.priority for provider in providers}
+    for provider in providers:
+        provider.priority = 0 if provider.identifier == loadtest_client.name else provider.priority + 100
+    db.session.commit()
+    invalidate_provider_routing()
+
+    with requests_mock.Mocker() as request_mock:
+        request_mock.post(loadtest_client.url, json={
+            'data': [],
+            'description': 'SMS successfully queued',
+            'code': 0,
+            'responseData': 1
+        })
+        yield loadtest_client
+
+    for provider in ProviderDetails.query.filter_by(notification_type=SMS_TYPE).all():
+        provider.priority = priorities[provider.id]
+    db.session.commit()
+    invalidate_provider_routing()
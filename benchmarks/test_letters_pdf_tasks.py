@@ -0,0 +1,65 @@
+import threading
+from time import sleep
+
+import pytest
+from werkzeug.serving import make_server
+
+from app.celery.letters_pdf_tasks import create_letters_pdf, create_letters_pdf_batch
+from app.models import LETTER_TYPE
+
+from tests.app.db import create_notification
+from tests.conftest import set_config
+
+LETTERS = 50
+
+# roughly how long template preview takes to render a one page letter
+RENDER_SECONDS = 0.05
+
+
+@pytest.fixture
+def template_preview(notify_api, mocker):
+    """
+    A stub of template preview on a local port, which waits RENDER_SECONDS and returns a two page PDF. Uploads to
+    S3 are mocked out.
+    """
+    def print_pdf(environ, start_response):
+        environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        sleep(RENDER_SECONDS)
+        start_response('200 OK', [('Content-Type', 'application/pdf'), ('X-pdf-page-count', '2')])
+        return [b'%PDF-1.4 load test']
+
+    server = make_server('localhost', 0, print_pdf, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    mocker.patch('app.celery.letters_pdf_tasks.s3.s3upload')
+    mocker.patch('app.letters.utils.s3upload')
+
+    with set_config(notify_api, 'TEMPLATE_PREVIEW_API_HOST', 'http://localhost:{}'.format(server.server_port)):
+        yield
+    server.shutdown()
+
+
+def _letters(template):
+    def setup():
+        notifications = [
+            create_notification(template, personalisation={'name': 'Jo'}) for _ in range(LETTERS)
+        ]
+        return ([str(notification.id) for notification in notifications],), {}
+    return setup
+
+
+@pytest.mark.benchmark(group='create-letters-pdf')
+def test_create_letters_pdf(benchmark, template_preview, templates):
+    def create(notification_ids):
+        for notification_id in notification_ids:
+            create_letters_pdf(notification_id)
+
+    benchmark.extra_info['letters_per_round'] = LETTERS
+    benchmark.pedantic(create, setup=_letters(templates[LETTER_TYPE]), rounds=3)
+
+
+@pytest.mark.benchmark(group='create-letters-pdf')
+def test_create_letters_pdf_batch(benchmark, template_preview, templates):
+    benchmark.extra_info['letters_per_round'] = LETTERS
+    benchmark.pedantic(create_letters_pdf_batch, setup=_letters(templates[LETTER_TYPE]), rounds=3)
@@ -0,0 +1,38 @@
+import pytest
+from flask import json
+
+from app.models import EMAIL_TYPE, LETTER_TYPE, SMS_TYPE
+
+from tests import create_authorization_header
+
+REQUESTS = {
+    SMS_TYPE: {'phone_number': '+447700900855'},
+    EMAIL_TYPE: {'email_address': 'benchmark@digital.cabinet-office.gov.uk'},
+    LETTER_TYPE: {},
+}
+
+PERSONALISATION = {
+    SMS_TYPE: {'name': 'Jo', 'code': '123456'},
+    EMAIL_TYPE: {'name': 'Jo', 'code': '123456'},
+    LETTER_TYPE: {'name': 'Jo', 'address_line_1': 'Jo Smith', 'address_line_2': '1 Street', 'postcode': 'SW1 1AA'},
+}
+
+
+@pytest.mark.benchmark(group='post-notification')
+@pytest.mark.parametrize('notification_type', [SMS_TYPE, EMAIL_TYPE, LETTER_TYPE])
+def test_post_notification(benchmark, client, service, templates, notification_type):
+    data = json.dumps(dict(
+        REQUESTS[notification_type],
+        template_id=str(templates[notification_type].id),
+        personalisation=PERSONALISATION[notification_type],
+    ))
+
+    def post_notification():
+        response = client.post(
+            '/v2/notifications/{}'.format(notification_type),
+            data=data,
+            headers=[('Content-Type', 'application/json'), create_authorization_header(service_id=service.id)]
+        )
+        assert response.status_code == 201, response.get_data(as_text=True)
+
+    benchmark(post_notification)
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+import pytest
+
+from app.models import Notification, SMS_TYPE
+from app.notifications.process_client_response import process_sms_client_response
+
+from tests.app.db import create_notification
+
+RECEIPTS = 100
+
+
+@pytest.mark.benchmark(group='receipts')
+def test_process_sms_client_response(benchmark, templates):
+    template = templates[SMS_TYPE]
+
+    def setup():
+        notifications = [
+            create_notification(template, status='sending', sent_by='firetext', sent_at=datetime.utcnow())
+            for _ in range(RECEIPTS)
+        ]
+        return ([str(notification.id) for notification in notifications],), {}
+
+    def process_receipts(references):
+        for reference in references:
+            process_sms_client_response(status='0', provider_reference=reference, client_name='Firetext')
+
+    benchmark.extra_info['receipts_per_round'] = RECEIPTS
+    benchmark.pedantic(process_receipts, setup=setup, rounds=5)
+
+    assert Notification.query.filter_by(status='sending').count() == 0
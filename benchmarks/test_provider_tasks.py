@@ -0,0 +1,29 @@
+import pytest
+
+from app.celery.provider_tasks import deliver_sms
+from app.models import Notification, SMS_TYPE
+
+from tests.app.db import create_notification
+
+NOTIFICATIONS = 100
+
+
+@pytest.mark.benchmark(group='deliver')
+def test_deliver_sms(benchmark, loadtesting_provider, templates):
+    template = templates[SMS_TYPE]
+
+    def setup():
+        notifications = [
+            create_notification(template, to_field='+447700900855', personalisation={'name': 'Jo', 'code': '1'})
+            for _ in range(NOTIFICATIONS)
+        ]
+        return ([str(notification.id) for notification in notifications],), {}
+
+    def deliver(notification_ids):
+        for notification_id in notification_ids:
+            deliver_sms(notification_id)
+
+    benchmark.extra_info['tasks_per_round'] = NOTIFICATIONS
+    benchmark.pedantic(deliver, setup=setup, rounds=5)
+
+    assert Notification.query.filter_by(status='created').count() == 0
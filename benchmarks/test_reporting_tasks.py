@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.celery.reporting_tasks import create_nightly_billing
+from app.models import EMAIL_TYPE, SMS_TYPE
+
+from tests.app.db import create_notification, create_rate
+
+NOTIFICATIONS_PER_DAY = 500
+DAYS = 3
+
+
+@pytest.mark.benchmark(group='billing')
+def test_create_nightly_billing(benchmark, templates):
+    create_rate(start_date=datetime(2016, 1, 1), value=0.0158, notification_type=SMS_TYPE)
+    today = datetime.utcnow().replace(hour=12, minute=0, second=0, microsecond=0)
+    for days_ago in range(1, DAYS + 1):
+        for i in range(NOTIFICATIONS_PER_DAY):
+            create_notification(
+                templates[SMS_TYPE if i % 2 else EMAIL_TYPE],
+                status='delivered',
+                sent_by='mmg' if i % 2 else 'ses',
+                created_at=today - timedelta(days=days_ago),
+                billable_units=1,
+            )
+
+    benchmark.extra_info['notifications'] = NOTIFICATIONS_PER_DAY * DAYS
+    benchmark.pedantic(create_nightly_billing, rounds=3)
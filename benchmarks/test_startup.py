@@ -0,0 +1,13 @@
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.mark.benchmark(group='startup')
+@pytest.mark.parametrize('module', ['application', 'run_celery'])
+def test_cold_start(benchmark, module):
+    """
+    Time a new python process importing the API or celery entry point, as happens for each worker on a scale-up.
+    """
+    benchmark.pedantic(subprocess.check_call, args=([sys.executable, '-c', 'import {}'.format(module)],), rounds=5)
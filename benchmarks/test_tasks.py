@@ -0,0 +1,23 @@
+import pytest
+
+from app.celery.tasks import process_job
+from app.models import SMS_TYPE
+
+from tests.app.db import create_job
+
+ROWS = 1000
+
+
+@pytest.mark.benchmark(group='process-job')
+def test_process_job(benchmark, mocker, templates):
+    template = templates[SMS_TYPE]
+    csv = 'phone number,name,code\n' + ''.join(
+        '+4477009{:05},Jo,{}\n'.format(row, row) for row in range(ROWS)
+    )
+    mocker.patch('app.celery.tasks.s3.get_job_from_s3', return_value=csv)
+
+    def setup():
+        return (str(create_job(template, notification_count=ROWS).id),), {}
+
+    benchmark.extra_info['rows_per_round'] = ROWS
+    benchmark.pedantic(process_job, setup=setup, rounds=5)
@@ -0,0 +1,33 @@
+"""
+
+Revision ID: 0214_letter_acks
+Revises: 0213_brand_colour_domain
+Create Date: 2018-08-20 10:12:32.128431
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0214_letter_acks'
+down_revision = '0213_brand_colour_domain'
+
+
+def upgrade():
+    op.create_table(
+        'letter_acks',
+        sa.Column('zip_file_name', sa.String(), nullable=False),
+        sa.Column('ack_file_name', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('zip_file_name', 'ack_file_name')
+    )
+    op.create_table(
+        'letter_ack_files',
+        sa.Column('ack_file_name', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('ack_file_name')
+    )
+
+
+def downgrade():
+    op.drop_table('letter_ack_files')
+    op.drop_table('letter_acks')
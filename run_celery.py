@@ -7,5 +7,5 @@ from app import notify_celery, create_app  # noqa
 
 
 application = Flask('delivery')
-create_app(application)
+create_app(application, register_routes=False)
 application.app_context().push()
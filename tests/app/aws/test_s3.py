@@ -1,3 +1,4 @@
+import io
 from unittest.mock import call
 from datetime import datetime, timedelta
 import pytest
@@ -7,13 +8,19 @@ from flask import current_app
 from freezegun import freeze_time
 
 from app.aws.s3 import (
+    delete_s3_objects,
     get_s3_bucket_objects,
+    iter_s3_bucket_objects,
     get_s3_file,
     filter_s3_bucket_objects_within_date_range,
     remove_transformed_dvla_file,
     get_list_of_files_by_suffix,
+    get_s3_client,
+    get_s3_resource,
+    s3upload,
 )
 from tests.app.conftest import datetime_in_past
+from tests.conftest import set_config
 
 
 def single_s3_object_stub(key='foo', last_modified=datetime.utcnow()):
@@ -25,29 +32,31 @@ def single_s3_object_stub(key='foo', last_modified=datetime.utcnow()):
 
 
 def test_get_s3_file_makes_correct_call(notify_api, mocker):
-    get_s3_mock = mocker.patch('app.aws.s3.get_s3_object')
-    get_s3_file('foo-bucket', 'bar-file.txt')
+    client = mocker.patch('app.aws.s3.get_s3_client').return_value
+    client.get_object.return_value['Body'].read.return_value = b'file contents'
 
-    get_s3_mock.assert_called_with(
-        'foo-bucket',
-        'bar-file.txt'
+    assert get_s3_file('foo-bucket', 'bar-file.txt') == 'file contents'
+
+    client.get_object.assert_called_with(
+        Bucket='foo-bucket',
+        Key='bar-file.txt'
     )
 
 
 def test_remove_transformed_dvla_file_makes_correct_call(notify_api, mocker):
-    s3_mock = mocker.patch('app.aws.s3.get_s3_object')
+    client = mocker.patch('app.aws.s3.get_s3_client').return_value
     fake_uuid = '5fbf9799-6b9b-4dbb-9a4e-74a939f3bb49'
 
     remove_transformed_dvla_file(fake_uuid)
 
-    s3_mock.assert_has_calls([
-        call(current_app.config['DVLA_BUCKETS']['job'], '{}-dvla-job.text'.format(fake_uuid)),
-        call().delete()
-    ])
+    client.delete_object.assert_called_once_with(
+        Bucket=current_app.config['DVLA_BUCKETS']['job'],
+        Key='{}-dvla-job.text'.format(fake_uuid)
+    )
 
 
 def test_get_s3_bucket_objects_make_correct_pagination_call(notify_api, mocker):
-    paginator_mock = mocker.patch('app.aws.s3.client')
+    paginator_mock = mocker.patch('app.aws.s3.get_s3_client')
 
     get_s3_bucket_objects('foo-bucket', subfolder='bar')
 
@@ -58,7 +67,7 @@ def test_get_s3_bucket_objects_make_correct_pagination_call(notify_api, mocker):
 
 def test_get_s3_bucket_objects_builds_objects_list_from_paginator(notify_api, mocker):
     AFTER_SEVEN_DAYS = datetime_in_past(days=8)
-    paginator_mock = mocker.patch('app.aws.s3.client')
+    paginator_mock = mocker.patch('app.aws.s3.get_s3_client')
     multiple_pages_s3_object = [
         {
             "Contents": [
@@ -79,6 +88,25 @@ def test_get_s3_bucket_objects_builds_objects_list_from_paginator(notify_api, mo
     assert set(bucket_objects[0].keys()) == set(['ETag', 'Key', 'LastModified'])
 
 
+def test_iter_s3_bucket_objects_lists_pages_as_they_are_needed(notify_api, mocker):
+    paginator_mock = mocker.patch('app.aws.s3.get_s3_client')
+    pages = iter([
+        {"Contents": [single_s3_object_stub('bar/foo.txt'), single_s3_object_stub('bar/foo1.txt')]},
+        {},
+        {"Contents": [single_s3_object_stub('bar/foo2.txt')]},
+    ])
+    paginator_mock.return_value.get_paginator.return_value.paginate.return_value = pages
+
+    bucket_objects = iter_s3_bucket_objects('foo-bucket', subfolder='bar')
+
+    assert next(bucket_objects)['Key'] == 'bar/foo.txt'
+    assert next(bucket_objects)['Key'] == 'bar/foo1.txt'
+    # the last page hasn't been fetched yet
+    assert next(pages) == {}
+    assert next(bucket_objects)['Key'] == 'bar/foo2.txt'
+    assert next(bucket_objects, None) is None
+
+
 @freeze_time("2016-01-01 11:00:00")
 def test_get_s3_bucket_objects_removes_redundant_root_object(notify_api, mocker):
     AFTER_SEVEN_DAYS = datetime_in_past(days=8)
@@ -152,7 +180,7 @@ def test_get_s3_bucket_objects_does_not_return_outside_of_date_range(notify_api,
     ('', 1, 1),
 ])
 def test_get_list_of_files_by_suffix(notify_api, mocker, suffix_str, days_before, returned_no):
-    paginator_mock = mocker.patch('app.aws.s3.client')
+    paginator_mock = mocker.patch('app.aws.s3.get_s3_client')
     multiple_pages_s3_object = [
         {
             "Contents": [
@@ -178,7 +206,7 @@ def test_get_list_of_files_by_suffix(notify_api, mocker, suffix_str, days_before
 
 
 def test_get_list_of_files_by_suffix_empty_contents_return_with_no_error(notify_api, mocker):
-    paginator_mock = mocker.patch('app.aws.s3.client')
+    paginator_mock = mocker.patch('app.aws.s3.get_s3_client')
     multiple_pages_s3_object = [
         {
             "other_content": [
@@ -190,3 +218,100 @@ def test_get_list_of_files_by_suffix_empty_contents_return_with_no_error(notify_
     key = get_list_of_files_by_suffix('foo-bucket', subfolder='bar', suffix='.pdf')
 
     assert sum(1 for x in key) == 0
+
+
+def test_get_s3_client_is_made_once_per_process(notify_api, mocker):
+    session = mocker.patch('app.aws.s3.boto3.session.Session')
+    mock_incr = mocker.patch('app.aws.s3.statsd_client.incr')
+
+    assert get_s3_client() == session.return_value.client.return_value
+    assert get_s3_client() == session.return_value.client.return_value
+
+    assert session.return_value.client.call_count == 1
+    mock_incr.assert_called_once_with('clients.s3.created')
+
+
+def test_get_s3_client_sends_reuse_count_at_most_every_interval(notify_api, mocker):
+    mocker.patch('app.aws.s3.boto3.session.Session')
+    mocker.patch('app.aws.s3.monotonic', side_effect=[100, 110, 130, 160, 160, 170])
+    mock_incr = mocker.patch('app.aws.s3.statsd_client.incr')
+
+    with set_config(notify_api, 'S3_CLIENT_STATS_INTERVAL_SECONDS', 60):
+        for _ in range(5):
+            get_s3_client()
+
+    assert mock_incr.call_args_list == [
+        call('clients.s3.created'),
+        call('clients.s3.reused', count=3),
+    ]
+
+
+def test_get_s3_client_is_made_again_in_a_new_process(notify_api, mocker):
+    session = mocker.patch('app.aws.s3.boto3.session.Session')
+    mocker.patch('app.aws.s3.os.getpid', side_effect=[100, 100, 101, 101])
+
+    get_s3_client()
+    get_s3_client()
+
+    assert session.return_value.client.call_count == 2
+
+
+def test_get_s3_resource_is_not_shared(notify_api, mocker):
+    session = mocker.patch('app.aws.s3.boto3.session.Session')
+
+    get_s3_resource()
+    get_s3_resource()
+
+    assert session.return_value.resource.call_count == 2
+
+
+def test_s3upload_puts_data_with_the_shared_client(notify_api, mocker):
+    client = mocker.patch('app.aws.s3.get_s3_client').return_value
+
+    s3upload(b'data', 'eu-west-1', 'foo-bucket', 'bar-file.txt', tags={'a': 'b'})
+
+    client.put_object.assert_called_once_with(
+        Bucket='foo-bucket', Key='bar-file.txt', Body=b'data', ServerSideEncryption='AES256',
+        ContentType='binary/octet-stream', Tagging='a=b'
+    )
+
+
+def test_s3upload_uploads_files_in_parts_with_the_shared_client(notify_api, mocker):
+    client = mocker.patch('app.aws.s3.get_s3_client').return_value
+    file = io.BytesIO(b'data')
+
+    s3upload(file, 'eu-west-1', 'foo-bucket', 'bar-file.txt')
+
+    client.upload_fileobj.assert_called_once_with(
+        file, 'foo-bucket', 'bar-file.txt',
+        ExtraArgs={'ServerSideEncryption': 'AES256', 'ContentType': 'binary/octet-stream'}
+    )
+
+
+def test_delete_s3_objects_deletes_in_batches_of_1000(notify_api, mocker):
+    client = mocker.patch('app.aws.s3.get_s3_client').return_value
+    client.delete_objects.return_value = {}
+    keys = ['file-{}'.format(i) for i in range(1001)]
+
+    assert delete_s3_objects('foo-bucket', keys) == []
+
+    assert client.delete_objects.call_count == 2
+    first_batch = client.delete_objects.call_args_list[0][1]
+    assert first_batch['Bucket'] == 'foo-bucket'
+    assert first_batch['Delete']['Objects'][0] == {'Key': 'file-0'}
+    assert len(first_batch['Delete']['Objects']) == 1000
+    assert client.delete_objects.call_args_list[1][1]['Delete']['Objects'] == [{'Key': 'file-1000'}]
+
+
+def test_delete_s3_objects_returns_keys_that_were_not_deleted(notify_api, mocker):
+    client = mocker.patch('app.aws.s3.get_s3_client').return_value
+    client.delete_objects.return_value = {'Errors': [{'Key': 'file-1', 'Code': 'AccessDenied', 'Message': 'no'}]}
+
+    assert delete_s3_objects('foo-bucket', ['file-0', 'file-1']) == ['file-1']
+
+
+def test_delete_s3_objects_does_nothing_without_keys(notify_api, mocker):
+    client = mocker.patch('app.aws.s3.get_s3_client').return_value
+
+    assert delete_s3_objects('foo-bucket', []) == []
+    assert not client.delete_objects.called
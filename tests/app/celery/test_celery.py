@@ -0,0 +1,149 @@
+from unittest.mock import call
+
+import pytest
+
+from app import instrumentation, notify_celery
+from app.celery.celery import add_published_at
+from app.celery.provider_tasks import deliver_email, deliver_sms
+
+from tests.conftest import set_config, set_config_values
+
+
+@pytest.fixture
+def small_batches(notify_api):
+    with set_config_values(notify_api, {
+        'PUBLISH_BATCH_SIZE': 2,
+        'PUBLISH_BATCH_MAX_SECONDS': 1,
+    }):
+        yield
+
+
+def test_publish_sends_straight_away_outside_batch_publishing(notify_api, mocker, celery_producer):
+    mock_apply_async = mocker.patch('app.celery.provider_tasks.deliver_sms.apply_async')
+
+    notify_celery.publish(deliver_sms, ['1'], queue='send-sms-tasks', countdown=5)
+
+    mock_apply_async.assert_called_once_with(['1'], queue='send-sms-tasks', countdown=5)
+    assert not notify_celery.producer_or_acquire.called
+
+
+def test_batch_publishing_sends_on_exit_with_one_producer(notify_api, mocker, celery_producer):
+    mock_sms = mocker.patch('app.celery.provider_tasks.deliver_sms.apply_async')
+    mock_email = mocker.patch('app.celery.provider_tasks.deliver_email.apply_async')
+
+    with notify_celery.batch_publishing():
+        notify_celery.publish(deliver_sms, ['1'], queue='send-sms-tasks')
+        notify_celery.publish(deliver_email, ['2'], queue='send-email-tasks')
+        assert not mock_sms.called
+        assert not mock_email.called
+
+    mock_sms.assert_called_once_with(['1'], queue='send-sms-tasks', producer=celery_producer)
+    mock_email.assert_called_once_with(['2'], queue='send-email-tasks', producer=celery_producer)
+
+
+def test_batch_publishing_sends_when_batch_is_full(small_batches, mocker, celery_producer):
+    mock_sms = mocker.patch('app.celery.provider_tasks.deliver_sms.apply_async')
+
+    with notify_celery.batch_publishing():
+        for notification_id in ['1', '2', '3']:
+            notify_celery.publish(deliver_sms, [notification_id], queue='send-sms-tasks')
+        assert mock_sms.call_args_list == [
+            call(['1'], queue='send-sms-tasks', producer=celery_producer),
+            call(['2'], queue='send-sms-tasks', producer=celery_producer),
+        ]
+
+    assert mock_sms.call_count == 3
+
+
+def test_batch_publishing_sends_when_oldest_message_has_waited_too_long(notify_api, mocker):
+    mock_sms = mocker.patch('app.celery.provider_tasks.deliver_sms.apply_async')
+    mocker.patch('app.celery.celery.time.monotonic', side_effect=[0, 0, 2, 2, 2, 2])
+
+    with notify_celery.batch_publishing():
+        notify_celery.publish(deliver_sms, ['1'], queue='send-sms-tasks')
+        assert not mock_sms.called
+        notify_celery.publish(deliver_sms, ['2'], queue='send-sms-tasks')
+        assert mock_sms.call_count == 2
+
+
+def test_nested_batch_publishing_sends_on_outer_exit(notify_api, mocker):
+    mock_sms = mocker.patch('app.celery.provider_tasks.deliver_sms.apply_async')
+
+    with notify_celery.batch_publishing():
+        with notify_celery.batch_publishing():
+            notify_celery.publish(deliver_sms, ['1'], queue='send-sms-tasks')
+        assert not mock_sms.called
+
+    assert mock_sms.call_count == 1
+
+
+def test_batch_publishing_records_batch_metrics(notify_api, mocker):
+    mocker.patch('app.celery.provider_tasks.deliver_sms.apply_async')
+    mock_incr = mocker.patch('app.statsd_client.incr')
+    mock_timing = mocker.patch('app.statsd_client.timing')
+
+    with notify_celery.batch_publishing():
+        notify_celery.publish(deliver_sms, ['1'], queue='send-sms-tasks')
+        notify_celery.publish(deliver_sms, ['2'], queue='send-sms-tasks')
+
+    assert mock_incr.call_args_list == [
+        call('celery.publish.send-sms-tasks.messages', count=2),
+        call('celery.publish.send-sms-tasks.batches'),
+    ]
+    assert mock_timing.call_args[0][0] == 'celery.publish.send-sms-tasks.elapsed-time'
+
+
+def test_publish_by_name_is_batched(notify_api, mocker, celery_producer):
+    mock_send_task = mocker.patch('app.notify_celery.send_task')
+
+    with notify_celery.batch_publishing():
+        notify_celery.publish_by_name('zip-and-send-letter-pdfs', queue='process-ftp-tasks', kwargs={'a': 1})
+        assert not mock_send_task.called
+
+    mock_send_task.assert_called_once_with(
+        name='zip-and-send-letter-pdfs', queue='process-ftp-tasks', kwargs={'a': 1}, producer=celery_producer
+    )
+
+
+def test_add_published_at_stamps_message_body(mocker):
+    mocker.patch('app.celery.celery.time.time', return_value=1000)
+    body = {'task': 'deliver-sms', 'args': ['1']}
+
+    add_published_at(body=body)
+
+    assert body['notify_published_at'] == 1000
+
+
+def test_notify_task_records_queue_wait_and_time_breakdown(notify_api, mocker):
+    mock_timing = mocker.patch('app.statsd_client.timing')
+    mock_incr = mocker.patch('app.statsd_client.incr')
+    mocker.patch('app.celery.celery.time.time', return_value=1010)
+
+    @notify_celery.task(name='instrumented-test-task')
+    def instrumented_test_task():
+        instrumentation.record('db', 0.5)
+        instrumentation.record('db', 0.25)
+
+    instrumented_test_task.push_request(notify_published_at=1000)
+    try:
+        instrumented_test_task()
+    finally:
+        instrumented_test_task.pop_request()
+
+    mock_timing.assert_any_call('celery.instrumented-test-task.queue-wait', 10)
+    mock_timing.assert_any_call('celery.instrumented-test-task.db-time', 0.75)
+    mock_incr.assert_any_call('celery.instrumented-test-task.db-calls', count=2)
+
+
+def test_notify_task_logs_profile_when_sampled(notify_api, mocker):
+    log_profile = mocker.patch('app.celery.celery.instrumentation.log_profile_if_slow')
+
+    @notify_celery.task(name='profiled-test-task')
+    def profiled_test_task():
+        pass
+
+    with set_config(notify_api, 'TASK_PROFILING_SAMPLE_RATE', 1):
+        profiled_test_task()
+
+    assert log_profile.call_args[0][0] is not None
+    assert log_profile.call_args[0][1] == 'profiled-test-task'
@@ -21,12 +21,14 @@ from app.celery.tasks import (
     get_billing_date_in_bst_from_filename,
     persist_daily_sorted_letter_counts,
     process_updates_from_file,
+    record_letter_ack_file,
     update_dvla_job_to_error,
     update_letter_notifications_statuses,
     update_letter_notifications_to_error,
     update_letter_notifications_to_sent_to_dvla
 )
 from app.dao.daily_sorted_letter_dao import dao_get_daily_sorted_letter_by_billing_day
+from app.dao.letter_ack_dao import dao_get_acked_zip_file_names
 
 from tests.app.db import create_notification, create_service_callback_api
 from tests.conftest import set_config
@@ -35,7 +37,7 @@ from tests.conftest import set_config
 @pytest.fixture
 def notification_update():
     """
-    Returns a namedtuple to use as the argument for the check_billable_units function
+    Returns a namedtuple to put in the list passed to the check_billable_units function
     """
     NotificationUpdate = namedtuple('NotificationUpdate', ['reference', 'status', 'page_count', 'cost_threshold'])
     return NotificationUpdate('REFERENCE_ABC', 'sent', '1', 'cost')
@@ -133,13 +135,13 @@ def test_update_letter_notifications_statuses_still_raises_temp_failure_error_wi
 
 
 def test_update_letter_notifications_statuses_calls_with_correct_bucket_location(notify_api, mocker):
-    s3_mock = mocker.patch('app.celery.tasks.s3.get_s3_object')
+    s3_mock = mocker.patch('app.celery.tasks.s3.get_s3_client').return_value
 
     with set_config(notify_api, 'NOTIFY_EMAIL_DOMAIN', 'foo.bar'):
         update_letter_notifications_statuses(filename='NOTIFY-20170823160812-RSP.TXT')
-        s3_mock.assert_called_with('{}-ftp'.format(
-            current_app.config['NOTIFY_EMAIL_DOMAIN']),
-            'NOTIFY-20170823160812-RSP.TXT'
+        s3_mock.get_object.assert_called_with(
+            Bucket='{}-ftp'.format(current_app.config['NOTIFY_EMAIL_DOMAIN']),
+            Key='NOTIFY-20170823160812-RSP.TXT'
         )
 
 
@@ -297,7 +299,7 @@ def test_check_billable_units_when_billable_units_matches_page_count(
 
     create_notification(sample_letter_template, reference='REFERENCE_ABC', billable_units=1)
 
-    check_billable_units(notification_update)
+    check_billable_units([notification_update])
 
     mock_logger.assert_not_called()
 
@@ -312,13 +314,46 @@ def test_check_billable_units_when_billable_units_does_not_match_page_count(
 
     notification = create_notification(sample_letter_template, reference='REFERENCE_ABC', billable_units=3)
 
-    check_billable_units(notification_update)
+    check_billable_units([notification_update])
 
     mock_logger.assert_called_once_with(
         'Notification with id {} had 3 billable_units but a page count of 1'.format(notification.id)
     )
 
 
+def test_check_billable_units_uses_notification_history_and_ignores_missing_notifications(
+    client,
+    sample_letter_template,
+    mocker,
+    notification_update
+):
+    mock_logger = mocker.patch('app.celery.tasks.current_app.logger.exception')
+    mock_warning = mocker.patch('app.celery.tasks.current_app.logger.warning')
+    notification = create_notification(sample_letter_template, reference='REFERENCE_ABC', billable_units=3)
+    Notification.query.filter_by(id=notification.id).delete()
+
+    check_billable_units([notification_update, notification_update._replace(reference='REFERENCE_XYZ')])
+
+    mock_logger.assert_called_once_with(
+        'Notification with id {} had 3 billable_units but a page count of 1'.format(notification.id)
+    )
+    mock_warning.assert_called_once_with('Notification with reference REFERENCE_XYZ not found to check billable units')
+
+
+def test_update_letter_notifications_statuses_logs_references_not_found(notify_api, mocker, sample_letter_template):
+    create_notification(sample_letter_template, reference='ref-foo', status=NOTIFICATION_SENDING, billable_units=1)
+    valid_file = 'ref-foo|Sent|1|Unsorted\nref-bar|Sent|1|Unsorted\nref-baz|Sent|1|Sorted'
+    mocker.patch('app.celery.tasks.s3.get_s3_file', return_value=valid_file)
+    mock_logger = mocker.patch('app.celery.tasks.current_app.logger.error')
+
+    update_letter_notifications_statuses(filename='NOTIFY-20170823160812-RSP.TXT')
+
+    mock_logger.assert_called_once_with(
+        "Update letter notification file NOTIFY-20170823160812-RSP.TXT failed: notifications not found "
+        "for references ['ref-bar', 'ref-baz']"
+    )
+
+
 @pytest.mark.parametrize('filename_date, billing_date', [
     ('20170820230000', date(2017, 8, 21)),
     ('20170120230000', date(2017, 1, 20))
@@ -338,3 +373,19 @@ def test_persist_daily_sorted_letter_counts_saves_sorted_and_unsorted_values(cli
 
     assert day.unsorted_count == 5
     assert day.sorted_count == 1
+
+
+def test_record_letter_ack_file_records_each_zip(notify_api, notify_db_session, mocker):
+    mock_get_file = mocker.patch('app.celery.tasks.s3.get_s3_file', return_value=(
+        'NOTIFY.20180111175007.ZIP|20180111175733\n'
+        'notify.20180111175008.zip|20180111175734\n'
+    ))
+
+    record_letter_ack_file('root/dispatch/NOTIFY.20180111175733.ACK.txt')
+
+    mock_get_file.assert_called_once_with(
+        current_app.config['DVLA_RESPONSE_BUCKET_NAME'], 'root/dispatch/NOTIFY.20180111175733.ACK.txt'
+    )
+    assert dao_get_acked_zip_file_names({
+        'NOTIFY.20180111175007.ZIP', 'NOTIFY.20180111175008.ZIP', 'NOTIFY.20180111175009.ZIP'
+    }) == {'NOTIFY.20180111175007.ZIP', 'NOTIFY.20180111175008.ZIP'}
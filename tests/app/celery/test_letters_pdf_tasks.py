@@ -1,8 +1,13 @@
+import json
+from datetime import date
+
+import boto3
 from flask import current_app
 
-from unittest.mock import call
+from unittest.mock import ANY, call
 
 from freezegun import freeze_time
+from moto import mock_s3
 import pytest
 import requests_mock
 from botocore.exceptions import ClientError
@@ -13,10 +18,12 @@ from sqlalchemy.orm.exc import NoResultFound
 from app.errors import VirusScanError
 from app.celery.letters_pdf_tasks import (
     create_letters_pdf,
+    create_letters_pdf_batch,
+    get_template_preview_session,
     get_letters_pdf,
     collate_letter_pdfs_for_day,
     group_letters,
-    letter_in_created_state,
+    letters_in_created_state,
     process_virus_scan_passed,
     process_virus_scan_failed,
     process_virus_scan_error, replay_letters_in_error
@@ -32,7 +39,8 @@ from app.models import (
     NOTIFICATION_SENDING,
     NOTIFICATION_TECHNICAL_FAILURE)
 
-from tests.conftest import set_config_values
+from tests.app.db import create_notification
+from tests.conftest import set_config, set_config_values
 
 
 def test_should_have_decorated_tasks_functions():
@@ -124,6 +132,37 @@ def test_create_letters_pdf_sets_billable_units(mocker, sample_letter_notificati
     assert noti.billable_units == 1
 
 
+@freeze_time("2017-12-04 17:31:00")
+def test_create_letters_pdf_copies_cached_pdf(notify_api, mocker, sample_letter_notification):
+    mock_copy = mocker.patch('app.celery.letters_pdf_tasks.copy_cached_letter_pdf', return_value=3)
+    mock_get_letters_pdf = mocker.patch('app.celery.letters_pdf_tasks.get_letters_pdf')
+    mock_s3 = mocker.patch('app.letters.utils.s3upload')
+
+    with set_config(notify_api, 'LETTERS_PDF_CACHE_ENABLED', True):
+        create_letters_pdf(sample_letter_notification.id)
+
+    mock_copy.assert_called_once_with(ANY, get_letter_pdf_filename(
+        reference=sample_letter_notification.reference,
+        crown=sample_letter_notification.service.crown
+    ))
+    assert not mock_get_letters_pdf.called
+    assert not mock_s3.called
+    assert sample_letter_notification.billable_units == 3
+
+
+def test_create_letters_pdf_caches_pdf_it_renders(notify_api, mocker, sample_letter_notification):
+    mocker.patch('app.celery.letters_pdf_tasks.copy_cached_letter_pdf', return_value=None)
+    mocker.patch('app.celery.letters_pdf_tasks.get_letters_pdf', return_value=(b'\x00\x01', 1))
+    mock_s3 = mocker.patch('app.letters.utils.s3upload')
+    mock_cache = mocker.patch('app.celery.letters_pdf_tasks.cache_letter_pdf')
+
+    with set_config(notify_api, 'LETTERS_PDF_CACHE_ENABLED', True):
+        create_letters_pdf(sample_letter_notification.id)
+
+    mock_cache.assert_called_once_with(ANY, mock_s3.call_args[1]['file_location'], 1)
+    assert sample_letter_notification.billable_units == 1
+
+
 def test_create_letters_pdf_non_existent_notification(notify_api, mocker, fake_uuid):
     with pytest.raises(expected_exception=NoResultFound):
         create_letters_pdf(fake_uuid)
@@ -170,8 +209,151 @@ def test_create_letters_pdf_sets_technical_failure_max_retries(mocker, sample_le
     mock_update_noti.assert_called_once_with(sample_letter_notification.id, 'technical-failure')
 
 
+def test_get_template_preview_session_is_reused(notify_api):
+    assert get_template_preview_session() is get_template_preview_session()
+
+
+@freeze_time("2017-12-04 17:31:00")
+def test_create_letters_pdf_batch_uploads_pdfs_and_sets_billable_units(notify_api, mocker, sample_letter_template):
+    notifications = [
+        create_notification(sample_letter_template, reference=reference, personalisation={'name': 'Jo'})
+        for reference in ['ref1', 'ref2']
+    ]
+    mock_s3 = mocker.patch('app.celery.letters_pdf_tasks.s3.s3upload')
+    mock_record_location = mocker.patch('app.celery.letters_pdf_tasks.record_letter_pdf_location')
+
+    with set_config_values(notify_api, {
+        'TEMPLATE_PREVIEW_API_HOST': 'http://localhost/notifications-template-preview',
+        'TEMPLATE_PREVIEW_API_KEY': 'test-key'
+    }):
+        with requests_mock.Mocker() as request_mock:
+            mock_post = request_mock.post(
+                'http://localhost/notifications-template-preview/print.pdf',
+                content=b'\x00\x01',
+                headers={'X-pdf-page-count': '3'},
+                status_code=200
+            )
+
+            create_letters_pdf_batch([str(notification.id) for notification in notifications])
+
+    assert mock_post.call_count == 2
+    assert mock_post.last_request.json()['template'] == {
+        'subject': sample_letter_template.subject,
+        'content': sample_letter_template.content,
+    }
+    assert sorted(kwargs['file_location'] for _, kwargs in mock_s3.call_args_list) == [
+        get_letter_pdf_filename(reference, sample_letter_template.service.crown) for reference in ['ref1', 'ref2']
+    ]
+    assert sorted(args[0] for args, _ in mock_record_location.call_args_list) == sorted(
+        kwargs['file_location'] for _, kwargs in mock_s3.call_args_list
+    )
+    for notification in notifications:
+        assert notification.billable_units == 2
+
+
+def test_create_letters_pdf_batch_hands_failed_letters_to_create_letters_pdf(
+        notify_api, mocker, sample_letter_template
+):
+    sent = create_notification(sample_letter_template, reference='sent')
+    failed = create_notification(sample_letter_template, reference='failed')
+
+    def create_letter_pdf(letter):
+        if letter['reference'] == 'failed':
+            raise RequestException()
+        return 1
+
+    mocker.patch('app.celery.letters_pdf_tasks._create_letter_pdf', side_effect=create_letter_pdf)
+    mock_create_letters_pdf = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf.apply_async')
+
+    create_letters_pdf_batch([str(sent.id), str(failed.id)])
+
+    mock_create_letters_pdf.assert_called_once_with([str(failed.id)], queue='retry-tasks')
+    assert sent.billable_units == 1
+    assert failed.billable_units == 0
+
+
+def test_create_letters_pdf_batch_skips_letters_no_longer_created(notify_api, mocker, sample_letter_template):
+    created = create_notification(sample_letter_template, reference='created')
+    cancelled = create_notification(sample_letter_template, reference='cancelled', status='cancelled')
+    mock_create_letter_pdf = mocker.patch('app.celery.letters_pdf_tasks._create_letter_pdf', return_value=1)
+    mock_retry = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf_batch.retry')
+
+    create_letters_pdf_batch([str(created.id), str(cancelled.id)])
+
+    assert [args[0]['reference'] for args, _ in mock_create_letter_pdf.call_args_list] == ['created']
+    assert created.billable_units == 1
+    assert cancelled.billable_units == 0
+    assert not mock_retry.called
+
+
+def test_create_letters_pdf_batch_copies_cached_pdfs(notify_api, mocker, sample_letter_notification):
+    mock_copy = mocker.patch('app.celery.letters_pdf_tasks.copy_cached_letter_pdf', return_value=3)
+    mock_render = mocker.patch('app.celery.letters_pdf_tasks.render_letters_pdf')
+    mock_s3 = mocker.patch('app.celery.letters_pdf_tasks.s3.s3upload')
+
+    with set_config(notify_api, 'LETTERS_PDF_CACHE_ENABLED', True):
+        create_letters_pdf_batch([str(sample_letter_notification.id)])
+
+    assert mock_copy.called
+    assert not mock_render.called
+    assert not mock_s3.called
+    assert sample_letter_notification.billable_units == 3
+
+
+def test_create_letters_pdf_batch_caches_pdfs_it_renders(notify_api, mocker, sample_letter_notification):
+    mocker.patch('app.celery.letters_pdf_tasks.copy_cached_letter_pdf', return_value=None)
+    mocker.patch('app.celery.letters_pdf_tasks.render_letters_pdf', return_value=(b'\x00\x01', 1))
+    mock_s3 = mocker.patch('app.celery.letters_pdf_tasks.s3.s3upload')
+    mock_cache = mocker.patch('app.celery.letters_pdf_tasks.cache_letter_pdf')
+
+    with set_config(notify_api, 'LETTERS_PDF_CACHE_ENABLED', True):
+        create_letters_pdf_batch([str(sample_letter_notification.id)])
+
+    mock_cache.assert_called_once_with(ANY, mock_s3.call_args[1]['file_location'], 1)
+
+
+def test_create_letters_pdf_batch_retries_letters_not_saved_yet(mocker, sample_letter_notification, fake_uuid):
+    mocker.patch('app.celery.letters_pdf_tasks.render_letters_pdf', return_value=(b'\x00\x01', 1))
+    mocker.patch('app.celery.letters_pdf_tasks.s3.s3upload')
+    mock_retry = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf_batch.retry')
+
+    create_letters_pdf_batch([str(sample_letter_notification.id), fake_uuid])
+
+    mock_retry.assert_called_once_with(args=[[fake_uuid]], queue='retry-tasks')
+    assert sample_letter_notification.billable_units == 1
+
+
+def test_create_letters_pdf_batch_hands_letters_never_saved_to_create_letters_pdf(
+    mocker, sample_letter_notification, fake_uuid
+):
+    mocker.patch('app.celery.letters_pdf_tasks.render_letters_pdf', return_value=(b'\x00\x01', 1))
+    mocker.patch('app.celery.letters_pdf_tasks.s3.s3upload')
+    mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf_batch.retry', side_effect=MaxRetriesExceededError)
+    mock_create = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf.apply_async')
+
+    create_letters_pdf_batch([str(sample_letter_notification.id), fake_uuid])
+
+    mock_create.assert_called_once_with([fake_uuid], queue='retry-tasks')
+
+
+def test_create_letters_pdf_batch_queues_letters_past_batch_size_as_another_batch(
+    notify_api, mocker, sample_letter_template
+):
+    notifications = [create_notification(sample_letter_template, reference='ref{}'.format(i)) for i in range(3)]
+    notification_ids = [str(notification.id) for notification in notifications]
+    mocker.patch('app.celery.letters_pdf_tasks.render_letters_pdf', return_value=(b'\x00\x01', 1))
+    mock_upload = mocker.patch('app.celery.letters_pdf_tasks.s3.s3upload')
+    mock_next_batch = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf_batch.apply_async')
+
+    with set_config(notify_api, 'CREATE_LETTERS_PDF_BATCH_SIZE', 2):
+        create_letters_pdf_batch(notification_ids)
+
+    assert mock_upload.call_count == 2
+    mock_next_batch.assert_called_once_with([notification_ids[2:]], queue='create-letters-pdf-tasks')
+
+
 def test_collate_letter_pdfs_for_day(notify_api, mocker):
-    mock_s3 = mocker.patch('app.celery.tasks.s3.get_s3_bucket_objects')
+    mock_s3 = mocker.patch('app.celery.tasks.s3.iter_s3_bucket_objects')
     mock_group_letters = mocker.patch('app.celery.letters_pdf_tasks.group_letters', return_value=[
         [{'Key': 'A.PDF', 'Size': 1}, {'Key': 'B.pDf', 'Size': 2}],
         [{'Key': 'C.pdf', 'Size': 3}]
@@ -186,18 +368,80 @@ def test_collate_letter_pdfs_for_day(notify_api, mocker):
         name='zip-and-send-letter-pdfs',
         kwargs={'filenames_to_zip': ['A.PDF', 'B.pDf']},
         queue='process-ftp-tasks',
-        compression='zlib'
+        compression='zlib',
+        producer=ANY
     )
     assert mock_celery.call_args_list[1] == call(
         name='zip-and-send-letter-pdfs',
         kwargs={'filenames_to_zip': ['C.pdf']},
         queue='process-ftp-tasks',
-        compression='zlib'
+        compression='zlib',
+        producer=ANY
+    )
+
+
+@pytest.mark.parametrize('letters_counted, warns', [(2, False), (3, True)])
+def test_collate_letter_pdfs_for_day_checks_letters_counted_against_database(
+    notify_api, mocker, letters_counted, warns
+):
+    mocker.patch('app.celery.tasks.s3.iter_s3_bucket_objects')
+    mocker.patch('app.celery.letters_pdf_tasks.group_letters', return_value=[])
+    mock_count = mocker.patch('app.celery.letters_pdf_tasks.get_letters_to_process_count', return_value=letters_counted)
+    mock_dao_count = mocker.patch(
+        'app.celery.letters_pdf_tasks.dao_get_count_of_letters_to_process_for_date', return_value=2
     )
+    mock_warning = mocker.patch.object(notify_api.logger, 'warning')
+
+    collate_letter_pdfs_for_day('2017-01-02')
+
+    mock_count.assert_called_once_with('2017-01-02')
+    mock_dao_count.assert_called_once_with(date(2017, 1, 2))
+    assert mock_warning.called is warns
+
+
+def test_collate_letter_pdfs_for_day_does_not_check_database_without_letters_counted(notify_api, mocker):
+    mocker.patch('app.celery.tasks.s3.iter_s3_bucket_objects')
+    mocker.patch('app.celery.letters_pdf_tasks.group_letters', return_value=[])
+    mocker.patch('app.celery.letters_pdf_tasks.get_letters_to_process_count', return_value=None)
+    mock_dao_count = mocker.patch('app.celery.letters_pdf_tasks.dao_get_count_of_letters_to_process_for_date')
+
+    collate_letter_pdfs_for_day('2017-01-02')
+
+    assert not mock_dao_count.called
+
+
+@mock_s3
+def test_collate_letter_pdfs_for_day_sends_manifests(notify_api, mocker):
+    bucket = boto3.resource('s3', region_name='eu-west-1').create_bucket(Bucket='test-letters-pdf')
+    mocker.patch('app.celery.letters_pdf_tasks.group_letters', return_value=[
+        [{'Key': 'A.PDF', 'Size': 1}, {'Key': 'B.pDf', 'Size': 2}],
+        [{'Key': 'C.pdf', 'Size': 3}]
+    ])
+    mock_celery = mocker.patch('app.celery.letters_pdf_tasks.notify_celery.send_task')
+
+    with set_config(notify_api, 'LETTER_ZIP_MANIFESTS_ENABLED', True):
+        collate_letter_pdfs_for_day('2017-01-02')
+
+    manifests = [kwargs['kwargs']['manifest'] for _, kwargs in mock_celery.call_args_list]
+    assert [manifest['bucket'] for manifest in manifests] == ['test-letters-pdf', 'test-letters-pdf']
+    assert all(manifest['key'].startswith('manifests/2017-01-02/') for manifest in manifests)
+    assert [
+        json.loads(bucket.Object(manifest['key']).get()['Body'].read().decode('utf-8'))
+        for manifest in manifests
+    ] == [
+        {'filenames_to_zip': ['A.PDF', 'B.pDf']},
+        {'filenames_to_zip': ['C.pdf']},
+    ]
 
 
-def test_group_letters_splits_on_file_size(notify_api, mocker):
-    mocker.patch('app.celery.letters_pdf_tasks.letter_in_created_state', return_value=True)
+@pytest.fixture
+def one_open_zip(notify_api):
+    with set_config(notify_api, 'LETTER_ZIP_OPEN_GROUPS', 1):
+        yield
+
+
+def test_group_letters_splits_on_file_size(notify_api, mocker, one_open_zip):
+    mocker.patch('app.celery.letters_pdf_tasks.letters_in_created_state', side_effect=set)
     letters = [
         # ends under max but next one is too big
         {'Key': 'A.pdf', 'Size': 1}, {'Key': 'B.pdf', 'Size': 2},
@@ -223,8 +467,8 @@ def test_group_letters_splits_on_file_size(notify_api, mocker):
         assert next(x, None) is None
 
 
-def test_group_letters_splits_on_file_count(notify_api, mocker):
-    mocker.patch('app.celery.letters_pdf_tasks.letter_in_created_state', return_value=True)
+def test_group_letters_splits_on_file_count(notify_api, mocker, one_open_zip):
+    mocker.patch('app.celery.letters_pdf_tasks.letters_in_created_state', side_effect=set)
     letters = [
         {'Key': 'A.pdf', 'Size': 1},
         {'Key': 'B.pdf', 'Size': 2},
@@ -247,8 +491,8 @@ def test_group_letters_splits_on_file_count(notify_api, mocker):
         assert next(x, None) is None
 
 
-def test_group_letters_splits_on_file_size_and_file_count(notify_api, mocker):
-    mocker.patch('app.celery.letters_pdf_tasks.letter_in_created_state', return_value=True)
+def test_group_letters_splits_on_file_size_and_file_count(notify_api, mocker, one_open_zip):
+    mocker.patch('app.celery.letters_pdf_tasks.letters_in_created_state', side_effect=set)
     letters = [
         # ends under max file size but next file is too big
         {'Key': 'A.pdf', 'Size': 1},
@@ -282,42 +526,93 @@ def test_group_letters_splits_on_file_size_and_file_count(notify_api, mocker):
         assert next(x, None) is None
 
 
+def test_group_letters_puts_letters_in_the_first_zip_they_fit_in(notify_api, mocker):
+    mocker.patch('app.celery.letters_pdf_tasks.letters_in_created_state', side_effect=set)
+    letters = [
+        {'Key': 'A.pdf', 'Size': 4},
+        # doesn't fit with A, so starts another zip
+        {'Key': 'B.pdf', 'Size': 3},
+        # fits with A, which is then full and sent
+        {'Key': 'C.pdf', 'Size': 1},
+        # fits with B, which is then full and sent
+        {'Key': 'D.pdf', 'Size': 2},
+        {'Key': 'E.pdf', 'Size': 3},
+        {'Key': 'F.pdf', 'Size': 4},
+        # doesn't fit with E or F, and there can only be two zips, so the fullest one, F, is sent
+        {'Key': 'G.pdf', 'Size': 4},
+        # fits with E
+        {'Key': 'H.pdf', 'Size': 2},
+    ]
+
+    with set_config_values(notify_api, {'MAX_LETTER_PDF_ZIP_FILESIZE': 5, 'LETTER_ZIP_OPEN_GROUPS': 2}):
+        assert list(group_letters(letters)) == [
+            [{'Key': 'A.pdf', 'Size': 4}, {'Key': 'C.pdf', 'Size': 1}],
+            [{'Key': 'B.pdf', 'Size': 3}, {'Key': 'D.pdf', 'Size': 2}],
+            [{'Key': 'F.pdf', 'Size': 4}],
+            [{'Key': 'E.pdf', 'Size': 3}, {'Key': 'H.pdf', 'Size': 2}],
+            [{'Key': 'G.pdf', 'Size': 4}],
+        ]
+
+
+def test_group_letters_looks_up_statuses_in_batches(notify_api, mocker):
+    mock = mocker.patch('app.celery.letters_pdf_tasks.letters_in_created_state', side_effect=set)
+    letters = [{'Key': '{}.pdf'.format(i), 'Size': 1} for i in range(5)]
+
+    with set_config(notify_api, 'LETTER_STATUS_LOOKUP_BATCH_SIZE', 2):
+        assert list(group_letters(iter(letters))) == [letters]
+
+    assert mock.call_args_list == [call(['0.pdf', '1.pdf']), call(['2.pdf', '3.pdf']), call(['4.pdf'])]
+
+
 def test_group_letters_ignores_non_pdfs(notify_api, mocker):
-    mocker.patch('app.celery.letters_pdf_tasks.letter_in_created_state', return_value=True)
+    mocker.patch('app.celery.letters_pdf_tasks.letters_in_created_state', side_effect=set)
     letters = [{'Key': 'A.zip'}]
     assert list(group_letters(letters)) == []
 
 
 def test_group_letters_ignores_notifications_already_sent(notify_api, mocker):
-    mock = mocker.patch('app.celery.letters_pdf_tasks.letter_in_created_state', return_value=False)
-    letters = [{'Key': 'A.pdf'}]
-    assert list(group_letters(letters)) == []
-    mock.assert_called_once_with('A.pdf')
+    mock = mocker.patch('app.celery.letters_pdf_tasks.letters_in_created_state', return_value={'B.pdf'})
+    letters = [{'Key': 'A.pdf', 'Size': 1}, {'Key': 'B.pdf', 'Size': 1}, {'Key': 'C.zip'}]
+    assert list(group_letters(letters)) == [[{'Key': 'B.pdf', 'Size': 1}]]
+    mock.assert_called_once_with(['A.pdf', 'B.pdf'])
 
 
 def test_group_letters_with_no_letters(notify_api, mocker):
-    mocker.patch('app.celery.letters_pdf_tasks.letter_in_created_state', return_value=True)
+    mocker.patch('app.celery.letters_pdf_tasks.letters_in_created_state', side_effect=set)
     assert list(group_letters([])) == []
 
 
-def test_letter_in_created_state(sample_notification):
+def test_letters_in_created_state(sample_notification):
     sample_notification.reference = 'ABCDEF1234567890'
     filename = '2018-01-13/NOTIFY.ABCDEF1234567890.D.2.C.C.20180113120000.PDF'
 
-    assert letter_in_created_state(filename) is True
+    assert letters_in_created_state([filename]) == {filename}
 
 
-def test_letter_in_created_state_fails_if_notification_not_in_created(sample_notification):
+def test_letters_in_created_state_fails_if_notification_not_in_created(sample_notification):
     sample_notification.reference = 'ABCDEF1234567890'
     sample_notification.status = NOTIFICATION_SENDING
     filename = '2018-01-13/NOTIFY.ABCDEF1234567890.D.2.C.C.20180113120000.PDF'
-    assert letter_in_created_state(filename) is False
+    assert letters_in_created_state([filename]) == set()
 
 
-def test_letter_in_created_state_fails_if_notification_doesnt_exist(sample_notification):
+def test_letters_in_created_state_fails_if_notification_doesnt_exist(sample_notification):
     sample_notification.reference = 'QWERTY1234567890'
     filename = '2018-01-13/NOTIFY.ABCDEF1234567890.D.2.C.C.20180113120000.PDF'
-    assert letter_in_created_state(filename) is False
+    assert letters_in_created_state([filename]) == set()
+
+
+def test_letters_in_created_state_looks_up_statuses_in_batches(notify_api, mocker):
+    filenames = ['2018-01-13/NOTIFY.{}.D.2.C.C.20180113120000.PDF'.format(ref) for ref in ['REF1', 'REF2', 'REF3']]
+    lookup = mocker.patch(
+        'app.celery.letters_pdf_tasks.dao_get_notification_statuses_by_references',
+        return_value={'REF1': NOTIFICATION_CREATED, 'REF2': NOTIFICATION_SENDING, 'REF3': NOTIFICATION_CREATED}
+    )
+
+    with set_config(notify_api, 'LETTER_STATUS_LOOKUP_BATCH_SIZE', 2):
+        assert letters_in_created_state(filenames) == {filenames[0], filenames[2]}
+
+    lookup.assert_called_once_with({'REF1', 'REF2', 'REF3'}, 2)
 
 
 @pytest.mark.parametrize('key_type,is_test_letter,noti_status', [
@@ -338,6 +633,16 @@ def test_process_letter_task_check_virus_scan_passed(
     assert sample_letter_notification.status == noti_status
 
 
+def test_process_virus_scan_passed_counts_letter_to_process(sample_letter_notification, mocker):
+    sample_letter_notification.status = 'pending-virus-check'
+    mocker.patch('app.celery.letters_pdf_tasks.move_scanned_pdf_to_test_or_live_pdf_bucket')
+    mock_increment = mocker.patch('app.celery.letters_pdf_tasks.increment_letters_to_process')
+
+    process_virus_scan_passed('NOTIFY.{}'.format(sample_letter_notification.reference))
+
+    mock_increment.assert_called_once_with(sample_letter_notification)
+
+
 def test_process_letter_task_check_virus_scan_failed(sample_letter_notification, mocker):
     filename = 'NOTIFY.{}'.format(sample_letter_notification.reference)
     sample_letter_notification.status = 'pending-virus-check'
@@ -368,11 +673,84 @@ def test_replay_letters_in_error_for_all_letters_in_error_bucket(notify_api, moc
     import boto3
     mockObject = boto3.resource('s3').Object('ERROR', 'ERROR/file_name')
     mocker.patch("app.celery.letters_pdf_tasks.get_file_names_from_error_bucket", return_value=[mockObject])
-    mock_move = mocker.patch("app.celery.letters_pdf_tasks.move_error_pdf_to_scan_bucket")
+    mock_copy = mocker.patch("app.celery.letters_pdf_tasks.s3.copy_s3_object")
+    mock_delete = mocker.patch("app.celery.letters_pdf_tasks.s3.delete_s3_objects", return_value=[])
     mock_celery = mocker.patch("app.celery.letters_pdf_tasks.notify_celery.send_task")
     replay_letters_in_error()
-    mock_move.assert_called_once_with('file_name')
-    mock_celery.assert_called_once_with(name='scan-file', kwargs={'filename': 'file_name'}, queue='antivirus-tasks')
+    mock_copy.assert_called_once_with('test-letters-scan', 'ERROR/file_name', 'test-letters-scan', 'file_name')
+    mock_delete.assert_called_once_with('test-letters-scan', ['ERROR/file_name'])
+    assert mock_celery.call_count == 1
+    assert mock_celery.call_args[1]['name'] == 'scan-file'
+    assert mock_celery.call_args[1]['kwargs'] == {'filename': 'file_name'}
+    assert mock_celery.call_args[1]['queue'] == 'antivirus-tasks'
+
+
+def test_replay_letters_in_error_moves_letters_in_batches(notify_api, mocker):
+    import boto3
+    mocker.patch("app.celery.letters_pdf_tasks.get_file_names_from_error_bucket", return_value=[
+        boto3.resource('s3').Object('ERROR', 'ERROR/file_{}'.format(i)) for i in range(3)
+    ])
+    mocker.patch("app.celery.letters_pdf_tasks.s3.copy_s3_object")
+    mock_delete = mocker.patch("app.celery.letters_pdf_tasks.s3.delete_s3_objects", return_value=[])
+    mock_celery = mocker.patch("app.celery.letters_pdf_tasks.notify_celery.send_task")
+
+    with set_config(notify_api, 'REPLAY_LETTERS_IN_ERROR_BATCH_SIZE', 2):
+        replay_letters_in_error()
+
+    assert mock_delete.call_args_list == [
+        call('test-letters-scan', ['ERROR/file_0', 'ERROR/file_1']),
+        call('test-letters-scan', ['ERROR/file_2']),
+    ]
+    assert [kwargs['kwargs']['filename'] for _, kwargs in mock_celery.call_args_list] == [
+        'file_0', 'file_1', 'file_2'
+    ]
+
+
+def test_replay_letters_in_error_leaves_letters_that_fail_to_copy_in_error(notify_api, mocker):
+    import boto3
+    mocker.patch("app.celery.letters_pdf_tasks.get_file_names_from_error_bucket", return_value=[
+        boto3.resource('s3').Object('ERROR', 'ERROR/file_0'),
+        boto3.resource('s3').Object('ERROR', 'ERROR/file_1'),
+    ])
+
+    def copy(source_bucket, source_key, target_bucket, target_key):
+        if target_key == 'file_0':
+            raise ClientError({'Error': {'Code': '500'}}, 'CopyObject')
+
+    mocker.patch("app.celery.letters_pdf_tasks.s3.copy_s3_object", side_effect=copy)
+    mock_delete = mocker.patch("app.celery.letters_pdf_tasks.s3.delete_s3_objects", return_value=[])
+    mock_celery = mocker.patch("app.celery.letters_pdf_tasks.notify_celery.send_task")
+
+    replay_letters_in_error()
+
+    mock_delete.assert_called_once_with('test-letters-scan', ['ERROR/file_1'])
+    assert mock_celery.call_count == 1
+    assert mock_celery.call_args[1]['kwargs'] == {'filename': 'file_1'}
+
+
+def test_replay_letters_in_error_does_not_scan_letters_that_fail_to_delete_from_error(notify_api, mocker):
+    import boto3
+    mocker.patch("app.celery.letters_pdf_tasks.get_file_names_from_error_bucket", return_value=[
+        boto3.resource('s3').Object('ERROR', 'ERROR/file_0'),
+        boto3.resource('s3').Object('ERROR', 'ERROR/file_1'),
+        boto3.resource('s3').Object('ERROR', 'ERROR/file_2'),
+    ])
+    mocker.patch("app.celery.letters_pdf_tasks.s3.copy_s3_object")
+    mock_delete = mocker.patch("app.celery.letters_pdf_tasks.s3.delete_s3_objects", side_effect=[
+        ['ERROR/file_0', 'ERROR/file_1'],
+        ['ERROR/file_1'],
+    ])
+    mock_celery = mocker.patch("app.celery.letters_pdf_tasks.notify_celery.send_task")
+    mock_error = mocker.patch.object(notify_api.logger, 'error')
+
+    replay_letters_in_error()
+
+    assert mock_delete.call_args_list == [
+        call('test-letters-scan', ['ERROR/file_0', 'ERROR/file_1', 'ERROR/file_2']),
+        call('test-letters-scan', ['ERROR/file_0', 'ERROR/file_1']),
+    ]
+    assert [kwargs['kwargs']['filename'] for _, kwargs in mock_celery.call_args_list] == ['file_0', 'file_2']
+    assert "['ERROR/file_1']" in mock_error.call_args[0][0]
 
 
 def test_replay_letters_in_error_for_one_file(notify_api, mocker):
@@ -1,3 +1,5 @@
+from unittest.mock import call
+
 import pytest
 from botocore.exceptions import ClientError
 from celery.exceptions import MaxRetriesExceededError
@@ -5,14 +7,18 @@ from notifications_utils.recipients import InvalidEmailError
 
 import app
 from app.celery import provider_tasks
-from app.celery.provider_tasks import deliver_sms, deliver_email
+from app.celery.provider_tasks import deliver_sms, deliver_email, deliver_sms_batch, deliver_email_batch
 from app.clients.email.aws_ses import AwsSesClientException
 from app.exceptions import NotificationTechnicalFailureException
+from tests.app.db import create_notification
+from tests.conftest import set_config
 
 
 def test_should_have_decorated_tasks_functions():
     assert deliver_sms.__wrapped__.__name__ == 'deliver_sms'
     assert deliver_email.__wrapped__.__name__ == 'deliver_email'
+    assert deliver_sms_batch.__wrapped__.__name__ == 'deliver_sms_batch'
+    assert deliver_email_batch.__wrapped__.__name__ == 'deliver_email_batch'
 
 
 def test_should_call_send_sms_to_provider_from_deliver_sms_task(
@@ -137,3 +143,79 @@ def test_send_sms_should_not_switch_providers_on_non_provider_failure(
     deliver_sms(sample_notification.id)
 
     assert switch_provider_mock.called is False
+
+
+def test_deliver_email_batch_sends_notifications_to_provider_as_a_batch(sample_email_template, mocker):
+    notifications = [create_notification(template=sample_email_template) for _ in range(3)]
+    send_batch = mocker.patch('app.delivery.send_to_providers.send_email_batch_to_provider', return_value=[])
+    retry = mocker.patch('app.celery.provider_tasks.deliver_email.apply_async')
+
+    deliver_email_batch([str(n.id) for n in notifications])
+
+    assert {n.id for n in send_batch.call_args[0][0]} == {n.id for n in notifications}
+    assert not retry.called
+
+
+def test_deliver_email_batch_retries_failed_and_missing_notifications_one_at_a_time(sample_email_template, mocker):
+    sent = create_notification(template=sample_email_template)
+    failed = create_notification(template=sample_email_template)
+    missing_id = str(app.create_uuid())
+    mocker.patch('app.delivery.send_to_providers.send_email_batch_to_provider', return_value=[failed])
+    retry = mocker.patch('app.celery.provider_tasks.deliver_email.apply_async')
+
+    deliver_email_batch([str(sent.id), str(failed.id), missing_id])
+
+    assert retry.call_args_list == [
+        call([str(failed.id)], queue='retry-tasks', countdown=300),
+        call([missing_id], queue='retry-tasks', countdown=300),
+    ]
+
+
+def test_deliver_email_batch_queues_notifications_past_batch_size_as_another_batch(
+    notify_api, sample_email_template, mocker
+):
+    notifications = [create_notification(template=sample_email_template) for _ in range(3)]
+    notification_ids = [str(n.id) for n in notifications]
+    send_batch = mocker.patch('app.delivery.send_to_providers.send_email_batch_to_provider', return_value=[])
+    next_batch = mocker.patch('app.celery.provider_tasks.deliver_email_batch.apply_async')
+
+    with set_config(notify_api, 'DELIVER_EMAIL_BATCH_SIZE', 2):
+        deliver_email_batch(notification_ids)
+
+    assert {str(n.id) for n in send_batch.call_args[0][0]} == set(notification_ids[:2])
+    next_batch.assert_called_once_with([notification_ids[2:]], queue='send-email-tasks')
+
+
+def test_deliver_sms_batch_sends_notifications_to_provider_as_a_batch(sample_template, mocker):
+    notifications = [create_notification(template=sample_template) for _ in range(3)]
+    send_batch = mocker.patch('app.delivery.send_to_providers.send_sms_batch_to_provider', return_value=[])
+    retry = mocker.patch('app.celery.provider_tasks.deliver_sms.apply_async')
+
+    deliver_sms_batch([str(n.id) for n in notifications])
+
+    assert {n.id for n in send_batch.call_args[0][0]} == {n.id for n in notifications}
+    assert not retry.called
+
+
+def test_deliver_sms_batch_retries_failed_notifications_one_at_a_time(sample_template, mocker):
+    sent = create_notification(template=sample_template)
+    failed = create_notification(template=sample_template)
+    mocker.patch('app.delivery.send_to_providers.send_sms_batch_to_provider', return_value=[failed])
+    retry = mocker.patch('app.celery.provider_tasks.deliver_sms.apply_async')
+
+    deliver_sms_batch([str(sent.id), str(failed.id)])
+
+    retry.assert_called_once_with([str(failed.id)], queue='retry-tasks', countdown=300)
+
+
+def test_deliver_sms_batch_queues_notifications_past_batch_size_as_another_batch(notify_api, sample_template, mocker):
+    notifications = [create_notification(template=sample_template) for _ in range(3)]
+    notification_ids = [str(n.id) for n in notifications]
+    send_batch = mocker.patch('app.delivery.send_to_providers.send_sms_batch_to_provider', return_value=[])
+    next_batch = mocker.patch('app.celery.provider_tasks.deliver_sms_batch.apply_async')
+
+    with set_config(notify_api, 'DELIVER_SMS_BATCH_SIZE', 2):
+        deliver_sms_batch(notification_ids)
+
+    assert {str(n.id) for n in send_batch.call_args[0][0]} == set(notification_ids[:2])
+    next_batch.assert_called_once_with([notification_ids[2:]], queue='send-sms-tasks')
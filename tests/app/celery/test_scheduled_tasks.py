@@ -1,6 +1,6 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from functools import partial
-from unittest.mock import call, patch, PropertyMock
+from unittest.mock import ANY, call, patch, PropertyMock
 import functools
 
 import pytz
@@ -40,7 +40,6 @@ from app.celery.scheduled_tasks import (
 from app.clients.performance_platform.performance_platform_client import PerformancePlatformClient
 from app.config import QueueNames, TaskNames
 from app.dao.jobs_dao import dao_get_job_by_id
-from app.dao.notifications_dao import dao_get_scheduled_notifications
 from app.dao.provider_details_dao import (
     dao_update_provider_details,
     get_current_provider
@@ -48,7 +47,7 @@ from app.dao.provider_details_dao import (
 from app.exceptions import NotificationTechnicalFailureException
 from app.models import (
     NotificationHistory,
-    Service,
+    ScheduledNotification,
     StatsTemplateUsageByMonth,
     JOB_STATUS_READY_TO_SEND,
     JOB_STATUS_IN_PROGRESS,
@@ -60,6 +59,8 @@ from app.models import (
 from app.utils import get_london_midnight_in_utc
 from app.celery.service_callback_tasks import create_delivery_status_callback_data
 from app.v2.errors import JobIncompleteError
+from app.dao.letter_ack_dao import dao_get_acked_zip_file_names, dao_record_letter_acks
+
 from tests.app.db import (
     create_notification, create_service, create_template, create_job, create_service_callback_api
 )
@@ -68,35 +69,10 @@ from tests.app.conftest import (
     sample_job as create_sample_job,
     sample_notification_history as create_notification_history,
     sample_template as create_sample_template,
-    create_custom_template,
     datetime_in_past
 )
 from tests.app.aws.test_s3 import single_s3_object_stub
-from tests.conftest import set_config_values
-
-
-def _create_slow_delivery_notification(provider='mmg'):
-    now = datetime.utcnow()
-    five_minutes_from_now = now + timedelta(minutes=5)
-    service = Service.query.get(current_app.config['FUNCTIONAL_TEST_PROVIDER_SERVICE_ID'])
-    if not service:
-        service = create_service(
-            service_id=current_app.config.get('FUNCTIONAL_TEST_PROVIDER_SERVICE_ID')
-        )
-
-    template = create_custom_template(
-        service=service,
-        user=service.users[0],
-        template_config_name='FUNCTIONAL_TEST_PROVIDER_SMS_TEMPLATE_ID',
-        template_type='sms'
-    )
-
-    create_notification(
-        template=template,
-        status='delivered',
-        sent_by=provider,
-        updated_at=five_minutes_from_now
-    )
+from tests.conftest import set_config, set_config_values
 
 
 @pytest.mark.skip(reason="This doesn't actually test the celery task wraps the function")
@@ -220,7 +196,28 @@ def test_timeout_notifications_sends_status_update_to_service(client, sample_tem
     timeout_notifications()
 
     encrypted_data = create_delivery_status_callback_data(notification, callback_api)
-    mocked.assert_called_once_with([str(notification.id), encrypted_data], queue=QueueNames.CALLBACKS)
+    mocked.assert_called_once_with([str(notification.id), encrypted_data], queue=QueueNames.CALLBACKS, producer=ANY)
+
+
+def test_timeout_notifications_looks_up_callback_api_once_per_service(client, sample_template, mocker):
+    create_service_callback_api(service=sample_template.service)
+    service_without_callback = create_service(service_name='no callback')
+    template_without_callback = create_template(service=service_without_callback)
+    mocked = mocker.patch('app.celery.service_callback_tasks.send_delivery_status_to_service.apply_async')
+    get_callback_api = mocker.spy(scheduled_tasks, 'get_service_delivery_status_callback_api_for_service')
+    created_at = datetime.utcnow() - timedelta(
+        seconds=current_app.config.get('SENDING_NOTIFICATIONS_TIMEOUT_PERIOD') + 10)
+    notifications = [
+        create_notification(template=sample_template, status='sending', created_at=created_at)
+        for _ in range(3)
+    ]
+    create_notification(template=template_without_callback, status='sending', created_at=created_at)
+
+    with set_config(client.application, 'TIMEOUT_NOTIFICATIONS_BATCH_SIZE', 2):
+        timeout_notifications()
+
+    assert get_callback_api.call_count == 2
+    assert sorted(call[0][0][0] for call in mocked.call_args_list) == sorted(str(x.id) for x in notifications)
 
 
 def test_should_update_scheduled_jobs_and_put_on_queue(notify_db, notify_db_session, mocker):
@@ -360,83 +357,96 @@ def test_send_total_sent_notifications_to_performance_platform_calls_with_correc
         ])
 
 
-def test_switch_current_sms_provider_on_slow_delivery_does_not_run_if_config_unset(
+@pytest.mark.parametrize('delivery_counts, should_switch', [
+    ((100, 5), False),
+    ((100, 6), True),
+    ((19, 19), False),
+])
+@freeze_time('2018-01-01 12:00:00')
+def test_switch_providers_on_slow_delivery_counts_slow_deliveries_if_redis_disabled(
     notify_api,
-    mocker
+    mocker,
+    restore_provider_details,
+    delivery_counts,
+    should_switch
 ):
-    get_notifications_mock = mocker.patch(
-        'app.celery.scheduled_tasks.is_delivery_slow_for_provider'
+    get_latency_mock = mocker.patch('app.celery.scheduled_tasks.get_delivery_latency_percentiles')
+    get_counts_mock = mocker.patch(
+        'app.celery.scheduled_tasks.dao_get_delivery_counts_for_provider',
+        return_value=delivery_counts
     )
     toggle_sms_mock = mocker.patch('app.celery.scheduled_tasks.dao_toggle_sms_provider')
+    current_provider = get_current_provider('sms')
+    current_provider.updated_at = datetime(2018, 1, 1, 11, 30)
 
-    with set_config_values(notify_api, {
-        'FUNCTIONAL_TEST_PROVIDER_SERVICE_ID': None,
-        'FUNCTIONAL_TEST_PROVIDER_SMS_TEMPLATE_ID': None
-    }):
+    with set_config(notify_api, 'REDIS_ENABLED', False):
         switch_current_sms_provider_on_slow_delivery()
 
-    assert get_notifications_mock.called is False
-    assert toggle_sms_mock.called is False
+    assert get_latency_mock.called is False
+    get_counts_mock.assert_called_once_with(
+        current_provider.identifier,
+        sent_at=datetime(2018, 1, 1, 11, 50),
+        delivery_time=timedelta(seconds=240)
+    )
+    assert toggle_sms_mock.called is should_switch
 
 
-def test_switch_providers_on_slow_delivery_runs_if_config_set(
+@freeze_time('2018-01-01 12:00:00')
+def test_switch_providers_on_slow_delivery_reads_latency_for_last_ten_minutes(
     notify_api,
     mocker,
-    prepare_current_provider
+    restore_provider_details
 ):
-    get_notifications_mock = mocker.patch(
-        'app.celery.scheduled_tasks.is_delivery_slow_for_provider',
-        return_value=[]
+    get_latency_mock = mocker.patch(
+        'app.celery.scheduled_tasks.get_delivery_latency_percentiles',
+        return_value={'count': 100, 'p95': 30}
     )
+    toggle_sms_mock = mocker.patch('app.celery.scheduled_tasks.dao_toggle_sms_provider')
+    current_provider = get_current_provider('sms')
+    current_provider.updated_at = datetime(2018, 1, 1, 11, 30)
 
-    with set_config_values(notify_api, {
-        'FUNCTIONAL_TEST_PROVIDER_SERVICE_ID': '7954469d-8c6d-43dc-b8f7-86be2d69f5f3',
-        'FUNCTIONAL_TEST_PROVIDER_SMS_TEMPLATE_ID': '331a63e6-f1aa-4588-ad3f-96c268788ae7'
-    }):
+    with set_config(notify_api, 'REDIS_ENABLED', True):
         switch_current_sms_provider_on_slow_delivery()
 
-    assert get_notifications_mock.called is True
+    get_latency_mock.assert_called_once_with(
+        current_provider.identifier,
+        since=datetime(2018, 1, 1, 11, 50),
+        percentiles=(95,)
+    )
+    assert toggle_sms_mock.called is False
 
 
-def test_switch_providers_triggers_on_slow_notification_delivery(
+def test_switch_providers_on_slow_delivery_reads_latency_since_last_switch(
     notify_api,
     mocker,
-    prepare_current_provider,
-    sample_user
+    prepare_current_provider
 ):
-    mocker.patch('app.provider_details.switch_providers.get_user_by_id', return_value=sample_user)
-    starting_provider = get_current_provider('sms')
+    get_latency_mock = mocker.patch(
+        'app.celery.scheduled_tasks.get_delivery_latency_percentiles',
+        return_value={'count': 0, 'p95': None}
+    )
+    current_provider = get_current_provider('sms')
 
-    with set_config_values(notify_api, {
-        'FUNCTIONAL_TEST_PROVIDER_SERVICE_ID': '7954469d-8c6d-43dc-b8f7-86be2d69f5f3',
-        'FUNCTIONAL_TEST_PROVIDER_SMS_TEMPLATE_ID': '331a63e6-f1aa-4588-ad3f-96c268788ae7'
-    }):
-        _create_slow_delivery_notification(starting_provider.identifier)
-        _create_slow_delivery_notification(starting_provider.identifier)
+    with set_config(notify_api, 'REDIS_ENABLED', True):
         switch_current_sms_provider_on_slow_delivery()
 
-    new_provider = get_current_provider('sms')
-    assert new_provider.identifier != starting_provider.identifier
-    assert new_provider.priority < starting_provider.priority
+    assert get_latency_mock.call_args[1]['since'] == current_provider.updated_at
 
 
-def test_switch_providers_on_slow_delivery_does_not_switch_if_already_switched(
+def test_switch_providers_triggers_on_slow_notification_delivery(
     notify_api,
     mocker,
     prepare_current_provider,
     sample_user
 ):
     mocker.patch('app.provider_details.switch_providers.get_user_by_id', return_value=sample_user)
+    mocker.patch(
+        'app.celery.scheduled_tasks.get_delivery_latency_percentiles',
+        return_value={'count': 20, 'p95': 250}
+    )
     starting_provider = get_current_provider('sms')
 
-    with set_config_values(notify_api, {
-        'FUNCTIONAL_TEST_PROVIDER_SERVICE_ID': '7954469d-8c6d-43dc-b8f7-86be2d69f5f3',
-        'FUNCTIONAL_TEST_PROVIDER_SMS_TEMPLATE_ID': '331a63e6-f1aa-4588-ad3f-96c268788ae7'
-    }):
-        _create_slow_delivery_notification()
-        _create_slow_delivery_notification()
-
-        switch_current_sms_provider_on_slow_delivery()
+    with set_config(notify_api, 'REDIS_ENABLED', True):
         switch_current_sms_provider_on_slow_delivery()
 
     new_provider = get_current_provider('sms')
@@ -444,68 +454,69 @@ def test_switch_providers_on_slow_delivery_does_not_switch_if_already_switched(
     assert new_provider.priority < starting_provider.priority
 
 
-def test_switch_providers_on_slow_delivery_does_not_switch_based_on_older_notifications(
+def test_switch_providers_on_slow_delivery_needs_enough_receipts(
     notify_api,
     mocker,
-    prepare_current_provider,
-    sample_user,
-
+    prepare_current_provider
 ):
-    """
-    Assume we have three slow delivery notifications for the current provider x. This triggers
-    a switch to provider y. If we experience some slow delivery notifications on this provider,
-    we switch back to provider x.
-
-    Provider x had three slow deliveries initially, but we do not want to trigger another switch
-    based on these as they are old. We only want to look for slow notifications after the point at
-    which we switched back to provider x.
-    """
-    mocker.patch('app.provider_details.switch_providers.get_user_by_id', return_value=sample_user)
-    starting_provider = get_current_provider('sms')
-
-    with set_config_values(notify_api, {
-        'FUNCTIONAL_TEST_PROVIDER_SERVICE_ID': '7954469d-8c6d-43dc-b8f7-86be2d69f5f3',
-        'FUNCTIONAL_TEST_PROVIDER_SMS_TEMPLATE_ID': '331a63e6-f1aa-4588-ad3f-96c268788ae7'
-    }):
-        # Provider x -> y
-        _create_slow_delivery_notification(starting_provider.identifier)
-        _create_slow_delivery_notification(starting_provider.identifier)
-        _create_slow_delivery_notification(starting_provider.identifier)
-        switch_current_sms_provider_on_slow_delivery()
-
-        current_provider = get_current_provider('sms')
-        assert current_provider.identifier != starting_provider.identifier
+    mocker.patch(
+        'app.celery.scheduled_tasks.get_delivery_latency_percentiles',
+        return_value={'count': 19, 'p95': 600}
+    )
+    toggle_sms_mock = mocker.patch('app.celery.scheduled_tasks.dao_toggle_sms_provider')
 
-        # Provider y -> x
-        _create_slow_delivery_notification(current_provider.identifier)
-        _create_slow_delivery_notification(current_provider.identifier)
+    with set_config(notify_api, 'REDIS_ENABLED', True):
         switch_current_sms_provider_on_slow_delivery()
 
-        new_provider = get_current_provider('sms')
-        assert new_provider.identifier != current_provider.identifier
-
-        # Expect to stay on provider x
-        switch_current_sms_provider_on_slow_delivery()
-        current_provider = get_current_provider('sms')
-        assert starting_provider.identifier == current_provider.identifier
+    assert toggle_sms_mock.called is False
 
 
 @freeze_time("2017-05-01 14:00:00")
 def test_should_send_all_scheduled_notifications_to_deliver_queue(sample_template, mocker):
-    mocked = mocker.patch('app.celery.provider_tasks.deliver_sms')
+    mocked = mocker.patch('app.celery.provider_tasks.deliver_sms_batch')
     message_to_deliver = create_notification(template=sample_template, scheduled_for="2017-05-01 13:15")
     create_notification(template=sample_template, scheduled_for="2017-05-01 10:15", status='delivered')
     create_notification(template=sample_template)
-    create_notification(template=sample_template, scheduled_for="2017-05-01 14:15")
-
-    scheduled_notifications = dao_get_scheduled_notifications()
-    assert len(scheduled_notifications) == 1
+    not_due_yet = create_notification(template=sample_template, scheduled_for="2017-05-01 14:15")
 
     send_scheduled_notifications()
 
-    mocked.apply_async.assert_called_once_with([str(message_to_deliver.id)], queue='send-sms-tasks')
-    scheduled_notifications = dao_get_scheduled_notifications()
-    assert not scheduled_notifications
+    mocked.apply_async.assert_called_once_with([[str(message_to_deliver.id)]], queue='send-sms-tasks', producer=ANY)
+    assert ScheduledNotification.query.filter_by(pending=True).one().notification_id == not_due_yet.id
+
+
+@freeze_time("2017-05-01 14:00:00")
+def test_send_scheduled_notifications_sends_in_batches(notify_api, sample_template, sample_email_template, mocker):
+    sms_queue = mocker.patch('app.celery.provider_tasks.deliver_sms_batch.apply_async')
+    email_queue = mocker.patch('app.celery.provider_tasks.deliver_email_batch.apply_async')
+    sms = [create_notification(template=sample_template, scheduled_for="2017-05-01 13:15") for _ in range(3)]
+    email = create_notification(template=sample_email_template, scheduled_for="2017-05-01 13:15")
+    test_key_sms = create_notification(template=sample_template, scheduled_for="2017-05-01 13:15", key_type='test')
+
+    with set_config_values(notify_api, {
+        'SEND_SCHEDULED_NOTIFICATIONS_BATCH_SIZE': 4,
+        'DELIVER_SMS_BATCH_SIZE': 2,
+    }):
+        send_scheduled_notifications()
+
+    sms_batches = [(call[0][0][0], call[1]['queue']) for call in sms_queue.call_args_list]
+    assert sorted(id for ids, queue in sms_batches if queue == 'send-sms-tasks' for id in ids) == \
+        sorted(str(x.id) for x in sms)
+    assert all(len(ids) <= 2 for ids, _ in sms_batches)
+    assert [ids for ids, queue in sms_batches if queue == 'research-mode-tasks'] == [[str(test_key_sms.id)]]
+    email_queue.assert_called_once_with([[str(email.id)]], queue='send-email-tasks', producer=ANY)
+    assert not ScheduledNotification.query.filter_by(pending=True).all()
+
+
+def test_send_scheduled_notifications_leaves_notifications_pending_if_queueing_fails(sample_template, mocker):
+    mocker.patch('app.celery.provider_tasks.deliver_sms_batch.apply_async', side_effect=Exception('boom'))
+    create_notification(template=sample_template, scheduled_for="2017-05-01 13:15")
+
+    with pytest.raises(Exception):
+        send_scheduled_notifications()
+    db.session.rollback()
+
+    assert ScheduledNotification.query.filter_by(pending=True).count() == 1
 
 
 def test_should_call_delete_inbound_sms_older_than_seven_days(notify_api, mocker):
@@ -777,6 +788,32 @@ def test_trigger_letter_pdfs_for_day(client, mocker, sample_letter_template):
                                         queue=QueueNames.LETTERS)
 
 
+@freeze_time("2017-12-18 17:50")
+def test_trigger_letter_pdfs_for_day_uses_letters_counted(client, mocker):
+    mock_count = mocker.patch('app.celery.scheduled_tasks.get_letters_to_process_count', return_value=2)
+    mock_dao_count = mocker.patch('app.celery.scheduled_tasks.dao_get_count_of_letters_to_process_for_date')
+    mock_celery = mocker.patch("app.celery.tasks.notify_celery.send_task")
+
+    trigger_letter_pdfs_for_day()
+
+    mock_count.assert_called_once_with(date(2017, 12, 18))
+    assert not mock_dao_count.called
+    mock_celery.assert_called_once_with(name='collate-letter-pdfs-for-day',
+                                        args=('2017-12-18',),
+                                        queue=QueueNames.LETTERS)
+
+
+@freeze_time("2017-12-18 17:50")
+def test_trigger_letter_pdfs_for_day_checks_database_if_no_letters_counted(client, mocker, sample_letter_template):
+    create_notification(template=sample_letter_template, created_at='2017-12-18 10:00:00')
+    mocker.patch('app.celery.scheduled_tasks.get_letters_to_process_count', return_value=0)
+    mock_celery = mocker.patch("app.celery.tasks.notify_celery.send_task")
+
+    trigger_letter_pdfs_for_day()
+
+    assert mock_celery.called
+
+
 @freeze_time("2017-12-18 17:50")
 def test_trigger_letter_pdfs_for_day_send_task_not_called_if_no_notis_for_day(
         client, mocker, sample_letter_template):
@@ -1083,7 +1120,7 @@ def mock_s3_get_list_diff(bucket_name, subfolder='', suffix='', last_modified=No
 
 
 @freeze_time('2018-01-11T23:00:00')
-def test_letter_not_raise_alert_if_ack_files_match_zip_list(mocker, notify_db):
+def test_letter_not_raise_alert_if_ack_files_match_zip_list(mocker, notify_db_session):
     mock_file_list = mocker.patch("app.aws.s3.get_list_of_files_by_suffix", side_effect=mock_s3_get_list_match)
     mock_get_file = mocker.patch("app.aws.s3.get_s3_file",
                                  return_value='NOTIFY.20180111175007.ZIP|20180111175733\n'
@@ -1103,7 +1140,7 @@ def test_letter_not_raise_alert_if_ack_files_match_zip_list(mocker, notify_db):
 
 
 @freeze_time('2018-01-11T23:00:00')
-def test_letter_raise_alert_if_ack_files_not_match_zip_list(mocker, notify_db):
+def test_letter_raise_alert_if_ack_files_not_match_zip_list(mocker, notify_db_session):
     mock_file_list = mocker.patch("app.aws.s3.get_list_of_files_by_suffix", side_effect=mock_s3_get_list_diff)
     mock_get_file = mocker.patch("app.aws.s3.get_s3_file",
                                  return_value='NOTIFY.20180111175007.ZIP|20180111175733\n'
@@ -1131,7 +1168,7 @@ def test_letter_raise_alert_if_ack_files_not_match_zip_list(mocker, notify_db):
 
 
 @freeze_time('2018-01-11T23:00:00')
-def test_letter_not_raise_alert_if_no_files_do_not_cause_error(mocker, notify_db):
+def test_letter_not_raise_alert_if_no_files_do_not_cause_error(mocker, notify_db_session):
     mock_file_list = mocker.patch("app.aws.s3.get_list_of_files_by_suffix", side_effect=None)
     mock_get_file = mocker.patch("app.aws.s3.get_s3_file",
                                  return_value='NOTIFY.20180111175007.ZIP|20180111175733\n'
@@ -1139,13 +1176,89 @@ def test_letter_not_raise_alert_if_no_files_do_not_cause_error(mocker, notify_db
 
     letter_raise_alert_if_no_ack_file_for_zip()
 
-    assert mock_file_list.call_count == 2
+    # with no zips sent there's nothing to look for in the ack files
+    assert mock_file_list.call_count == 1
     assert mock_get_file.call_count == 0
 
 
+@freeze_time('2018-01-11T23:00:00')
+def test_letter_raise_alert_uses_recorded_ack_files(mocker, notify_db_session):
+    dao_record_letter_acks(
+        'root/dispatch/NOTIFY.20180111175733.ACK.txt', ['NOTIFY.20180111175007.ZIP', 'NOTIFY.20180111175008.ZIP']
+    )
+    mock_file_list = mocker.patch("app.aws.s3.get_list_of_files_by_suffix", side_effect=mock_s3_get_list_match)
+    mock_get_file = mocker.patch("app.aws.s3.get_s3_file")
+    mock_zendesk = mocker.patch("app.celery.scheduled_tasks.zendesk_client.create_ticket")
+
+    letter_raise_alert_if_no_ack_file_for_zip()
+
+    assert mock_file_list.call_count == 1
+    assert mock_get_file.call_count == 0
+    assert not mock_zendesk.called
+
+
+@freeze_time('2018-01-11T23:00:00')
+def test_letter_raise_alert_only_downloads_ack_files_not_yet_recorded(mocker, notify_db_session):
+    dao_record_letter_acks('root/dispatch/NOTIFY.20180111175733.ACK.txt', ['NOTIFY.20180111175007.ZIP'])
+    mocker.patch("app.aws.s3.get_list_of_files_by_suffix", side_effect=lambda bucket_name, subfolder, **kwargs: {
+        '2018-01-11/zips_sent': ['NOTIFY.20180111175007.ZIP.TXT', 'NOTIFY.20180111175008.ZIP.TXT'],
+        'root/dispatch': [
+            'root/dispatch/NOTIFY.20180111175733.ACK.txt',
+            'root/dispatch/NOTIFY.20180111180000.ACK.txt',
+            'root/dispatch/NOTIFY.20180110180000.ACK.txt',
+        ],
+    }[subfolder])
+    mock_get_file = mocker.patch("app.aws.s3.get_s3_file", return_value='NOTIFY.20180111175008.ZIP|20180111180000')
+    mock_zendesk = mocker.patch("app.celery.scheduled_tasks.zendesk_client.create_ticket")
+
+    letter_raise_alert_if_no_ack_file_for_zip()
+
+    mock_get_file.assert_called_once_with(
+        current_app.config['DVLA_RESPONSE_BUCKET_NAME'], 'root/dispatch/NOTIFY.20180111180000.ACK.txt'
+    )
+    assert not mock_zendesk.called
+    assert dao_get_acked_zip_file_names({'NOTIFY.20180111175008.ZIP'}) == {'NOTIFY.20180111175008.ZIP'}
+
+
+@freeze_time('2018-01-11T23:00:00')
+def test_letter_raise_alert_does_not_download_recorded_ack_files_again(mocker, notify_db_session):
+    # an ack file whose zips were all acked by an earlier file
+    dao_record_letter_acks('root/dispatch/NOTIFY.20180111175733.ACK.txt', ['NOTIFY.20180111175007.ZIP'])
+    dao_record_letter_acks('root/dispatch/NOTIFY.20180111180000.ACK.txt', ['NOTIFY.20180111175007.ZIP'])
+    mocker.patch("app.aws.s3.get_list_of_files_by_suffix", side_effect=lambda bucket_name, subfolder, **kwargs: {
+        '2018-01-11/zips_sent': ['NOTIFY.20180111175007.ZIP.TXT', 'NOTIFY.20180111175008.ZIP.TXT'],
+        'root/dispatch': [
+            'root/dispatch/NOTIFY.20180111175733.ACK.txt',
+            'root/dispatch/NOTIFY.20180111180000.ACK.txt',
+        ],
+    }[subfolder])
+    mock_get_file = mocker.patch("app.aws.s3.get_s3_file")
+    mocker.patch("app.celery.scheduled_tasks.zendesk_client.create_ticket")
+
+    letter_raise_alert_if_no_ack_file_for_zip()
+
+    assert not mock_get_file.called
+
+
+@freeze_time('2018-01-11T23:00:00')
+def test_letter_raise_alert_logs_zips_in_todays_ack_files_that_are_not_for_today(
+    notify_api, mocker, notify_db_session
+):
+    dao_record_letter_acks('root/dispatch/NOTIFY.20180110175733.ACK.txt', ['NOTIFY.20180110175007.ZIP'])
+    dao_record_letter_acks(
+        'root/dispatch/NOTIFY.20180111175733.ACK.txt', ['NOTIFY.20180111175007.ZIP', 'NOTIFY.20180110175008.ZIP']
+    )
+    mocker.patch("app.aws.s3.get_list_of_files_by_suffix", return_value=['NOTIFY.20180111175007.ZIP.TXT'])
+    mock_info = mocker.patch.object(notify_api.logger, 'info')
+
+    letter_raise_alert_if_no_ack_file_for_zip()
+
+    mock_info.assert_any_call("letter ack contains zip that is not for today: {'NOTIFY.20180110175008.ZIP'}")
+
+
 def test_replay_created_notifications(notify_db_session, sample_service, mocker):
-    email_delivery_queue = mocker.patch('app.celery.provider_tasks.deliver_email.apply_async')
-    sms_delivery_queue = mocker.patch('app.celery.provider_tasks.deliver_sms.apply_async')
+    email_delivery_queue = mocker.patch('app.celery.provider_tasks.deliver_email_batch.apply_async')
+    sms_delivery_queue = mocker.patch('app.celery.provider_tasks.deliver_sms_batch.apply_async')
 
     sms_template = create_template(service=sample_service, template_type='sms')
     email_template = create_template(service=sample_service, template_type='email')
@@ -1167,7 +1280,46 @@ def test_replay_created_notifications(notify_db_session, sample_service, mocker)
                         status='created')
 
     replay_created_notifications()
-    email_delivery_queue.assert_called_once_with([str(old_email.id)],
-                                                 queue='send-email-tasks')
-    sms_delivery_queue.assert_called_once_with([str(old_sms.id)],
-                                               queue="send-sms-tasks")
+    email_delivery_queue.assert_called_once_with([[str(old_email.id)]],
+                                                 queue='send-email-tasks',
+                                                 producer=ANY)
+    sms_delivery_queue.assert_called_once_with([[str(old_sms.id)]],
+                                               queue="send-sms-tasks",
+                                               producer=ANY)
+
+
+def test_replay_created_notifications_publishes_in_batches(notify_api, sample_service, mocker):
+    sms_delivery_queue = mocker.patch('app.celery.provider_tasks.deliver_sms_batch.apply_async')
+    mocker.patch('app.celery.provider_tasks.deliver_email_batch.apply_async')
+
+    sms_template = create_template(service=sample_service, template_type='sms')
+    created_at = datetime.utcnow() - timedelta(hours=5)
+    notifications = [
+        create_notification(template=sms_template, created_at=created_at, status='created') for _ in range(5)
+    ]
+    test_key_notification = create_notification(
+        template=sms_template, created_at=created_at, status='created', key_type='test'
+    )
+
+    with set_config(notify_api, 'DELIVER_SMS_BATCH_SIZE', 2):
+        replay_created_notifications()
+
+    batches = [(call[0][0][0], call[1]['queue']) for call in sms_delivery_queue.call_args_list]
+    assert sorted(len(ids) for ids, queue in batches if queue == 'send-sms-tasks') == [1, 2, 2]
+    assert sorted(id for ids, queue in batches if queue == 'send-sms-tasks' for id in ids) == \
+        sorted(str(x.id) for x in notifications)
+    assert [ids for ids, queue in batches if queue == 'research-mode-tasks'] == [[str(test_key_notification.id)]]
+
+
+def test_replay_created_notifications_stops_at_limit(notify_api, sample_service, mocker):
+    sms_delivery_queue = mocker.patch('app.celery.provider_tasks.deliver_sms_batch.apply_async')
+    mocker.patch('app.celery.provider_tasks.deliver_email_batch.apply_async')
+
+    sms_template = create_template(service=sample_service, template_type='sms')
+    for _ in range(3):
+        create_notification(template=sms_template, created_at=datetime.utcnow() - timedelta(hours=5), status='created')
+
+    with set_config(notify_api, 'REPLAY_CREATED_NOTIFICATIONS_LIMIT', 2):
+        replay_created_notifications()
+
+    assert len(sms_delivery_queue.call_args[0][0][0]) == 2
@@ -1,7 +1,7 @@
 import json
 import uuid
 from datetime import datetime, timedelta
-from unittest.mock import Mock, call
+from unittest.mock import ANY, Mock, call
 
 import pytest
 import requests_mock
@@ -24,6 +24,7 @@ from app.celery.tasks import (
     save_letter,
     process_incomplete_job,
     process_incomplete_jobs,
+    publish_letters_pdf_batches,
     get_template_class,
     s3,
     send_inbound_sms_to_service,
@@ -64,7 +65,7 @@ from tests.app.db import (
     create_reply_to_email,
     create_service_with_defined_sms_sender,
 )
-from tests.conftest import set_config_values
+from tests.conftest import set_config, set_config_values
 
 
 class AnyStringWith(str):
@@ -122,7 +123,8 @@ def test_should_process_sms_job(sample_job, mocker):
         (str(sample_job.service_id),
          "uuid",
          "something_encrypted"),
-        queue="database-tasks"
+        queue="database-tasks",
+        producer=ANY
     )
     job = jobs_dao.dao_get_job_by_id(sample_job.id)
     assert job.job_status == 'finished'
@@ -238,7 +240,8 @@ def test_should_process_email_job_if_exactly_on_send_limits(notify_db,
             "uuid",
             "something_encrypted",
         ),
-        queue="database-tasks"
+        queue="database-tasks",
+        producer=ANY
     )
 
 
@@ -282,7 +285,8 @@ def test_should_process_email_job(email_job_with_placeholders, mocker):
             "uuid",
             "something_encrypted",
         ),
-        queue="database-tasks"
+        queue="database-tasks",
+        producer=ANY
     )
     job = jobs_dao.dao_get_job_by_id(email_job_with_placeholders.id)
     assert job.job_status == 'finished'
@@ -294,8 +298,8 @@ def test_should_process_letter_job(sample_letter_job, mocker):
     A1,A2,A3,A4,A_POST,Alice
     """
     s3_mock = mocker.patch('app.celery.tasks.s3.get_job_from_s3', return_value=csv)
-    process_row_mock = mocker.patch('app.celery.tasks.process_row')
-    mocker.patch('app.celery.tasks.create_uuid', return_value="uuid")
+    mock_save_letter = mocker.patch('app.celery.tasks.save_letter.apply_async')
+    mock_create_letters_pdf_batch = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf_batch.apply_async')
 
     process_job(sample_letter_job.id)
 
@@ -304,24 +308,52 @@ def test_should_process_letter_job(sample_letter_job, mocker):
         str(sample_letter_job.id)
     )
 
-    row_call = process_row_mock.mock_calls[0][1]
-    assert row_call[0].index == 0
-    assert row_call[0].recipient == ['A1', 'A2', 'A3', 'A4', None, None, 'A_POST']
-    assert row_call[0].personalisation == {
+    # letters are saved before the batch that creates their PDFs is published
+    notification = Notification.query.filter(Notification.job_id == sample_letter_job.id).one()
+    assert notification.to == 'A1'
+    assert notification.job_row_number == 0
+    assert notification.status == 'created'
+    assert notification.personalisation == {
         'addressline1': 'A1',
         'addressline2': 'A2',
         'addressline3': 'A3',
         'addressline4': 'A4',
         'postcode': 'A_POST'
     }
-    assert row_call[2] == sample_letter_job
-    assert row_call[3] == sample_letter_job.service
-
-    assert process_row_mock.call_count == 1
+    assert not mock_save_letter.called
+    mock_create_letters_pdf_batch.assert_called_once_with(
+        [[str(notification.id)]], queue=QueueNames.CREATE_LETTERS_PDF, producer=ANY
+    )
 
     assert sample_letter_job.job_status == 'finished'
 
 
+def test_should_process_letter_job_in_research_mode_with_save_letter_tasks(sample_letter_job, mocker):
+    sample_letter_job.service.research_mode = True
+    mocker.patch('app.celery.tasks.s3.get_job_from_s3', return_value=load_example_csv('multiple_letter'))
+    mock_save_letter = mocker.patch('app.celery.tasks.save_letter.apply_async')
+    mock_create_letters_pdf_batch = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf_batch.apply_async')
+
+    process_job(sample_letter_job.id)
+
+    assert mock_save_letter.call_count == 10
+    assert not mock_create_letters_pdf_batch.called
+
+
+def test_save_letters_from_job_publishes_letters_saved_before_a_failure(sample_letter_job, mocker):
+    mocker.patch('app.celery.tasks.s3.get_job_from_s3', return_value=load_example_csv('multiple_letter'))
+    mocker.patch('app.celery.tasks.create_uuid', side_effect=['1', '2', '3'])
+    mocker.patch('app.celery.tasks._persist_letter', side_effect=[Mock(), Mock(), SQLAlchemyError()])
+    mock_create_letters_pdf_batch = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf_batch.apply_async')
+
+    with pytest.raises(SQLAlchemyError):
+        process_job(sample_letter_job.id)
+
+    mock_create_letters_pdf_batch.assert_called_once_with(
+        [['1', '2']], queue=QueueNames.CREATE_LETTERS_PDF, producer=ANY
+    )
+
+
 def test_should_process_all_sms_job(sample_job_with_placeholdered_template,
                                     mocker):
     mocker.patch('app.celery.tasks.s3.get_job_from_s3', return_value=load_example_csv('multiple_sms'))
@@ -1166,7 +1198,7 @@ def test_save_letter_calls_create_fake_response_for_letters_in_research_mode_on_
     )
 
 
-def test_save_letter_calls_create_letters_pdf_task_not_in_research(
+def test_save_letter_leaves_creating_the_pdf_to_the_job(
         mocker, notify_db_session, sample_letter_job):
     mock_create_letters_pdf = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf.apply_async')
 
@@ -1190,11 +1222,23 @@ def test_save_letter_calls_create_letters_pdf_task_not_in_research(
         encryption.encrypt(notification_json),
     )
 
-    assert mock_create_letters_pdf.called
-    mock_create_letters_pdf.assert_called_once_with(
-        [str(notification_id)],
-        queue=QueueNames.CREATE_LETTERS_PDF
-    )
+    assert Notification.query.get(notification_id).status == 'created'
+    assert not mock_create_letters_pdf.called
+
+
+@pytest.mark.parametrize('research_mode, expected_batches', [
+    (False, [['1', '2'], ['3']]),
+    (True, []),
+])
+def test_publish_letters_pdf_batches(notify_api, mocker, research_mode, expected_batches):
+    mock_create_letters_pdf_batch = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf_batch.apply_async')
+
+    with set_config(notify_api, 'CREATE_LETTERS_PDF_BATCH_SIZE', 2):
+        publish_letters_pdf_batches(['1', '2', '3'], Mock(research_mode=research_mode))
+
+    assert mock_create_letters_pdf_batch.call_args_list == [
+        call([batch], queue=QueueNames.CREATE_LETTERS_PDF) for batch in expected_batches
+    ]
 
 
 def test_should_cancel_job_if_service_is_inactive(sample_service,
@@ -1510,6 +1554,7 @@ def test_process_incomplete_job_email(mocker, sample_email_template):
 def test_process_incomplete_job_letter(mocker, sample_letter_template):
     mocker.patch('app.celery.tasks.s3.get_job_from_s3', return_value=load_example_csv('multiple_letter'))
     mock_letter_saver = mocker.patch('app.celery.tasks.save_letter.apply_async')
+    mock_create_letters_pdf_batch = mocker.patch('app.celery.letters_pdf_tasks.create_letters_pdf_batch.apply_async')
 
     job = create_job(template=sample_letter_template, notification_count=10,
                      created_at=datetime.utcnow() - timedelta(hours=2),
@@ -1524,10 +1569,14 @@ def test_process_incomplete_job_letter(mocker, sample_letter_template):
 
     process_incomplete_job(str(job.id))
 
-    assert mock_letter_saver.call_count == 8
+    assert not mock_letter_saver.called
+    resumed = Notification.query.filter(Notification.job_id == job.id, Notification.job_row_number > 1).all()
+    assert len(resumed) == 8
+    notification_ids = mock_create_letters_pdf_batch.call_args[0][0][0]
+    assert sorted(notification_ids) == sorted(str(notification.id) for notification in resumed)
+    mock_create_letters_pdf_batch.assert_called_once_with([notification_ids], queue=QueueNames.CREATE_LETTERS_PDF)
 
 
-@freeze_time('2017-01-01')
 def test_process_incomplete_jobs_sets_status_to_in_progress_and_resets_processing_started_time(mocker, sample_template):
     mock_process_incomplete_job = mocker.patch('app.celery.tasks.process_incomplete_job')
 
@@ -4,7 +4,7 @@ from unittest.mock import Mock, ANY
 from notifications_utils.recipients import InvalidEmailError
 
 from app import aws_ses_client
-from app.clients.email.aws_ses import get_aws_responses, AwsSesClientException
+from app.clients.email.aws_ses import get_aws_responses, AwsSesClient, AwsSesClientException
 
 
 def test_should_return_correct_details_for_delivery():
@@ -118,3 +118,29 @@ def test_send_email_raises_other_errs_as_AwsSesClientException(mocker):
         )
 
     assert 'some error message from amazon' in str(excinfo.value)
+
+
+def test_boto_client_is_created_on_first_use(mocker):
+    boto_client = mocker.patch('app.clients.email.aws_ses.boto3.session.Session').return_value.client
+    client = AwsSesClient()
+    client.init_app('eu-west-1', statsd_client=Mock(), max_pool_connections=25)
+
+    assert not boto_client.called
+
+    assert client.get_boto_client() == boto_client.return_value
+    assert client.get_boto_client() == boto_client.return_value
+    boto_client.assert_called_once_with('ses', region_name='eu-west-1', config=ANY)
+    assert boto_client.call_args[1]['config'].max_pool_connections == 25
+
+
+def test_boto_client_is_created_again_in_a_new_process(mocker):
+    boto_client = mocker.patch('app.clients.email.aws_ses.boto3.session.Session').return_value.client
+    mocker.patch('app.clients.email.aws_ses.os.getpid', side_effect=[100, 100, 100, 101, 101])
+    client = AwsSesClient()
+    client.init_app('eu-west-1', statsd_client=Mock())
+
+    client.get_boto_client()
+    client.get_boto_client()
+    client.get_boto_client()
+
+    assert boto_client.call_count == 2
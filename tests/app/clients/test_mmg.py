@@ -129,3 +129,16 @@ def test_send_sms_raises_if_mmg_rejects_with_read_timeout(rmock):
 
     assert exc.value.status_code == 504
     assert exc.value.text == 'Gateway Time-out'
+
+
+def test_send_sms_reuses_pooled_session(notify_api, mocker):
+    session = mmg_client.session
+
+    with requests_mock.Mocker() as request_mock:
+        request_mock.post('https://api.mmg.co.uk/json/api.php', json={'Reference': 12345678}, status_code=200)
+        mmg_client.send_sms('+447234567890', 'my message', 'ref-1')
+        mmg_client.send_sms('+447234567890', 'my message', 'ref-2')
+
+    assert request_mock.call_count == 2
+    assert mmg_client.session is session
+    assert session.get_adapter('https://api.mmg.co.uk')._pool_maxsize == 10
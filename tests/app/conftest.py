@@ -10,7 +10,7 @@ import requests_mock
 from sqlalchemy import asc
 from sqlalchemy.orm.session import make_transient
 
-from app import db
+from app import db, notify_celery
 from app.models import (
     Service,
     Template,
@@ -63,6 +63,28 @@ from tests.app.db import (
 )
 
 
+@pytest.fixture(autouse=True)
+def celery_producer(mocker):
+    """
+    Batched publishing takes a producer from celery's pool, which would connect to the broker. Tests mock the
+    tasks being published, so hand out a mock producer instead.
+    """
+    producer = mocker.Mock()
+    producer_context = mocker.MagicMock()
+    producer_context.__enter__.return_value = producer
+    mocker.patch.object(notify_celery, 'producer_or_acquire', return_value=producer_context)
+    return producer
+
+
+@pytest.fixture(autouse=True)
+def fresh_s3_client(mocker):
+    """
+    Each process keeps one S3 client. Make a new one for each test, so a client made while one test had moto
+    running isn't used by the next.
+    """
+    mocker.patch.dict('app.aws.s3._client', {'pid': None, 'client': None, 'reused': 0, 'reported_at': None})
+
+
 @pytest.yield_fixture
 def rmock():
     with requests_mock.mock() as rmock:
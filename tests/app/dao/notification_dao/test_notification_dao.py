@@ -6,19 +6,22 @@ import pytest
 from freezegun import freeze_time
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 
+from app import instrumentation
 from app.dao.notifications_dao import (
     dao_create_notification,
     dao_created_scheduled_notification,
     dao_delete_notifications_and_history_by_id,
     dao_get_count_of_letters_to_process_for_date,
+    dao_get_delivery_counts_for_provider,
     dao_get_last_notification_added_for_job_id,
     dao_get_last_template_usage,
     dao_get_notifications_by_to_field,
-    dao_get_scheduled_notifications,
+    dao_lock_scheduled_notifications_to_send,
     dao_get_template_usage,
     dao_timeout_notifications,
     dao_update_notification,
     dao_update_notifications_by_reference,
+    dao_update_notifications_sent_to_provider,
     delete_notifications_created_more_than_a_week_ago_by_type,
     get_notification_by_id,
     get_notification_for_job,
@@ -26,12 +29,16 @@ from app.dao.notifications_dao import (
     get_notifications_for_job,
     get_notifications_for_service,
     get_total_sent_notifications_in_date_range,
-    is_delivery_slow_for_provider,
-    set_scheduled_notification_to_processed,
+    set_scheduled_notifications_to_processed,
     update_notification_status_by_id,
     update_notification_status_by_reference,
     dao_get_notification_by_reference,
     dao_get_notifications_by_references,
+    dao_get_notification_statuses_by_references,
+    dao_get_billable_units_by_references,
+    dao_update_letter_notifications_by_reference,
+    dao_update_notifications_billable_units,
+    dao_get_notifications_by_ids,
     dao_get_notification_history_by_reference,
     notifications_not_yet_sent,
     fetch_aggregate_stats_by_date_range_for_all_services,
@@ -789,7 +796,7 @@ def test_dao_timeout_notifications(sample_template):
     assert Notification.query.get(sending.id).status == 'sending'
     assert Notification.query.get(pending.id).status == 'pending'
     assert Notification.query.get(delivered.id).status == 'delivered'
-    technical_failure_notifications, temporary_failure_notifications = dao_timeout_notifications(1)
+    technical_failure_notifications, temporary_failure_notifications = dao_timeout_notifications(1, 10)
     assert Notification.query.get(created.id).status == 'technical-failure'
     assert Notification.query.get(sending.id).status == 'temporary-failure'
     assert Notification.query.get(pending.id).status == 'temporary-failure'
@@ -801,6 +808,37 @@ def test_dao_timeout_notifications(sample_template):
     assert len(technical_failure_notifications + temporary_failure_notifications) == 3
 
 
+def test_dao_timeout_notifications_returns_ids_and_service_ids(sample_template):
+    with freeze_time(datetime.utcnow() - timedelta(minutes=2)):
+        created = create_notification(sample_template, status='created')
+        sending = create_notification(sample_template, status='sending')
+
+    technical_failure_notifications, temporary_failure_notifications = dao_timeout_notifications(1, 10)
+
+    assert [(x.id, x.service_id) for x in technical_failure_notifications] == [(created.id, created.service_id)]
+    assert [(x.id, x.service_id) for x in temporary_failure_notifications] == [(sending.id, sending.service_id)]
+
+
+def test_dao_timeout_notifications_times_out_at_most_limit_for_each_status(sample_template):
+    with freeze_time(datetime.utcnow() - timedelta(minutes=2)):
+        for status in ['created', 'created', 'created', 'sending', 'pending', 'sending']:
+            create_notification(sample_template, status=status)
+
+    technical_failure_notifications, temporary_failure_notifications = dao_timeout_notifications(1, 2)
+
+    assert len(technical_failure_notifications) == 2
+    assert len(temporary_failure_notifications) == 2
+    assert Notification.query.filter_by(status='technical-failure').count() == 2
+    assert NotificationHistory.query.filter_by(status='technical-failure').count() == 2
+    assert Notification.query.filter_by(status='created').count() == 1
+
+    technical_failure_notifications, temporary_failure_notifications = dao_timeout_notifications(1, 2)
+
+    assert len(technical_failure_notifications) == 1
+    assert len(temporary_failure_notifications) == 1
+    assert Notification.query.filter_by(status='temporary-failure').count() == 3
+
+
 def test_dao_timeout_notifications_only_updates_for_older_notifications(sample_template):
     with freeze_time(datetime.utcnow() + timedelta(minutes=10)):
         created = create_notification(sample_template, status='created')
@@ -812,7 +850,7 @@ def test_dao_timeout_notifications_only_updates_for_older_notifications(sample_t
     assert Notification.query.get(sending.id).status == 'sending'
     assert Notification.query.get(pending.id).status == 'pending'
     assert Notification.query.get(delivered.id).status == 'delivered'
-    technical_failure_notifications, temporary_failure_notifications = dao_timeout_notifications(1)
+    technical_failure_notifications, temporary_failure_notifications = dao_timeout_notifications(1, 10)
     assert NotificationHistory.query.get(created.id).status == 'created'
     assert NotificationHistory.query.get(sending.id).status == 'sending'
     assert NotificationHistory.query.get(pending.id).status == 'pending'
@@ -832,7 +870,7 @@ def test_dao_timeout_notifications_doesnt_affect_letters(sample_letter_template)
     assert Notification.query.get(pending.id).status == 'pending'
     assert Notification.query.get(delivered.id).status == 'delivered'
 
-    technical_failure_notifications, temporary_failure_notifications = dao_timeout_notifications(1)
+    technical_failure_notifications, temporary_failure_notifications = dao_timeout_notifications(1, 10)
 
     assert NotificationHistory.query.get(created.id).status == 'created'
     assert NotificationHistory.query.get(sending.id).status == 'sending'
@@ -1171,14 +1209,12 @@ def test_get_total_sent_notifications_for_email_excludes_sms_counts(
 
 
 @freeze_time("2016-01-10 12:00:00.000000")
-def test_slow_provider_delivery_returns_for_sent_notifications(
-    sample_template
-):
+def test_dao_get_delivery_counts_for_provider(sample_template):
     now = datetime.utcnow()
     one_minute_from_now = now + timedelta(minutes=1)
     five_minutes_from_now = now + timedelta(minutes=5)
 
-    notification_five_minutes_to_deliver = partial(
+    delivered_by_mmg = partial(
         create_notification,
         template=sample_template,
         status='delivered',
@@ -1186,115 +1222,17 @@ def test_slow_provider_delivery_returns_for_sent_notifications(
         updated_at=five_minutes_from_now
     )
 
-    notification_five_minutes_to_deliver(sent_at=now)
-    notification_five_minutes_to_deliver(sent_at=one_minute_from_now)
-    notification_five_minutes_to_deliver(sent_at=one_minute_from_now)
+    delivered_by_mmg(sent_at=now)
+    delivered_by_mmg(sent_at=one_minute_from_now)
+    delivered_by_mmg(sent_at=one_minute_from_now, updated_at=one_minute_from_now + timedelta(seconds=10))
+    delivered_by_mmg(sent_at=one_minute_from_now, status='sending')
+    delivered_by_mmg(sent_at=one_minute_from_now, sent_by='firetext')
 
-    slow_delivery = is_delivery_slow_for_provider(
+    assert dao_get_delivery_counts_for_provider(
+        'mmg',
         sent_at=one_minute_from_now,
-        provider='mmg',
-        threshold=2,
-        delivery_time=timedelta(minutes=3),
-        service_id=sample_template.service.id,
-        template_id=sample_template.id
-    )
-
-    assert slow_delivery
-
-
-@freeze_time("2016-01-10 12:00:00.000000")
-def test_slow_provider_delivery_observes_threshold(
-    sample_template
-):
-    now = datetime.utcnow()
-    five_minutes_from_now = now + timedelta(minutes=5)
-
-    notification_five_minutes_to_deliver = partial(
-        create_notification,
-        template=sample_template,
-        status='delivered',
-        sent_at=now,
-        sent_by='mmg',
-        updated_at=five_minutes_from_now
-    )
-
-    notification_five_minutes_to_deliver()
-    notification_five_minutes_to_deliver()
-
-    slow_delivery = is_delivery_slow_for_provider(
-        sent_at=now,
-        provider='mmg',
-        threshold=3,
-        delivery_time=timedelta(minutes=5),
-        service_id=sample_template.service.id,
-        template_id=sample_template.id
-    )
-
-    assert not slow_delivery
-
-
-@freeze_time("2016-01-10 12:00:00.000000")
-def test_slow_provider_delivery_returns_for_delivered_notifications_only(
-    sample_template
-):
-    now = datetime.utcnow()
-    five_minutes_from_now = now + timedelta(minutes=5)
-
-    notification_five_minutes_to_deliver = partial(
-        create_notification,
-        template=sample_template,
-        sent_at=now,
-        sent_by='firetext',
-        created_at=now,
-        updated_at=five_minutes_from_now
-    )
-
-    notification_five_minutes_to_deliver(status='sending')
-    notification_five_minutes_to_deliver(status='delivered')
-    notification_five_minutes_to_deliver(status='delivered')
-
-    slow_delivery = is_delivery_slow_for_provider(
-        sent_at=now,
-        provider='firetext',
-        threshold=2,
-        delivery_time=timedelta(minutes=5),
-        service_id=sample_template.service.id,
-        template_id=sample_template.id
-    )
-
-    assert slow_delivery
-
-
-@freeze_time("2016-01-10 12:00:00.000000")
-def test_slow_provider_delivery_does_not_return_for_standard_delivery_time(
-    sample_template
-):
-    now = datetime.utcnow()
-    five_minutes_from_now = now + timedelta(minutes=5)
-
-    notification = partial(
-        create_notification,
-        template=sample_template,
-        created_at=now,
-        sent_at=now,
-        sent_by='mmg',
-        status='delivered'
-    )
-
-    notification(updated_at=five_minutes_from_now - timedelta(seconds=1))
-    notification(updated_at=five_minutes_from_now - timedelta(seconds=1))
-    notification(updated_at=five_minutes_from_now)
-
-    slow_delivery = is_delivery_slow_for_provider(
-        sent_at=now,
-        provider='mmg',
-        threshold=2,
-        delivery_time=timedelta(minutes=5),
-        service_id=sample_template.service.id,
-        template_id=sample_template.id
-    )
-
-    assert not slow_delivery
+        delivery_time=timedelta(minutes=3)
+    ) == (2, 1)
 
 
 def test_dao_get_notifications_by_to_field(sample_template):
@@ -1513,32 +1451,31 @@ def test_dao_created_scheduled_notification(sample_notification):
     assert saved_notification[0].scheduled_for == datetime(2017, 1, 5, 14, 15)
 
 
-def test_dao_get_scheduled_notifications(notify_db, notify_db_session, sample_template):
+def test_set_scheduled_notification_to_processed(notify_db, notify_db_session, sample_template):
     notification_1 = sample_notification(notify_db=notify_db, notify_db_session=notify_db_session,
                                          template=sample_template, scheduled_for='2017-05-05 14:15',
                                          status='created')
-    sample_notification(notify_db=notify_db, notify_db_session=notify_db_session,
-                        template=sample_template, scheduled_for='2017-05-04 14:15', status='delivered')
-    sample_notification(notify_db=notify_db, notify_db_session=notify_db_session,
-                        template=sample_template, status='created')
-    scheduled_notifications = dao_get_scheduled_notifications()
-    assert len(scheduled_notifications) == 1
-    assert scheduled_notifications[0].id == notification_1.id
-    assert scheduled_notifications[0].scheduled_notification.pending
+    assert notification_1.scheduled_notification.pending
 
+    set_scheduled_notifications_to_processed([notification_1.id])
+    assert not ScheduledNotification.query.filter_by(notification_id=notification_1.id).one().pending
 
-def test_set_scheduled_notification_to_processed(notify_db, notify_db_session, sample_template):
-    notification_1 = sample_notification(notify_db=notify_db, notify_db_session=notify_db_session,
-                                         template=sample_template, scheduled_for='2017-05-05 14:15',
-                                         status='created')
-    scheduled_notifications = dao_get_scheduled_notifications()
-    assert len(scheduled_notifications) == 1
-    assert scheduled_notifications[0].id == notification_1.id
-    assert scheduled_notifications[0].scheduled_notification.pending
 
-    set_scheduled_notification_to_processed(notification_1.id)
-    scheduled_notifications = dao_get_scheduled_notifications()
-    assert not scheduled_notifications
+@freeze_time('2017-05-06 12:00')
+def test_dao_lock_scheduled_notifications_to_send(sample_template, sample_email_template, sample_letter_template):
+    later = create_notification(template=sample_template, scheduled_for='2017-05-05 14:15')
+    earlier = create_notification(template=sample_email_template, scheduled_for='2017-05-05 10:15')
+    create_notification(template=sample_template, scheduled_for='2017-05-05 09:15', status='delivered')
+    create_notification(template=sample_template, scheduled_for='2017-05-06 14:15')
+    create_notification(template=sample_letter_template, scheduled_for='2017-05-05 09:15')
+
+    scheduled_notifications = dao_lock_scheduled_notifications_to_send(10)
+
+    assert [(n.id, n.notification_type, n.key_type, n.research_mode) for n in scheduled_notifications] == [
+        (earlier.id, 'email', 'normal', False),
+        (later.id, 'sms', 'normal', False),
+    ]
+    assert [n.id for n in dao_lock_scheduled_notifications_to_send(1)] == [earlier.id]
 
 
 def test_dao_get_notifications_by_to_field_filters_status(sample_template):
@@ -1675,6 +1612,53 @@ def test_dao_update_notifications_by_reference_updated_notificaitons_and_history
     assert notification_0 == Notification.query.get(notification_0.id)
 
 
+def test_dao_update_notifications_sent_to_provider_updates_notifications_and_history(sample_template):
+    notification_1 = create_notification(template=sample_template)
+    notification_2 = create_notification(template=sample_template)
+    untouched = create_notification(template=sample_template)
+    sent_at = datetime.utcnow()
+
+    dao_update_notifications_sent_to_provider([
+        {'id': notification_1.id, 'status': 'sending', 'sent_at': sent_at, 'sent_by': 'mmg',
+         'reference': 'ref-1', 'billable_units': 1},
+        {'id': notification_2.id, 'status': 'technical-failure', 'sent_at': None, 'sent_by': None,
+         'reference': None, 'billable_units': 0},
+    ])
+
+    for model in (Notification, NotificationHistory):
+        updated_1 = model.query.get(notification_1.id)
+        assert updated_1.status == 'sending'
+        assert updated_1.sent_at == sent_at
+        assert updated_1.sent_by == 'mmg'
+        assert updated_1.reference == 'ref-1'
+        assert updated_1.billable_units == 1
+        assert updated_1.updated_at
+        assert model.query.get(notification_2.id).status == 'technical-failure'
+        assert model.query.get(untouched.id).status == 'created'
+
+
+def test_dao_update_notifications_sent_to_provider_ignores_notifications_without_history(sample_template):
+    notification = create_notification(template=sample_template, key_type=KEY_TYPE_TEST)
+
+    dao_update_notifications_sent_to_provider([
+        {'id': notification.id, 'status': 'sending', 'sent_at': datetime.utcnow(), 'sent_by': 'mmg',
+         'reference': None, 'billable_units': 0},
+    ])
+
+    assert Notification.query.get(notification.id).status == 'sending'
+    assert NotificationHistory.query.get(notification.id) is None
+
+
+def test_dao_get_notifications_by_ids(sample_template):
+    notification_1 = create_notification(template=sample_template)
+    notification_2 = create_notification(template=sample_template)
+    create_notification(template=sample_template)
+
+    notifications = dao_get_notifications_by_ids([notification_1.id, notification_2.id, uuid.uuid4()])
+
+    assert {n.id for n in notifications} == {notification_1.id, notification_2.id}
+
+
 def test_dao_update_notifications_by_reference_returns_zero_when_no_notifications_to_update(notify_db):
     updated_count = dao_update_notifications_by_reference(references=['ref'],
                                                           update_dict={"status": "delivered",
@@ -1714,6 +1698,92 @@ def test_dao_get_notifications_by_reference(sample_template):
     assert notifications[1].id in [notification_1.id, notification_2.id]
 
 
+def test_dao_get_notification_statuses_by_references_queries_in_batches(notify_api, sample_template):
+    create_notification(template=sample_template, reference='ref1')
+    create_notification(template=sample_template, reference='ref2', status='sending')
+    create_notification(template=sample_template, reference='ref3')
+    create_notification(template=sample_template, reference='other')
+
+    with notify_api.app_context():
+        statuses = dao_get_notification_statuses_by_references(['ref1', 'ref2', 'ref3', 'missing'], batch_size=2)
+        queries, _ = instrumentation.get_timing_totals()['db']
+
+    assert statuses == {'ref1': 'created', 'ref2': 'sending', 'ref3': 'created'}
+    assert queries == 2
+
+
+def test_dao_update_letter_notifications_by_reference_updates_both_tables(sample_letter_template):
+    delivered = create_notification(sample_letter_template, reference='ref1', status='sending')
+    failed = create_notification(sample_letter_template, reference='ref2', status='sending')
+    history_only = create_notification(sample_letter_template, reference='ref3', status='sending')
+    Notification.query.filter_by(id=history_only.id).delete()
+
+    with freeze_time('2018-01-01 12:00'):
+        not_found = dao_update_letter_notifications_by_reference([
+            ('ref1', 'delivered', 1),
+            ('ref2', 'temporary-failure', 2),
+            ('ref3', 'delivered', 3),
+            ('ref4', 'delivered', 4),
+        ], batch_size=10)
+
+    assert not_found == ['ref4']
+    assert (delivered.status, delivered.billable_units, delivered.updated_at) == (
+        'delivered', 1, datetime(2018, 1, 1, 12)
+    )
+    assert (failed.status, failed.billable_units) == ('temporary-failure', 2)
+    for notification_id, status, billable_units in [
+        (delivered.id, 'delivered', 1), (failed.id, 'temporary-failure', 2), (history_only.id, 'delivered', 3)
+    ]:
+        history = NotificationHistory.query.get(notification_id)
+        assert (history.status, history.billable_units) == (status, billable_units)
+
+
+def test_dao_update_letter_notifications_by_reference_does_nothing_without_updates(notify_db_session):
+    assert dao_update_letter_notifications_by_reference([], batch_size=10) == []
+
+
+def test_dao_update_letter_notifications_by_reference_updates_in_batches(notify_api, sample_letter_template):
+    notifications = [
+        create_notification(sample_letter_template, reference='ref{}'.format(i), status='sending') for i in range(3)
+    ]
+
+    with notify_api.app_context():
+        not_found = dao_update_letter_notifications_by_reference([
+            ('ref0', 'delivered', 1),
+            ('ref1', 'delivered', 1),
+            ('ref2', 'delivered', 1),
+            ('missing', 'delivered', 1),
+        ], batch_size=2)
+        queries, _ = instrumentation.get_timing_totals()['db']
+
+    assert not_found == ['missing']
+    assert [notification.status for notification in notifications] == ['delivered'] * 3
+    # an update of each table for each batch
+    assert queries == 4
+
+
+def test_dao_update_notifications_billable_units_updates_both_tables(sample_letter_template):
+    first = create_notification(sample_letter_template)
+    second = create_notification(sample_letter_template)
+
+    dao_update_notifications_billable_units({first.id: 2, second.id: 3})
+
+    assert (first.billable_units, second.billable_units) == (2, 3)
+    assert NotificationHistory.query.get(first.id).billable_units == 2
+    assert NotificationHistory.query.get(second.id).billable_units == 3
+
+
+def test_dao_get_billable_units_by_references_reads_history_for_missing_notifications(sample_letter_template):
+    notification = create_notification(sample_letter_template, reference='ref1', billable_units=2)
+    history_only = create_notification(sample_letter_template, reference='ref2', billable_units=3)
+    Notification.query.filter_by(id=history_only.id).delete()
+
+    assert dao_get_billable_units_by_references(['ref1', 'ref2', 'ref3']) == {
+        'ref1': (notification.id, 2),
+        'ref2': (history_only.id, 3),
+    }
+
+
 def test_dao_get_notification_history_by_reference_with_one_match_returns_notification(
         sample_letter_template
 ):
@@ -1828,9 +1898,19 @@ def test_notifications_not_yet_sent(sample_service, notification_type):
                         status='sending')
     create_notification(template=template, created_at=datetime.utcnow(), status='created')
 
-    results = notifications_not_yet_sent(older_than, notification_type)
+    results = notifications_not_yet_sent(older_than, notification_type).all()
     assert len(results) == 1
-    assert results[0] == old_notification
+    assert results[0].id == old_notification.id
+    assert results[0].key_type == 'normal'
+    assert results[0].research_mode is False
+
+
+def test_notifications_not_yet_sent_observes_limit(sample_template):
+    for _ in range(3):
+        create_notification(template=sample_template, created_at=datetime.utcnow() - timedelta(seconds=5),
+                            status='created')
+
+    assert len(notifications_not_yet_sent(4, 'sms', limit=2).all()) == 2
 
 
 @pytest.mark.parametrize("notification_type",
@@ -1847,7 +1927,7 @@ def test_notifications_not_yet_sent_return_no_rows(sample_service, notification_
                         status='sending')
     create_notification(template=template, created_at=datetime.utcnow(), status='delivered')
 
-    results = notifications_not_yet_sent(older_than, notification_type)
+    results = notifications_not_yet_sent(older_than, notification_type).all()
     assert len(results) == 0
 
 
@@ -0,0 +1,65 @@
+from app.dao.letter_ack_dao import (
+    dao_get_acked_zip_file_names,
+    dao_get_recorded_ack_file_names,
+    dao_get_zip_file_names_in_ack_files_for_day,
+    dao_record_letter_acks,
+)
+from app.models import LetterAck, LetterAckFile
+
+
+def test_dao_record_letter_acks(notify_db_session):
+    dao_record_letter_acks('ACK1.txt', ['ZIP1', 'ZIP2'])
+
+    acks = LetterAck.query.order_by(LetterAck.zip_file_name).all()
+
+    assert [(ack.zip_file_name, ack.ack_file_name) for ack in acks] == [('ZIP1', 'ACK1.txt'), ('ZIP2', 'ACK1.txt')]
+    assert all(ack.created_at for ack in acks)
+    assert [ack_file.ack_file_name for ack_file in LetterAckFile.query.all()] == ['ACK1.txt']
+
+
+def test_dao_record_letter_acks_keeps_each_ack_for_a_zip(notify_db_session):
+    dao_record_letter_acks('ACK1.txt', ['ZIP1'])
+    dao_record_letter_acks('ACK2.txt', ['ZIP1', 'ZIP2'])
+
+    acks = LetterAck.query.order_by(LetterAck.zip_file_name, LetterAck.ack_file_name).all()
+
+    assert [(ack.zip_file_name, ack.ack_file_name) for ack in acks] == [
+        ('ZIP1', 'ACK1.txt'), ('ZIP1', 'ACK2.txt'), ('ZIP2', 'ACK2.txt')
+    ]
+
+
+def test_dao_record_letter_acks_twice_does_nothing(notify_db_session):
+    dao_record_letter_acks('ACK1.txt', ['ZIP1'])
+    dao_record_letter_acks('ACK1.txt', ['ZIP1'])
+
+    assert LetterAck.query.count() == 1
+    assert LetterAckFile.query.count() == 1
+
+
+def test_dao_record_letter_acks_with_no_zips_records_the_ack_file(notify_db_session):
+    dao_record_letter_acks('ACK1.txt', [])
+
+    assert LetterAck.query.count() == 0
+    assert dao_get_recorded_ack_file_names({'ACK1.txt'}) == {'ACK1.txt'}
+
+
+def test_dao_get_acked_zip_file_names(notify_db_session):
+    dao_record_letter_acks('ACK1.txt', ['ZIP1', 'ZIP2'])
+    dao_record_letter_acks('ACK2.txt', ['ZIP1'])
+
+    assert dao_get_acked_zip_file_names({'ZIP1', 'ZIP3'}) == {'ZIP1'}
+    assert dao_get_acked_zip_file_names(set()) == set()
+
+
+def test_dao_get_zip_file_names_in_ack_files_for_day(notify_db_session):
+    dao_record_letter_acks('NOTIFY.20180110175733.ACK.txt', ['ZIP1', 'ZIP2'])
+    dao_record_letter_acks('NOTIFY.20180111175733.ACK.txt', ['ZIP2', 'ZIP3'])
+
+    assert dao_get_zip_file_names_in_ack_files_for_day('20180111') == {'ZIP2', 'ZIP3'}
+
+
+def test_dao_get_recorded_ack_file_names(notify_db_session):
+    dao_record_letter_acks('ACK1.txt', ['ZIP1', 'ZIP2'])
+
+    assert dao_get_recorded_ack_file_names({'ACK1.txt', 'ACK2.txt'}) == {'ACK1.txt'}
+    assert dao_get_recorded_ack_file_names(set()) == set()
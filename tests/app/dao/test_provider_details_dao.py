@@ -287,3 +287,20 @@ def test_get_current_sms_provider_returns_active_only(restore_provider_details):
     new_current_provider = get_current_provider('sms')
 
     assert current_provider.identifier != new_current_provider.identifier
+
+
+def test_dao_update_provider_details_invalidates_provider_routing(restore_provider_details, mocker):
+    invalidate = mocker.patch('app.dao.provider_details_dao.invalidate_provider_routing')
+
+    dao_update_provider_details(get_provider_details_by_identifier('mmg'))
+
+    invalidate.assert_called_once_with()
+
+
+def test_dao_switch_sms_provider_invalidates_provider_routing(restore_provider_details, mocker):
+    invalidate = mocker.patch('app.dao.provider_details_dao.invalidate_provider_routing')
+    current_sms_provider = get_current_provider('sms')
+
+    dao_toggle_sms_provider(current_sms_provider.identifier)
+
+    assert invalidate.called
@@ -3,19 +3,23 @@ from collections import namedtuple
 from datetime import datetime
 from unittest.mock import ANY
 
+import boto3
 import pytest
 from flask import current_app
-from notifications_utils.recipients import validate_and_format_phone_number
+from moto import mock_ses
+from notifications_utils.recipients import validate_and_format_phone_number, InvalidEmailError
 from requests import HTTPError
 
 import app
 from app import mmg_client, firetext_client
 from app.dao import (provider_details_dao, notifications_dao)
+from app.clients.email.aws_ses import AwsSesClientException
 from app.dao.provider_details_dao import dao_switch_sms_provider_to_provider_with_identifier
 from app.delivery import send_to_providers
 from app.exceptions import NotificationTechnicalFailureException
 from app.models import (
     Notification,
+    NotificationHistory,
     EmailBranding,
     KEY_TYPE_NORMAL,
     KEY_TYPE_TEST,
@@ -25,6 +29,7 @@ from app.models import (
     BRANDING_BOTH,
     BRANDING_ORG_BANNER
 )
+from tests.conftest import set_config
 from tests.app.db import (
     create_service,
     create_template,
@@ -746,3 +751,245 @@ def test_send_email_to_provider_should_format_email_address(sample_email_notific
         html_body=ANY,
         reply_to_address=ANY,
     )
+
+
+def test_send_email_batch_to_provider_sends_each_notification_and_persists_references(
+    sample_email_template_with_html,
+    mocker
+):
+    notifications = [
+        create_notification(
+            template=sample_email_template_with_html,
+            to_field="jo.smith{}@example.com".format(i),
+            personalisation={'name': 'Jo'}
+        )
+        for i in range(3)
+    ]
+    mocker.patch('app.aws_ses_client.send_email', side_effect=['ref-0', 'ref-1', 'ref-2'])
+    mock_get_template = mocker.spy(send_to_providers, 'dao_get_template_by_id')
+
+    failed = send_to_providers.send_email_batch_to_provider(notifications)
+
+    assert failed == []
+    assert app.aws_ses_client.send_email.call_count == 3
+    assert mock_get_template.call_count == 1
+    sent_to = {call[0][1] for call in app.aws_ses_client.send_email.call_args_list}
+    assert sent_to == {'jo.smith0@example.com', 'jo.smith1@example.com', 'jo.smith2@example.com'}
+
+    persisted = Notification.query.filter(Notification.id.in_([n.id for n in notifications])).all()
+    assert {n.reference for n in persisted} == {'ref-0', 'ref-1', 'ref-2'}
+    for notification in persisted:
+        assert notification.status == 'sending'
+        assert notification.sent_by == 'ses'
+        assert notification.sent_at <= datetime.utcnow()
+        history = NotificationHistory.query.get(notification.id)
+        assert history.status == 'sending'
+        assert history.reference == notification.reference
+
+
+def test_send_email_batch_to_provider_returns_failed_notifications_for_retry(sample_email_template, mocker):
+    sent = create_notification(template=sample_email_template, to_field='sent@example.com')
+    failed = create_notification(template=sample_email_template, to_field='failed@example.com')
+
+    def send_email(source, to, *args, **kwargs):
+        if to == 'failed@example.com':
+            raise AwsSesClientException('some error')
+        return 'reference'
+    mocker.patch('app.aws_ses_client.send_email', side_effect=send_email)
+
+    assert send_to_providers.send_email_batch_to_provider([sent, failed]) == [failed]
+
+    assert Notification.query.get(sent.id).status == 'sending'
+    assert Notification.query.get(failed.id).status == 'created'
+    assert Notification.query.get(failed.id).sent_at is None
+
+
+def test_send_email_batch_to_provider_marks_invalid_email_addresses_as_technical_failure(
+    sample_email_template,
+    mocker
+):
+    notification = create_notification(template=sample_email_template, to_field='sent@example.com')
+    mocker.patch('app.aws_ses_client.send_email', side_effect=InvalidEmailError('bad email'))
+
+    assert send_to_providers.send_email_batch_to_provider([notification]) == []
+
+    assert Notification.query.get(notification.id).status == 'technical-failure'
+
+
+def test_send_email_batch_to_provider_sends_research_mode_through_research_mode_task(
+    sample_service,
+    sample_email_template,
+    mocker
+):
+    sample_service.research_mode = True
+    notification = create_notification(template=sample_email_template, to_field='john@smith.com')
+    mocker.patch('app.aws_ses_client.send_email')
+    mocker.patch('app.delivery.send_to_providers.send_email_response')
+
+    assert send_to_providers.send_email_batch_to_provider([notification]) == []
+
+    assert not app.aws_ses_client.send_email.called
+    app.delivery.send_to_providers.send_email_response.assert_called_once_with(ANY, 'john@smith.com')
+    assert Notification.query.get(notification.id).status == 'sending'
+
+
+def test_send_email_batch_to_provider_ignores_notifications_not_in_created(sample_email_template, mocker):
+    notification = create_notification(template=sample_email_template, status='sending')
+    mocker.patch('app.aws_ses_client.send_email')
+
+    assert send_to_providers.send_email_batch_to_provider([notification]) == []
+
+    assert not app.aws_ses_client.send_email.called
+
+
+@mock_ses
+def test_send_email_batch_to_provider_sends_through_ses(notify_api, sample_email_template, mocker):
+    ses = boto3.client('ses', region_name='eu-west-1')
+    ses.verify_domain_identity(Domain='test.notify.com')
+    ses.verify_email_identity(EmailAddress='"Sample service" <sample.service@test.notify.com>')
+    mocker.patch.object(app.aws_ses_client, '_client', ses)
+    notifications = [
+        create_notification(template=sample_email_template, to_field='jo.smith{}@example.com'.format(i))
+        for i in range(5)
+    ]
+
+    assert send_to_providers.send_email_batch_to_provider(notifications) == []
+
+    persisted = Notification.query.filter(Notification.id.in_([n.id for n in notifications])).all()
+    assert len({n.reference for n in persisted}) == 5
+    assert all(n.status == 'sending' for n in persisted)
+
+
+def test_send_sms_batch_to_provider_sends_each_notification_and_persists_billable_units(
+    sample_sms_template_with_html,
+    mocker
+):
+    notifications = [
+        create_notification(
+            template=sample_sms_template_with_html,
+            to_field="+44723412312{}".format(i),
+            personalisation={"name": "Jo"},
+            reply_to_text=sample_sms_template_with_html.service.get_default_sms_sender()
+        )
+        for i in range(3)
+    ]
+    mocker.patch('app.mmg_client.send_sms')
+    mock_provider_to_use = mocker.spy(send_to_providers, 'provider_to_use')
+    mock_get_template = mocker.spy(send_to_providers, 'dao_get_template_by_id')
+
+    failed = send_to_providers.send_sms_batch_to_provider(notifications)
+
+    assert failed == []
+    assert mock_provider_to_use.call_count == 1
+    assert mock_get_template.call_count == 1
+    assert mmg_client.send_sms.call_count == 3
+    mmg_client.send_sms.assert_any_call(
+        to=validate_and_format_phone_number("+447234123120"),
+        content="Sample service: Hello Jo\nHere is <em>some HTML</em> & entities",
+        reference=str(notifications[0].id),
+        sender=current_app.config['FROM_NUMBER']
+    )
+
+    for notification in Notification.query.filter(Notification.id.in_([n.id for n in notifications])):
+        assert notification.status == 'sending'
+        assert notification.sent_by == 'mmg'
+        assert notification.billable_units == 1
+        assert NotificationHistory.query.get(notification.id).status == 'sending'
+
+
+def test_send_sms_batch_to_provider_chooses_provider_for_international_notifications(
+    restore_provider_details,
+    sample_sms_template_with_html,
+    sample_user,
+    mocker
+):
+    mocker.patch('app.provider_details.switch_providers.get_user_by_id', return_value=sample_user)
+    dao_switch_sms_provider_to_provider_with_identifier('firetext')
+    uk = create_notification(template=sample_sms_template_with_html, to_field="+447234123999", international=False)
+    international = create_notification(
+        template=sample_sms_template_with_html, to_field="+447234123111", international=True
+    )
+    mocker.patch('app.mmg_client.send_sms')
+    mocker.patch('app.firetext_client.send_sms')
+
+    send_to_providers.send_sms_batch_to_provider([uk, international])
+
+    firetext_client.send_sms.assert_called_once_with(to="447234123999", content=ANY, reference=str(uk.id), sender=None)
+    mmg_client.send_sms.assert_called_once_with(
+        to="447234123111", content=ANY, reference=str(international.id), sender=None
+    )
+    assert Notification.query.get(uk.id).status == 'sending'
+    assert Notification.query.get(uk.id).sent_by == 'firetext'
+    assert Notification.query.get(international.id).status == 'sent'
+    assert Notification.query.get(international.id).sent_by == 'mmg'
+
+
+def test_send_sms_batch_to_provider_returns_failed_notifications_and_switches_provider_once(
+    sample_sms_template,
+    mocker
+):
+    sent = create_notification(template=sample_sms_template, to_field="+447234123123")
+    failed = [create_notification(template=sample_sms_template, to_field="+447234123999") for _ in range(2)]
+
+    def send_sms(to, **kwargs):
+        if to == "447234123999":
+            raise Exception('provider error')
+    mocker.patch('app.mmg_client.send_sms', side_effect=send_sms)
+    switch_provider_mock = mocker.patch('app.delivery.send_to_providers.dao_toggle_sms_provider')
+
+    assert send_to_providers.send_sms_batch_to_provider([sent] + failed) == failed
+
+    switch_provider_mock.assert_called_once_with('mmg')
+    assert Notification.query.get(sent.id).status == 'sending'
+    assert all(Notification.query.get(n.id).status == 'created' for n in failed)
+
+
+def test_send_sms_batch_to_provider_sends_research_mode_through_research_mode_task(
+    sample_service,
+    sample_sms_template,
+    mocker
+):
+    sample_service.research_mode = True
+    notification = create_notification(template=sample_sms_template, to_field="+447234123123")
+    mocker.patch('app.mmg_client.send_sms')
+    send_sms_response = mocker.patch('app.delivery.send_to_providers.send_sms_response')
+
+    assert send_to_providers.send_sms_batch_to_provider([notification]) == []
+
+    assert not mmg_client.send_sms.called
+    send_sms_response.assert_called_once_with('mmg', str(notification.id), notification.to)
+
+
+def test_provider_to_use_chooses_sms_provider_by_weight_when_load_balancing(notify_api, notify_db_session, mocker):
+    choose_sms_provider = mocker.patch('app.delivery.send_to_providers.choose_sms_provider', return_value='firetext')
+
+    with set_config(notify_api, 'SMS_LOAD_BALANCING_ENABLED', True):
+        assert send_to_providers.provider_to_use('sms', '1234').name == 'firetext'
+        assert send_to_providers.provider_to_use('sms', '1234', international=True).name == 'mmg'
+
+    choose_sms_provider.assert_called_once_with(ANY)
+
+
+def test_send_sms_should_not_switch_providers_on_failure_when_load_balancing(notify_api, sample_notification, mocker):
+    mocker.patch('app.mmg_client.send_sms', side_effect=Exception('Error'))
+    mocker.patch('app.delivery.send_to_providers.choose_sms_provider', return_value='mmg')
+    switch_provider_mock = mocker.patch('app.delivery.send_to_providers.dao_toggle_sms_provider')
+    record_outcome = mocker.patch('app.delivery.send_to_providers.record_sms_provider_outcome')
+
+    with set_config(notify_api, 'SMS_LOAD_BALANCING_ENABLED', True), pytest.raises(Exception):
+        send_to_providers.send_sms_to_provider(sample_notification)
+
+    assert not switch_provider_mock.called
+    record_outcome.assert_called_once_with('mmg', False, ANY)
+
+
+def test_send_concurrently_adds_each_thread_timing_totals_after_they_finish(notify_api):
+    def send(item):
+        app.instrumentation.record('http', item)
+        return item * 2
+
+    with notify_api.app_context():
+        results = send_to_providers.send_concurrently(send, [1, 2, 3], max_workers=3)
+
+        assert results == [(2, None), (4, None), (6, None)]
+        assert app.instrumentation.get_timing_totals() == {'http': (3, 6)}
@@ -1,5 +1,8 @@
+import base64
+import io
+
 import pytest
-from datetime import datetime
+from datetime import date, datetime
 
 import boto3
 from flask import current_app
@@ -7,15 +10,25 @@ from freezegun import freeze_time
 from moto import mock_s3
 
 from app.letters.utils import (
+    cache_letter_pdf,
+    copy_cached_letter_pdf,
+    decode_letter_content,
+    get_letter_pdf_cache_key,
     get_bucket_prefix_for_notification,
     get_letter_pdf_filename,
     get_letter_pdf,
+    get_letter_print_date,
+    get_letters_to_process_count,
+    decrement_letters_to_process,
+    increment_letters_to_process,
     upload_letter_pdf,
     move_scanned_pdf_to_test_or_live_pdf_bucket,
     ScanErrorType, move_failed_pdf, get_folder_name
 )
 from app.models import KEY_TYPE_NORMAL, KEY_TYPE_TEST, PRECOMPILED_TEMPLATE_NAME
 
+from tests.conftest import set_config
+
 FROZEN_DATE_TIME = "2018-03-14 17:00:00"
 
 
@@ -109,6 +122,37 @@ def test_get_letter_pdf_gets_pdf_from_correct_bucket(
     assert ret == b'pdf_content'
 
 
+@mock_s3
+def test_get_letter_pdf_gets_pdf_from_recorded_location(sample_precompiled_letter_notification_using_test_key, mocker):
+    bucket_name = current_app.config['TEST_LETTERS_BUCKET_NAME']
+    conn = boto3.resource('s3', region_name='eu-west-1')
+    bucket = conn.create_bucket(Bucket=bucket_name)
+    bucket.put_object(Key='SOMEWHERE/ELSE.PDF', Body=b'pdf_content')
+    mock_redis_get = mocker.patch('app.letters.utils.redis_store.get', return_value=b'SOMEWHERE/ELSE.PDF')
+
+    assert get_letter_pdf(sample_precompiled_letter_notification_using_test_key) == b'pdf_content'
+    mock_redis_get.assert_called_once_with('letter-pdf-location-FOO')
+
+
+@mock_s3
+@freeze_time(FROZEN_DATE_TIME)
+def test_get_letter_pdf_lists_bucket_if_recorded_location_is_missing(
+    sample_precompiled_letter_notification_using_test_key, mocker
+):
+    bucket_name = current_app.config['TEST_LETTERS_BUCKET_NAME']
+    filename = datetime.utcnow().strftime('NOTIFY.FOO.D.2.C.C.%Y%m%d%H%M%S.PDF')
+    conn = boto3.resource('s3', region_name='eu-west-1')
+    bucket = conn.create_bucket(Bucket=bucket_name)
+    bucket.put_object(Key=filename, Body=b'pdf_content')
+    mocker.patch('app.letters.utils.redis_store.get', return_value=b'NOTIFY.FOO.MOVED.PDF')
+    mock_redis_set = mocker.patch('app.letters.utils.redis_store.set')
+
+    assert get_letter_pdf(sample_precompiled_letter_notification_using_test_key) == b'pdf_content'
+    mock_redis_set.assert_called_once_with(
+        'letter-pdf-location-FOO', filename, ex=current_app.config['EXPIRE_CACHE_EIGHT_DAYS']
+    )
+
+
 @pytest.mark.parametrize('is_precompiled_letter,bucket_config_name', [
     (False, 'LETTERS_PDF_BUCKET_NAME'),
     (True, 'LETTERS_SCAN_BUCKET_NAME')
@@ -128,6 +172,8 @@ def test_upload_letter_pdf_to_correct_bucket(
         is_scan_letter=is_precompiled_letter
     )
 
+    mock_redis_set = mocker.patch('app.letters.utils.redis_store.set')
+
     upload_letter_pdf(sample_letter_notification, b'\x00\x01', precompiled=is_precompiled_letter)
 
     mock_s3.assert_called_once_with(
@@ -136,6 +182,46 @@ def test_upload_letter_pdf_to_correct_bucket(
         filedata=b'\x00\x01',
         region=current_app.config['AWS_REGION']
     )
+    # precompiled letters are still to be scanned, so aren't where they'll end up
+    assert mock_redis_set.called is not is_precompiled_letter
+
+
+@mock_s3
+def test_upload_letter_pdf_uploads_a_file(sample_letter_notification):
+    bucket_name = current_app.config['LETTERS_SCAN_BUCKET_NAME']
+    bucket = boto3.resource('s3', region_name='eu-west-1').create_bucket(Bucket=bucket_name)
+
+    filename = upload_letter_pdf(sample_letter_notification, io.BytesIO(b'pdf_content'), precompiled=True)
+
+    assert bucket.Object(filename).get()['Body'].read() == b'pdf_content'
+
+
+@pytest.mark.parametrize('content', [
+    base64.b64encode(b'letter-content').decode('ascii'),
+    base64.encodebytes(b'letter-content' * 100).decode('ascii'),
+])
+def test_decode_letter_content(notify_api, mocker, content):
+    mocker.patch('app.letters.utils.BASE64_CHUNK_SIZE', 7)
+
+    with decode_letter_content(content) as letter_file:
+        assert letter_file.read() == base64.b64decode(content)
+
+
+@pytest.mark.parametrize('content', ['hi', 'bGV0dGVy\u00e9'])
+def test_decode_letter_content_raises_value_error_for_invalid_base64(notify_api, content):
+    with pytest.raises(ValueError):
+        decode_letter_content(content)
+
+
+def test_decode_letter_content_writes_large_letters_to_disk(notify_api):
+    content = base64.b64encode(b'letter-content' * 10).decode('ascii')
+
+    with set_config(notify_api, 'PRECOMPILED_LETTER_SPOOL_MAX_SIZE', 10):
+        letter_file = decode_letter_content(content)
+
+    with letter_file:
+        assert letter_file._rolled
+        assert letter_file.read() == b'letter-content' * 10
 
 
 @mock_s3
@@ -225,3 +311,115 @@ def test_get_folder_name_in_british_summer_time(notify_api, freeze_date, expecte
 
 def test_get_folder_name_returns_empty_string_for_test_letter():
     assert '' == get_folder_name(datetime.utcnow(), is_test_or_scan_letter=True)
+
+
+@pytest.mark.parametrize("created_at, expected_print_date", [
+    (datetime(2018, 7, 2, 16, 29), date(2018, 7, 2)),
+    (datetime(2018, 7, 2, 16, 31), date(2018, 7, 3)),
+    (datetime(2018, 1, 2, 17, 29), date(2018, 1, 2)),
+    (datetime(2018, 1, 2, 17, 31), date(2018, 1, 3)),
+])
+def test_get_letter_print_date(notify_api, created_at, expected_print_date):
+    assert get_letter_print_date(created_at) == expected_print_date
+
+
+def test_increment_letters_to_process_counts_letter_on_its_print_day(sample_letter_notification, mocker):
+    sample_letter_notification.created_at = datetime(2018, 7, 2, 16, 31)
+    mock_increment = mocker.patch('app.letters.utils.redis_store.increment_hash_value')
+    mock_expire = mocker.patch('app.letters.utils.redis_store.expire')
+
+    increment_letters_to_process(sample_letter_notification)
+
+    mock_increment.assert_called_once_with('letters-to-process-2018-07-03', 'count')
+    mock_expire.assert_called_once_with('letters-to-process-2018-07-03', current_app.config['EXPIRE_CACHE_EIGHT_DAYS'])
+
+
+def test_decrement_letters_to_process(sample_letter_notification, mocker):
+    sample_letter_notification.created_at = datetime(2018, 7, 2, 16, 29)
+    mock_decrement = mocker.patch('app.letters.utils.redis_store.decrement_hash_value')
+
+    decrement_letters_to_process(sample_letter_notification)
+
+    mock_decrement.assert_called_once_with('letters-to-process-2018-07-02', 'count')
+
+
+@pytest.mark.parametrize('key_type, research_mode', [(KEY_TYPE_TEST, False), (KEY_TYPE_NORMAL, True)])
+def test_letters_that_are_not_printed_are_not_counted(sample_letter_notification, mocker, key_type, research_mode):
+    sample_letter_notification.key_type = key_type
+    sample_letter_notification.service.research_mode = research_mode
+    mock_increment = mocker.patch('app.letters.utils.redis_store.increment_hash_value')
+    mock_decrement = mocker.patch('app.letters.utils.redis_store.decrement_hash_value')
+
+    increment_letters_to_process(sample_letter_notification)
+    decrement_letters_to_process(sample_letter_notification)
+
+    assert not mock_increment.called
+    assert not mock_decrement.called
+
+
+@pytest.mark.parametrize('counts, expected_count', [
+    (None, None),
+    ({}, None),
+    ({b'count': b'3'}, 3),
+])
+def test_get_letters_to_process_count(mocker, counts, expected_count):
+    mock_get = mocker.patch('app.letters.utils.redis_store.get_all_from_hash', return_value=counts)
+
+    assert get_letters_to_process_count(date(2018, 7, 2)) == expected_count
+    mock_get.assert_called_once_with('letters-to-process-2018-07-02')
+
+
+@freeze_time('2018-03-14 12:00:00')
+def test_get_letter_pdf_cache_key_only_depends_on_content():
+    data = {
+        'template': {'subject': 'Hello', 'content': 'Dear ((name))'},
+        'values': {'name': 'Jo'},
+        'dvla_org_id': '001',
+    }
+
+    assert get_letter_pdf_cache_key(data) == get_letter_pdf_cache_key(dict(reversed(list(data.items()))))
+    assert get_letter_pdf_cache_key(data) != get_letter_pdf_cache_key(dict(data, values={'name': 'Sam'}))
+    assert get_letter_pdf_cache_key(data).endswith('.pdf')
+
+
+def test_get_letter_pdf_cache_key_is_different_each_day():
+    data = {
+        'template': {'subject': 'Hello', 'content': 'Dear ((name))'},
+        'values': {'name': 'Jo'},
+        'dvla_org_id': '001',
+    }
+
+    # letters are dated in London, so 23:30 UTC in summer is the next day
+    with freeze_time('2018-06-14 12:00:00'):
+        first_day = get_letter_pdf_cache_key(data)
+    with freeze_time('2018-06-14 22:59:59'):
+        assert get_letter_pdf_cache_key(data) == first_day
+    with freeze_time('2018-06-14 23:30:00'):
+        assert get_letter_pdf_cache_key(data) != first_day
+
+
+@mock_s3
+def test_copy_cached_letter_pdf_returns_none_if_not_cached(notify_api, mocker):
+    mock_incr = mocker.patch('app.letters.utils.statsd_client.incr')
+    conn = boto3.resource('s3', region_name='eu-west-1')
+    conn.create_bucket(Bucket=current_app.config['LETTERS_PDF_CACHE_BUCKET_NAME'])
+
+    assert copy_cached_letter_pdf('abc.pdf', '2018-03-14/NOTIFY.REF.PDF') is None
+    mock_incr.assert_called_once_with('letters.pdf-cache.miss')
+
+
+@mock_s3
+def test_cached_letter_pdf_is_copied_for_the_next_letter(notify_api, mocker):
+    mock_incr = mocker.patch('app.letters.utils.statsd_client.incr')
+    letters_bucket_name = current_app.config['LETTERS_PDF_BUCKET_NAME']
+    conn = boto3.resource('s3', region_name='eu-west-1')
+    letters_bucket = conn.create_bucket(Bucket=letters_bucket_name)
+    conn.create_bucket(Bucket=current_app.config['LETTERS_PDF_CACHE_BUCKET_NAME'])
+    s3 = boto3.client('s3', region_name='eu-west-1')
+    s3.put_object(Bucket=letters_bucket_name, Key='2018-03-14/NOTIFY.REF1.PDF', Body=b'pdf_content')
+
+    cache_letter_pdf('abc.pdf', '2018-03-14/NOTIFY.REF1.PDF', 2)
+
+    assert copy_cached_letter_pdf('abc.pdf', '2018-03-14/NOTIFY.REF2.PDF') == 2
+    assert letters_bucket.Object('2018-03-14/NOTIFY.REF2.PDF').get()['Body'].read() == b'pdf_content'
+    mock_incr.assert_called_once_with('letters.pdf-cache.hit')
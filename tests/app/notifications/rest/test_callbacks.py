@@ -107,6 +107,7 @@ def test_dvla_rsp_txt_file_callback_calls_update_letter_notifications_task(clien
 def test_dvla_ack_calls_does_not_call_letter_notifications_task(client, mocker):
     update_task = \
         mocker.patch('app.notifications.notifications_letter_callback.update_letter_notifications_statuses.apply_async')
+    mocker.patch('app.notifications.notifications_letter_callback.record_letter_ack_file.apply_async')
     data = _sample_sns_s3_callback('bar.ack.txt')
     response = dvla_post(client, data)
 
@@ -114,6 +115,15 @@ def test_dvla_ack_calls_does_not_call_letter_notifications_task(client, mocker):
     update_task.assert_not_called()
 
 
+def test_dvla_ack_file_callback_calls_record_letter_ack_file_task(client, mocker):
+    record_task = mocker.patch('app.notifications.notifications_letter_callback.record_letter_ack_file.apply_async')
+    data = _sample_sns_s3_callback('root/dispatch/NOTIFY.20180111175733.ACK.txt')
+    response = dvla_post(client, data)
+
+    assert response.status_code == 200
+    record_task.assert_called_once_with(['root/dispatch/NOTIFY.20180111175733.ACK.txt'], queue='notify-internal-tasks')
+
+
 def test_firetext_callback_should_not_need_auth(client, mocker):
     mocker.patch('app.statsd_client.incr')
     data = 'mobile=441234123123&status=0&reference=send-sms-code&time=2016-03-10 14:17:00'
@@ -151,6 +151,19 @@ def test_ses_callback_should_set_status_to_temporary_failure(client,
     assert send_mock.called
 
 
+def test_ses_callback_should_record_delivery_latency(sample_email_template, mocker):
+    record_latency = mocker.patch('app.notifications.notifications_ses_callback.record_delivery_latency')
+    with freeze_time('2001-01-01T12:00:00'):
+        sent_at = datetime(2001, 1, 1, 11, 59, 55)
+        create_notification(
+            template=sample_email_template, reference='ref', status='sending', sent_at=sent_at, sent_by='ses'
+        )
+
+        assert process_ses_response(ses_notification_callback(reference='ref')) is None
+
+    record_latency.assert_called_once_with('ses', sent_at, datetime(2001, 1, 1, 12, 0))
+
+
 def test_ses_callback_should_not_set_status_once_status_is_delivered(client,
                                                                      notify_db,
                                                                      notify_db_session,
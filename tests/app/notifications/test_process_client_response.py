@@ -1,14 +1,17 @@
 import uuid
+from datetime import datetime, timedelta
 
 import pytest
+from freezegun import freeze_time
 
+from app import notify_celery
 from app.clients import ClientException
 from app.notifications.process_client_response import (
     validate_callback_data,
     process_sms_client_response
 )
 from app.celery.service_callback_tasks import create_delivery_status_callback_data
-from tests.app.db import create_service_callback_api
+from tests.app.db import create_notification, create_service_callback_api
 
 
 def test_validate_callback_data_returns_none_when_valid():
@@ -69,6 +72,23 @@ def test_outcome_statistics_called_for_successful_callback(sample_notification,
                                       queue="service-callbacks")
 
 
+def test_service_callback_joins_an_open_publishing_batch(sample_notification, mocker, celery_producer):
+    mocker.patch(
+        'app.notifications.process_client_response.notifications_dao.update_notification_status_by_id',
+        return_value=sample_notification
+    )
+    send_mock = mocker.patch(
+        'app.celery.service_callback_tasks.send_delivery_status_to_service.apply_async'
+    )
+    create_service_callback_api(service=sample_notification.service, url="https://original_url.com")
+
+    with notify_celery.batch_publishing():
+        process_sms_client_response(status='3', provider_reference=str(uuid.uuid4()), client_name='MMG')
+        assert not send_mock.called
+
+    assert send_mock.call_args[1] == {'queue': 'service-callbacks', 'producer': celery_producer}
+
+
 def test_sms_resonse_does_not_call_send_callback_if_no_db_entry(sample_notification, mocker):
     mocker.patch(
         'app.notifications.process_client_response.notifications_dao.update_notification_status_by_id',
@@ -82,6 +102,20 @@ def test_sms_resonse_does_not_call_send_callback_if_no_db_entry(sample_notificat
     send_mock.assert_not_called()
 
 
+@freeze_time('2018-01-01 12:00:00')
+@pytest.mark.parametrize('status, expected_calls', [('3', 1), ('5', 0)])
+def test_process_sms_response_records_delivery_latency_for_delivered_notifications(
+    sample_template, mocker, status, expected_calls
+):
+    record_latency = mocker.patch('app.notifications.process_client_response.record_delivery_latency')
+    sent_at = datetime.utcnow() - timedelta(seconds=30)
+    notification = create_notification(template=sample_template, status='sending', sent_at=sent_at, sent_by='mmg')
+
+    process_sms_client_response(status=status, provider_reference=str(notification.id), client_name='MMG')
+
+    assert record_latency.call_args_list == [(('mmg', sent_at, datetime.utcnow()),)] * expected_calls
+
+
 def test_process_sms_response_return_success_for_send_sms_code_reference(mocker):
     success, error = process_sms_client_response(
         status='000', provider_reference='send-sms-code', client_name='sms-client')
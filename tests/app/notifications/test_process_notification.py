@@ -164,6 +164,33 @@ def test_persist_notification_does_not_increment_cache_if_test_key(
 
 
 @freeze_time("2016-01-01 11:09:00.061258")
+@pytest.mark.parametrize('notification_type, recipient, counted', [
+    ('letter', 'Jo Bloggs', True),
+    ('sms', '+447111111111', False),
+])
+def test_persist_notification_counts_letters_to_process(
+    sample_letter_template, sample_template, sample_api_key, mocker, notification_type, recipient, counted
+):
+    mock_increment = mocker.patch('app.notifications.process_notifications.increment_letters_to_process')
+    template = sample_letter_template if notification_type == 'letter' else sample_template
+
+    notification = persist_notification(
+        template_id=template.id,
+        template_version=template.version,
+        recipient=recipient,
+        service=template.service,
+        personalisation={},
+        notification_type=notification_type,
+        api_key_id=sample_api_key.id,
+        key_type=sample_api_key.key_type,
+    )
+
+    if counted:
+        mock_increment.assert_called_once_with(notification)
+    else:
+        assert not mock_increment.called
+
+
 def test_persist_notification_with_optionals(sample_job, sample_api_key, mocker):
     assert Notification.query.count() == 0
     assert NotificationHistory.query.count() == 0
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import pytest
+from freezegun import freeze_time
+
+from app.provider_details.delivery_latency import (
+    get_delivery_latency_percentiles,
+    record_delivery_latency,
+)
+
+from tests.conftest import set_config
+
+
+@pytest.fixture
+def redis_enabled(notify_api):
+    with set_config(notify_api, 'REDIS_ENABLED', True):
+        yield
+
+
+@pytest.mark.parametrize('seconds, bucket', [
+    (0, 0),
+    (7.5, 7),
+    (99, 99),
+    (101, 110),
+    (243, 250),
+    (1234, 1300),
+])
+@freeze_time('2018-01-01 12:00:30')
+def test_record_delivery_latency_counts_receipt_in_bucket_for_minute(redis_enabled, mocker, seconds, bucket):
+    increment = mocker.patch('app.provider_details.delivery_latency.redis_store.increment_hash_value')
+    expire = mocker.patch('app.provider_details.delivery_latency.redis_store.expire')
+    now = datetime.utcnow()
+
+    record_delivery_latency('mmg', now - timedelta(seconds=seconds), now)
+
+    increment.assert_called_once_with('delivery-latency-mmg-2018-01-01T12:00', bucket)
+    expire.assert_called_once_with('delivery-latency-mmg-2018-01-01T12:00', 960)
+
+
+def test_record_delivery_latency_does_nothing_if_redis_disabled(notify_api, mocker):
+    increment = mocker.patch('app.provider_details.delivery_latency.redis_store.increment_hash_value')
+
+    with set_config(notify_api, 'REDIS_ENABLED', False):
+        record_delivery_latency('mmg', datetime.utcnow(), datetime.utcnow())
+
+    assert not increment.called
+
+
+@freeze_time('2018-01-01 12:00:30')
+def test_get_delivery_latency_percentiles_merges_minutes(redis_enabled, mocker):
+    get_all_from_hash = mocker.patch(
+        'app.provider_details.delivery_latency.redis_store.get_all_from_hash',
+        side_effect=[{b'5': b'40', b'250': b'1'}, {b'5': b'10', b'30': b'48'}, {b'600': b'1'}] + [None] * 12
+    )
+
+    assert get_delivery_latency_percentiles('mmg') == {'count': 100, 'p50': 5, 'p95': 30, 'p99': 250}
+    assert get_all_from_hash.call_args_list[0][0] == ('delivery-latency-mmg-2018-01-01T12:00',)
+    assert get_all_from_hash.call_args_list[1][0] == ('delivery-latency-mmg-2018-01-01T11:59',)
+    assert get_all_from_hash.call_count == 15
+
+
+@freeze_time('2018-01-01 12:00:30')
+def test_get_delivery_latency_percentiles_only_reads_whole_minutes_since(redis_enabled, mocker):
+    get_all_from_hash = mocker.patch(
+        'app.provider_details.delivery_latency.redis_store.get_all_from_hash',
+        return_value=None
+    )
+
+    assert get_delivery_latency_percentiles('mmg', since=datetime(2018, 1, 1, 11, 57, 10)) == {
+        'count': 0, 'p50': None, 'p95': None, 'p99': None
+    }
+    assert [args[0] for args, _ in get_all_from_hash.call_args_list] == [
+        'delivery-latency-mmg-2018-01-01T12:00',
+        'delivery-latency-mmg-2018-01-01T11:59',
+        'delivery-latency-mmg-2018-01-01T11:58',
+    ]
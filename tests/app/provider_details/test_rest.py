@@ -137,3 +137,20 @@ def test_update_provider_should_store_user_id(client, restore_provider_details,
     assert update_resp_1['identifier'] == provider.identifier
     assert not update_resp_1['active']
     assert not provider.active
+
+
+def test_get_provider_delivery_latency(client, notify_db, mocker):
+    provider = ProviderDetails.query.filter_by(identifier='mmg').one()
+    get_latency = mocker.patch(
+        'app.provider_details.rest.get_delivery_latency_percentiles',
+        return_value={'count': 10, 'p50': 4, 'p95': 30, 'p99': 61}
+    )
+
+    response = client.get(
+        '/provider-details/{}/delivery-latency'.format(provider.id),
+        headers=[create_authorization_header()]
+    )
+
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True))['data'] == {'count': 10, 'p50': 4, 'p95': 30, 'p99': 61}
+    get_latency.assert_called_once_with('mmg')
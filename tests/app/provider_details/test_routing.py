@@ -0,0 +1,237 @@
+from unittest.mock import call
+
+import pytest
+from freezegun import freeze_time
+
+from app.dao.provider_details_dao import (
+    get_provider_details_by_identifier,
+    get_provider_details_by_notification_type,
+)
+from app.provider_details import routing
+from app.provider_details.routing import (
+    choose_sms_provider,
+    get_active_provider_identifiers,
+    get_sms_provider_health,
+    record_sms_provider_outcome,
+    invalidate_provider_routing,
+    PROVIDER_ROUTING_VERSION_CACHE_KEY,
+    _weighted_choice,
+)
+
+from tests.conftest import set_config_values
+
+
+@pytest.fixture
+def routing_cache(notify_api, mocker):
+    mocker.patch.dict(routing._routing_table, clear=True)
+    mocker.patch.dict(routing._version, {'value': None, 'checked_at': None})
+    with set_config_values(notify_api, {
+        'PROVIDER_ROUTING_CACHE_TTL_SECONDS': 30,
+        'PROVIDER_ROUTING_VERSION_CHECK_SECONDS': 2,
+    }):
+        yield
+
+
+def test_get_active_provider_identifiers_returns_active_providers_in_priority_order(restore_provider_details):
+    mmg = get_provider_details_by_identifier('mmg')
+    mmg.active = False
+
+    assert get_active_provider_identifiers('sms') == [
+        provider.identifier for provider in get_provider_details_by_notification_type('sms') if provider.active
+    ]
+    assert 'mmg' not in get_active_provider_identifiers('sms')
+    assert get_active_provider_identifiers('email') == ['ses']
+
+
+def test_get_active_provider_identifiers_only_queries_once_while_cached(notify_db_session, routing_cache, mocker):
+    mocker.patch('app.provider_details.routing.redis_store.get', return_value=None)
+    load = mocker.spy(routing, '_load_active_provider_identifiers')
+
+    first = get_active_provider_identifiers('sms')
+    second = get_active_provider_identifiers('sms')
+    get_active_provider_identifiers('sms', international=True)
+
+    assert first == second
+    assert load.call_count == 2
+
+
+def test_get_active_provider_identifiers_reloads_when_ttl_expires(notify_db_session, routing_cache, mocker):
+    mocker.patch('app.provider_details.routing.redis_store.get', return_value=None)
+    load = mocker.spy(routing, '_load_active_provider_identifiers')
+    monotonic = mocker.patch('app.provider_details.routing.monotonic', return_value=100)
+
+    get_active_provider_identifiers('sms')
+    monotonic.return_value = 131
+    get_active_provider_identifiers('sms')
+
+    assert load.call_count == 2
+
+
+def test_get_active_provider_identifiers_reloads_when_version_changes(notify_db_session, routing_cache, mocker):
+    redis_get = mocker.patch('app.provider_details.routing.redis_store.get', return_value=b'1')
+    load = mocker.spy(routing, '_load_active_provider_identifiers')
+    monotonic = mocker.patch('app.provider_details.routing.monotonic', return_value=100)
+
+    get_active_provider_identifiers('sms')
+    redis_get.return_value = b'2'
+    monotonic.return_value = 101
+    get_active_provider_identifiers('sms')
+    assert load.call_count == 1
+
+    monotonic.return_value = 103
+    get_active_provider_identifiers('sms')
+    assert load.call_count == 2
+    redis_get.assert_called_with(PROVIDER_ROUTING_VERSION_CACHE_KEY)
+
+
+def test_invalidate_provider_routing_clears_cache_and_bumps_version(notify_db_session, routing_cache, mocker):
+    mocker.patch('app.provider_details.routing.redis_store.get', return_value=None)
+    redis_incr = mocker.patch('app.provider_details.routing.redis_store.incr')
+    load = mocker.spy(routing, '_load_active_provider_identifiers')
+
+    get_active_provider_identifiers('sms')
+    invalidate_provider_routing()
+    get_active_provider_identifiers('sms')
+
+    assert load.call_count == 2
+    redis_incr.assert_called_once_with(PROVIDER_ROUTING_VERSION_CACHE_KEY)
+
+
+@pytest.fixture
+def load_balancing(notify_api, mocker):
+    mocker.patch.dict(routing._sms_provider_health, clear=True)
+    with set_config_values(notify_api, {
+        'SMS_LOAD_BALANCING_ENABLED': True,
+        'SMS_PROVIDER_WEIGHTS': {'mmg': 75, 'firetext': 25},
+        'SMS_PROVIDER_RATE_LIMITS': {},
+        'REDIS_ENABLED': True,
+    }):
+        yield
+
+
+def test_choose_sms_provider_splits_traffic_by_weight(load_balancing, mocker):
+    mocker.patch('app.provider_details.routing.get_sms_provider_health', return_value=1)
+    choice = mocker.patch('app.provider_details.routing._weighted_choice', return_value='firetext')
+
+    assert choose_sms_provider(['mmg', 'firetext', 'loadtesting']) == 'firetext'
+
+    choice.assert_called_once_with(['mmg', 'firetext'], [75, 25])
+
+
+@pytest.mark.parametrize('point, expected', [
+    (0, 'mmg'),
+    (74.9, 'mmg'),
+    (75, 'firetext'),
+    (100, 'firetext'),
+])
+def test_weighted_choice(mocker, point, expected):
+    mocker.patch('app.provider_details.routing.random.uniform', return_value=point)
+
+    assert _weighted_choice(['mmg', 'firetext'], [75, 25]) == expected
+
+
+def test_choose_sms_provider_scales_weights_by_health(load_balancing, mocker):
+    mocker.patch('app.provider_details.routing.get_sms_provider_health', side_effect=lambda i: 0.2 if i == 'mmg' else 1)
+    choice = mocker.patch('app.provider_details.routing._weighted_choice', return_value='mmg')
+
+    choose_sms_provider(['mmg', 'firetext'])
+
+    choice.assert_called_once_with(['mmg', 'firetext'], [15, 25])
+
+
+@freeze_time('2018-01-01 12:00:00')
+def test_choose_sms_provider_skips_provider_over_rate_limit(notify_api, load_balancing, mocker):
+    mocker.patch('app.provider_details.routing.get_sms_provider_health', return_value=1)
+    mocker.patch('app.provider_details.routing._weighted_choice', side_effect=['mmg', 'firetext'])
+    redis_get = mocker.patch('app.provider_details.routing.redis_store.get', side_effect=[b'100', b'49'])
+    redis_incr = mocker.patch('app.provider_details.routing.redis_store.incr')
+    mocker.patch('app.provider_details.routing.redis_store.expire')
+
+    with set_config_values(notify_api, {'SMS_PROVIDER_RATE_LIMITS': {'mmg': 100, 'firetext': 50}}):
+        assert choose_sms_provider(['mmg', 'firetext']) == 'firetext'
+
+    assert redis_get.call_args_list == [
+        call('sms-provider-rate-limit-mmg-1514808000'),
+        call('sms-provider-rate-limit-firetext-1514808000'),
+    ]
+    # only the chosen provider's request is counted against its limit
+    redis_incr.assert_called_once_with('sms-provider-rate-limit-firetext-1514808000')
+
+
+def test_choose_sms_provider_uses_highest_weight_when_all_over_rate_limit(notify_api, load_balancing, mocker):
+    mocker.patch('app.provider_details.routing.get_sms_provider_health', return_value=1)
+    mocker.patch('app.provider_details.routing.redis_store.get', return_value=b'100')
+    redis_incr = mocker.patch('app.provider_details.routing.redis_store.incr')
+    mocker.patch('app.provider_details.routing.redis_store.expire')
+
+    with set_config_values(notify_api, {'SMS_PROVIDER_RATE_LIMITS': {'mmg': 100, 'firetext': 50}}):
+        assert choose_sms_provider(['firetext', 'mmg']) == 'mmg'
+
+    assert redis_incr.call_count == 1
+
+
+def test_choose_sms_provider_uses_first_provider_without_weights(load_balancing):
+    assert choose_sms_provider(['loadtesting']) == 'loadtesting'
+
+
+@freeze_time('2018-01-01 12:00:30')
+def test_record_sms_provider_outcome_counts_requests_errors_and_slow_requests(load_balancing, mocker):
+    increment = mocker.patch('app.provider_details.routing.redis_store.increment_hash_value')
+    expire = mocker.patch('app.provider_details.routing.redis_store.expire')
+
+    record_sms_provider_outcome('mmg', False, 6)
+
+    assert increment.call_args_list == [
+        call('sms-provider-health-mmg-2018-01-01T12:00', 'requests'),
+        call('sms-provider-health-mmg-2018-01-01T12:00', 'errors'),
+        call('sms-provider-health-mmg-2018-01-01T12:00', 'slow'),
+    ]
+    expire.assert_called_once_with('sms-provider-health-mmg-2018-01-01T12:00', 360)
+
+
+@pytest.mark.parametrize('counts, expected_health', [
+    ({b'requests': b'10', b'errors': b'10'}, 1),
+    ({b'requests': b'100'}, 1),
+    ({b'requests': b'100', b'errors': b'10', b'slow': b'20'}, 0.8),
+    ({b'requests': b'100', b'errors': b'100'}, 0.1),
+])
+def test_get_sms_provider_health(load_balancing, mocker, counts, expected_health):
+    mocker.patch(
+        'app.provider_details.routing.get_delivery_latency_percentiles', return_value={'count': 0, 'p95': None}
+    )
+    get_all_from_hash = mocker.patch(
+        'app.provider_details.routing.redis_store.get_all_from_hash',
+        side_effect=[counts, None, None, None, None]
+    )
+
+    assert get_sms_provider_health('mmg') == pytest.approx(expected_health)
+    assert get_all_from_hash.call_count == 5
+
+
+@pytest.mark.parametrize('latency, expected_health', [
+    ({'count': 10, 'p95': 960}, 0.8),
+    ({'count': 100, 'p95': 240}, 0.8),
+    ({'count': 100, 'p95': 480}, 0.4),
+    ({'count': 100, 'p95': 9600}, 0.1),
+])
+def test_get_sms_provider_health_scales_down_for_slow_delivery(load_balancing, mocker, latency, expected_health):
+    mocker.patch(
+        'app.provider_details.routing.redis_store.get_all_from_hash',
+        side_effect=[{b'requests': b'100', b'errors': b'10', b'slow': b'20'}, None, None, None, None]
+    )
+    get_latency = mocker.patch('app.provider_details.routing.get_delivery_latency_percentiles', return_value=latency)
+
+    assert get_sms_provider_health('mmg') == pytest.approx(expected_health)
+    get_latency.assert_called_once_with('mmg', percentiles=(95,))
+
+
+def test_get_sms_provider_health_is_cached(load_balancing, mocker):
+    mocker.patch(
+        'app.provider_details.routing.get_delivery_latency_percentiles', return_value={'count': 0, 'p95': None}
+    )
+    get_all_from_hash = mocker.patch('app.provider_details.routing.redis_store.get_all_from_hash', return_value=None)
+
+    get_sms_provider_health('mmg')
+    get_sms_provider_health('mmg')
+
+    assert get_all_from_hash.call_count == 5
@@ -8,6 +8,7 @@ import botocore
 import pytest
 import requests_mock
 from PyPDF2.utils import PdfReadError
+from flask import url_for
 from freezegun import freeze_time
 from notifications_utils import SMS_CHAR_COUNT_LIMIT
 
@@ -1213,3 +1214,127 @@ def test_preview_letter_template_precompiled_png_template_preview_pdf_error(
 
             assert request['message'] == "Error extracting requested page from PDF file for notification_id {} type " \
                                          "{} {}".format(notification.id, type(PdfReadError()), error_message)
+
+
+def test_preview_letter_template_by_id_is_served_from_the_cache(
+    notify_api,
+    sample_letter_notification,
+    admin_request,
+    mocker,
+):
+    mock_redis_get = mocker.patch('app.template.rest.redis_store.get', return_value=b'AAE=')
+    mock_redis_set = mocker.patch('app.template.rest.redis_store.set')
+
+    with requests_mock.Mocker() as request_mock:
+        resp = admin_request.get(
+            'template.preview_letter_template_by_notification_id',
+            service_id=sample_letter_notification.service_id,
+            notification_id=sample_letter_notification.id,
+            file_type='png',
+        )
+
+    assert resp == {'content': 'AAE='}
+    assert not request_mock.called
+    assert mock_redis_get.call_args[0][0].startswith('letter-preview-{}-'.format(sample_letter_notification.id))
+    assert not mock_redis_set.called
+
+
+def test_preview_letter_template_by_id_caches_the_preview(
+    notify_api,
+    sample_letter_notification,
+    admin_request,
+    mocker,
+):
+    mocker.patch('app.template.rest.redis_store.get', return_value=None)
+    mock_redis_set = mocker.patch('app.template.rest.redis_store.set')
+
+    with set_config_values(notify_api, {
+        'TEMPLATE_PREVIEW_API_HOST': 'http://localhost/notifications-template-preview',
+        'TEMPLATE_PREVIEW_API_KEY': 'test-key'
+    }):
+        with requests_mock.Mocker() as request_mock:
+            request_mock.post('http://localhost/notifications-template-preview/preview.png', content=b'\x00\x01')
+
+            admin_request.get(
+                'template.preview_letter_template_by_notification_id',
+                service_id=sample_letter_notification.service_id,
+                notification_id=sample_letter_notification.id,
+                file_type='png',
+            )
+
+    mock_redis_set.assert_called_once_with(mocker.ANY, 'AAE=', ex=notify_api.config['LETTER_PREVIEW_CACHE_SECONDS'])
+
+
+def test_preview_letter_template_by_id_does_not_cache_large_previews(
+    notify_api,
+    sample_letter_notification,
+    admin_request,
+    mocker,
+):
+    mocker.patch('app.template.rest.redis_store.get', return_value=None)
+    mock_redis_set = mocker.patch('app.template.rest.redis_store.set')
+
+    with set_config_values(notify_api, {
+        'TEMPLATE_PREVIEW_API_HOST': 'http://localhost/notifications-template-preview',
+        'TEMPLATE_PREVIEW_API_KEY': 'test-key',
+        'LETTER_PREVIEW_CACHE_MAX_BYTES': 3,
+    }):
+        with requests_mock.Mocker() as request_mock:
+            request_mock.post('http://localhost/notifications-template-preview/preview.png', content=b'\x00\x01')
+
+            resp = admin_request.get(
+                'template.preview_letter_template_by_notification_id',
+                service_id=sample_letter_notification.service_id,
+                notification_id=sample_letter_notification.id,
+                file_type='png',
+            )
+
+    assert resp == {'content': 'AAE='}
+    assert not mock_redis_set.called
+
+
+def test_preview_letter_template_by_id_returns_304_if_preview_has_not_changed(
+    notify_api,
+    client,
+    sample_letter_notification,
+    mocker,
+):
+    mocker.patch('app.template.rest.redis_store.get', return_value=b'AAE=')
+    url = url_for(
+        'template.preview_letter_template_by_notification_id',
+        service_id=sample_letter_notification.service_id,
+        notification_id=sample_letter_notification.id,
+        file_type='png',
+    )
+
+    first_response = client.get(url, headers=[create_authorization_header()])
+    etag = first_response.headers['ETag']
+
+    response = client.get(url, headers=[create_authorization_header(), ('If-None-Match', etag)])
+
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert not response.get_data()
+
+
+def test_preview_letter_template_by_id_etag_changes_with_the_template(
+    notify_api,
+    client,
+    sample_letter_notification,
+    mocker,
+):
+    mocker.patch('app.template.rest.redis_store.get', return_value=b'AAE=')
+    url = url_for(
+        'template.preview_letter_template_by_notification_id',
+        service_id=sample_letter_notification.service_id,
+        notification_id=sample_letter_notification.id,
+        file_type='png',
+    )
+
+    etag = client.get(url, headers=[create_authorization_header()]).headers['ETag']
+    dao_get_template_by_id(sample_letter_notification.template_id).content = 'Changed'
+
+    response = client.get(url, headers=[create_authorization_header(), ('If-None-Match', etag)])
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
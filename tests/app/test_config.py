@@ -79,3 +79,28 @@ def test_queue_names_all_queues_correct():
         QueueNames.CALLBACKS,
         QueueNames.LETTERS,
     ]) == set(queues)
+
+
+def test_celery_imports_every_module_with_tasks(notify_api):
+    # workers don't import the blueprints, so tasks are only registered if their module is in CELERY_IMPORTS
+    from app import notify_celery
+
+    task_modules = {task.__module__ for task in notify_celery.tasks.values() if task.__module__.startswith('app.')}
+
+    assert task_modules <= set(notify_api.config['CELERY_TASK_MODULES'])
+
+
+def test_celery_imports_defaults_to_every_task_module(monkeypatch, reload_config):
+    monkeypatch.delenv('CELERY_IMPORTS', raising=False)
+
+    importlib.reload(config)
+
+    assert config.Config.CELERY_IMPORTS == config.Config.CELERY_TASK_MODULES
+
+
+def test_celery_imports_can_be_set_per_worker(monkeypatch, reload_config):
+    monkeypatch.setenv('CELERY_IMPORTS', 'app.celery.provider_tasks,app.celery.service_callback_tasks')
+
+    importlib.reload(config)
+
+    assert config.Config.CELERY_IMPORTS == ('app.celery.provider_tasks', 'app.celery.service_callback_tasks')
@@ -0,0 +1,163 @@
+import pytest
+from flask import Response, g
+from sqlalchemy.exc import ProgrammingError
+
+from app import db, instrumentation, redis_store
+from app.models import Notification
+
+from tests.conftest import set_config
+
+
+def test_database_queries_are_counted_against_the_app_context(notify_api, notify_db_session):
+    with notify_api.app_context():
+        Notification.query.all()
+        Notification.query.count()
+
+        count, total = instrumentation.get_timing_totals()['db']
+
+    assert count == 2
+    assert total > 0
+
+
+def test_failed_database_queries_are_counted(notify_api, notify_db_session):
+    with notify_api.app_context():
+        with pytest.raises(ProgrammingError):
+            db.session.execute('select * from not_a_table')
+        db.session.rollback()
+
+        assert instrumentation.get_timing_totals()['db'][0] == 1
+
+
+def test_redis_calls_are_counted_against_the_app_context(notify_api):
+    with set_config(notify_api, 'REDIS_ENABLED', False), notify_api.app_context():
+        redis_store.get('key')
+        redis_store.incr('key')
+
+        assert instrumentation.get_timing_totals()['redis'][0] == 2
+
+
+def test_timed_records_time_even_if_function_raises(notify_api):
+    @instrumentation.timed('http')
+    def call_provider():
+        raise ValueError()
+
+    with notify_api.app_context():
+        with pytest.raises(ValueError):
+            call_provider()
+
+        assert instrumentation.get_timing_totals()['http'][0] == 1
+
+
+def test_timing_totals_are_separate_for_each_app_context(notify_api):
+    with notify_api.app_context():
+        instrumentation.record('http', 1)
+
+    with notify_api.app_context():
+        assert instrumentation.get_timing_totals() == {}
+
+
+def test_add_timing_totals_adds_to_the_current_app_context(notify_api):
+    with notify_api.app_context():
+        instrumentation.record('db', 1)
+        instrumentation.add_timing_totals({'db': (2, 0.5), 'http': (1, 0.25)})
+
+        assert instrumentation.get_timing_totals() == {'db': (3, 1.5), 'http': (1, 0.25)}
+
+
+def test_start_sampled_profile_is_off_by_default(mocker):
+    assert instrumentation.start_sampled_profile(0) is None
+
+
+def test_log_profile_if_slow_only_logs_slow_tasks(notify_api, mocker):
+    logger = mocker.patch.object(notify_api.logger, 'info')
+
+    profile = instrumentation.start_sampled_profile(1)
+    instrumentation.log_profile_if_slow(profile, 'fast-task', 0.1, 5)
+    assert not logger.called
+
+    profile = instrumentation.start_sampled_profile(1)
+    instrumentation.log_profile_if_slow(profile, 'slow-task', 6, 5)
+    assert logger.call_args[0][0].startswith('Profile of slow-task which took 6.0000s')
+
+
+def test_span_does_nothing_outside_a_request(notify_api):
+    @instrumentation.span('persist')
+    def persist():
+        return 'persisted'
+
+    with notify_api.app_context():
+        assert persist() == 'persisted'
+        assert 'span_stack' not in g
+
+
+def test_spans_are_nested_under_the_request(notify_api):
+    with notify_api.test_request_context():
+        instrumentation.start_request_spans('v2_notifications.post_notification')
+        with instrumentation.span('auth'):
+            pass
+        with instrumentation.span('persist'):
+            with instrumentation.span('redis-counters'):
+                pass
+
+        root = g.span_stack[0]
+
+    assert [child['name'] for child in root['children']] == ['auth', 'persist']
+    assert [child['name'] for child in root['children'][1]['children']] == ['redis-counters']
+
+
+def test_finish_request_spans_records_span_and_call_timings(notify_api, mocker):
+    mock_timing = mocker.patch('app.statsd_client.timing')
+    mock_incr = mocker.patch('app.statsd_client.incr')
+
+    with notify_api.test_request_context():
+        instrumentation.start_request_spans('v2_notifications.post_notification')
+        with instrumentation.span('auth'):
+            instrumentation.record('db', 0.25)
+        response = instrumentation.finish_request_spans(Response())
+
+        assert 'span_stack' not in g
+
+    assert 'Server-Timing' not in response.headers
+    assert [args[0] for args, _ in mock_timing.call_args_list] == [
+        'requests.v2_notifications.post_notification.auth-time',
+        'requests.v2_notifications.post_notification.db-time',
+    ]
+    mock_incr.assert_called_once_with('requests.v2_notifications.post_notification.db-calls', count=1)
+
+
+def test_finish_request_spans_adds_server_timing_header(notify_api, mocker):
+    mocker.patch('app.instrumentation.monotonic', side_effect=[0, 0.01, 0.03, 0.05])
+
+    with set_config(notify_api, 'SERVER_TIMING_HEADER_ENABLED', True), notify_api.test_request_context():
+        instrumentation.start_request_spans('status.show_status')
+        with instrumentation.span('auth'):
+            pass
+        instrumentation.record('db', 0.004)
+        response = instrumentation.finish_request_spans(Response())
+
+    assert response.headers['Server-Timing'] == 'total;dur=50.0, auth;dur=20.0, db;desc="1 calls";dur=4.0'
+
+
+def test_finish_request_spans_logs_span_tree_of_slow_requests(notify_api, mocker):
+    logger = mocker.patch.object(notify_api.logger, 'warning')
+    mocker.patch('app.instrumentation.monotonic', side_effect=[0, 1, 1.5, 2])
+
+    with set_config(notify_api, 'SLOW_REQUEST_THRESHOLD_SECONDS', 1), notify_api.test_request_context():
+        instrumentation.start_request_spans('v2_notifications.post_notification')
+        with instrumentation.span('persist'):
+            pass
+        instrumentation.finish_request_spans(Response())
+
+    assert logger.call_args[0][0] == (
+        'Slow request v2_notifications.post_notification\n'
+        'v2_notifications.post_notification 2.0000s\n'
+        '  persist 0.5000s\n'
+    )
+
+
+def test_requests_get_server_timing_header(notify_api, client):
+    with set_config(notify_api, 'SERVER_TIMING_HEADER_ENABLED', True):
+        response = client.get('/_status')
+
+    assert response.status_code == 200
+    assert response.headers['Server-Timing'].startswith('total;dur=')
@@ -0,0 +1,115 @@
+import io
+
+import pytest
+
+from app.load_test import LoadTest, percentiles
+from app.models import EMAIL_TYPE, LETTER_TYPE, SMS_TYPE
+
+from tests.app.db import create_service, create_template
+
+
+@pytest.fixture
+def service(notify_db_session):
+    service = create_service(service_permissions=[EMAIL_TYPE, SMS_TYPE, LETTER_TYPE])
+    create_template(service, template_type=SMS_TYPE, content='Hello ((name)), your code is ((code))')
+    create_template(service, template_type=EMAIL_TYPE)
+    create_template(service, template_type=LETTER_TYPE, content='Dear ((name))')
+    return service
+
+
+def load_test(notify_api, service, mix=(80, 15, 5), job_rows=0):
+    return LoadTest(notify_api, service, notifications=10, clients=2, mix=mix, workers=1, receipt_rate=10,
+                    job_rows=job_rows)
+
+
+def test_load_test_needs_a_template_for_each_type_in_the_mix(notify_api, notify_db_session):
+    service = create_service()
+    create_template(service, template_type=SMS_TYPE)
+
+    assert load_test(notify_api, service, mix=(100, 0, 0)).templates[SMS_TYPE]
+    with pytest.raises(Exception) as e:
+        load_test(notify_api, service)
+    assert str(e.value) == 'Service {} has no email template'.format(service.id)
+
+
+def test_load_test_only_sends_jobs_for_services_in_research_mode(notify_api, service):
+    with pytest.raises(Exception) as e:
+        load_test(notify_api, service, job_rows=10)
+    assert 'must be in research mode' in str(e.value)
+
+    service.research_mode = True
+    assert load_test(notify_api, service, job_rows=10).job_rows == 10
+
+
+def test_load_test_needs_a_receipt_rate(notify_api, service):
+    with pytest.raises(Exception) as e:
+        LoadTest(notify_api, service, notifications=10, clients=2, mix=(80, 15, 5), workers=1, receipt_rate=0)
+    assert str(e.value) == 'Receipt rate must be more than 0'
+
+
+@pytest.mark.parametrize('notifications, mix, expected', [
+    (10, (80, 15, 5), {SMS_TYPE: 8, EMAIL_TYPE: 1, LETTER_TYPE: 1}),
+    (3, (1, 1, 1), {SMS_TYPE: 1, EMAIL_TYPE: 1, LETTER_TYPE: 1}),
+    (10, (1, 1, 1), {SMS_TYPE: 3, EMAIL_TYPE: 3, LETTER_TYPE: 4}),
+    (10, (50, 50, 0), {SMS_TYPE: 5, EMAIL_TYPE: 5, LETTER_TYPE: 0}),
+])
+def test_notification_types_add_up_to_notifications(notify_api, service, notifications, mix, expected):
+    test = LoadTest(notify_api, service, notifications=notifications, clients=2, mix=mix, workers=1, receipt_rate=10)
+
+    notification_types = test._notification_types()
+
+    assert len(notification_types) == notifications
+    assert {
+        notification_type: notification_types.count(notification_type) for notification_type in expected
+    } == expected
+
+
+def test_request_data_fills_in_placeholders(notify_api, service):
+    test = load_test(notify_api, service)
+
+    assert test._request_data(SMS_TYPE) == {
+        'phone_number': '07700900001',
+        'template_id': str(test.templates[SMS_TYPE].id),
+        'personalisation': {'name': 'load test', 'code': 'load test'},
+    }
+    assert test._request_data(LETTER_TYPE)['personalisation'] == {
+        'name': 'load test',
+        'address_line_1': 'Load Test',
+        'address_line_2': '1 Test Street',
+        'postcode': 'SW1A 1AA',
+    }
+
+
+def test_receipt_relay_holds_receipts_to_feed_back_later(notify_api, service, mocker):
+    test = load_test(notify_api, service)
+    start_response = mocker.Mock()
+
+    response = test._receipt_relay({
+        'PATH_INFO': '/notifications/sms/mmg',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': '2',
+        'wsgi.input': io.BytesIO(b'{}'),
+    }, start_response)
+
+    assert response == [b'{"result": "success"}']
+    start_response.assert_called_once_with('200 OK', [('Content-Type', 'application/json')])
+    assert test.receipts.get_nowait() == ('/notifications/sms/mmg', 'application/json', b'{}')
+
+
+def test_run_task_runs_task_from_message_and_acks_it(notify_api, service, mocker):
+    apply = mocker.patch('app.celery.provider_tasks.deliver_sms.apply')
+    message = mocker.Mock()
+
+    load_test(notify_api, service)._run_task({'task': 'deliver_sms', 'args': ['1'], 'kwargs': {}}, message)
+
+    apply.assert_called_once_with(args=['1'], kwargs={})
+    message.ack.assert_called_once_with()
+
+
+@pytest.mark.parametrize('values, expected', [
+    ([], {'p50': None, 'p95': None, 'p99': None}),
+    ([3, 1, 2], {'p50': 2, 'p95': 3, 'p99': 3}),
+    (list(range(1, 101)), {'p50': 50, 'p95': 95, 'p99': 99}),
+])
+def test_percentiles(values, expected):
+    assert percentiles(values) == expected
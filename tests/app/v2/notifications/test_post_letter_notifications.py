@@ -375,7 +375,7 @@ def test_post_letter_notification_is_delivered_and_has_pdf_uploaded_to_test_lett
 
     notification = Notification.query.one()
     assert notification.status == NOTIFICATION_PENDING_VIRUS_CHECK
-    s3mock.assert_called_once_with(ANY, b'letter-content', precompiled=True)
+    s3mock.assert_called_once_with(ANY, ANY, precompiled=True)
     mock_celery.assert_called_once_with(
         name=TaskNames.SCAN_FILE,
         kwargs={'filename': 'test.pdf'},
@@ -443,7 +443,11 @@ def test_post_precompiled_letter_with_invalid_base64(client, notify_user, mocker
 
 def test_post_precompiled_letter_notification_returns_201(client, notify_user, mocker):
     sample_service = create_service(service_permissions=['letter', 'precompiled_letter'])
-    s3mock = mocker.patch('app.v2.notifications.post_notifications.upload_letter_pdf')
+    uploaded = []
+    s3mock = mocker.patch(
+        'app.v2.notifications.post_notifications.upload_letter_pdf',
+        side_effect=lambda notification, letter_file, precompiled: uploaded.append(letter_file.read())
+    )
     mocker.patch('app.v2.notifications.post_notifications.pdf_page_count', return_value=5)
     mocker.patch("app.letters.rest.notify_celery.send_task")
     data = {
@@ -458,7 +462,8 @@ def test_post_precompiled_letter_notification_returns_201(client, notify_user, m
 
     assert response.status_code == 201, response.get_data(as_text=True)
 
-    s3mock.assert_called_once_with(ANY, b'letter-content', precompiled=True)
+    s3mock.assert_called_once_with(ANY, ANY, precompiled=True)
+    assert uploaded == [b'letter-content']
 
     notification = Notification.query.first()
 